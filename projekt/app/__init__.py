@@ -1,17 +1,25 @@
 import os
 from flask import Flask
-from config import Config
-from app.db import db, init_app, User
+from config import DATABASE_PROFILES
+from app.db import init_app
+from app.passwords import password_hasher
+from app.identity import identity_cache
+from app.instrumentation import sql_instrumentation
+from app.profiling import request_profiler
+from app.jobs import job_worker
+from app import exports, engine, benchmark, rollups, migrations, timetable, sessions, templating, warmup
 from flask_login import LoginManager
 
 login_manager = LoginManager()
 
-def create_app(test_config: dict=None, config_class=Config):
+def create_app(test_config: dict=None, config_class=None):
     app = Flask(__name__, instance_relative_config=True)
 
-    if test_config is None:
-        app.config.from_object(config_class)
-    else:
+    if config_class is None:
+        config_class = DATABASE_PROFILES[os.environ.get('DATABASE_PROFILE', 'sqlite')]
+
+    app.config.from_object(config_class)
+    if test_config is not None:
         app.config.from_mapping(test_config)
 
     try:
@@ -21,6 +29,20 @@ def create_app(test_config: dict=None, config_class=Config):
     
     
     init_app(app)
+    engine.init_app(app)
+    sql_instrumentation.init_app(app)
+    request_profiler.init_app(app)
+    password_hasher.init_app(app)
+    identity_cache.init_app(app)
+    exports.init_app(app)
+    rollups.init_app(app)
+    migrations.init_app(app)
+    timetable.init_app(app)
+    sessions.init_app(app)
+    templating.init_app(app)
+    warmup.init_app(app)
+    benchmark.init_app(app)
+    job_worker.init_app(app)
 
     login_manager.init_app(app)
     login_manager.login_view = 'auth.login'
@@ -41,8 +63,23 @@ def create_app(test_config: dict=None, config_class=Config):
 
     app.register_blueprint(clients_bp)
 
+    from app.routes.exports import exports_bp
+
+    app.register_blueprint(exports_bp)
+
+    from app.routes.api import api_bp
+
+    app.register_blueprint(api_bp)
+
+    from app.routes.calendar import calendar_bp
+
+    app.register_blueprint(calendar_bp)
+
+    if app.config['PRELOAD_WARMUP']:
+        warmup.warmup(app)
+
     return app
 
 @login_manager.user_loader
 def load_user(user_id):
-    return db.session.get(User, int(user_id))
\ No newline at end of file
+    return identity_cache.get(int(user_id))
\ No newline at end of file
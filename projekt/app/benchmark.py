@@ -0,0 +1,419 @@
+import gc
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import namedtuple
+from datetime import date, time as dtime, timedelta
+import click
+from flask import url_for
+from sqlalchemy import event
+from app.db import (
+    db, User, Client, Trainer, Employee, Owner, MembershipType, Membership, GroupClass, Participation,
+    refresh_membership_valid_until, refresh_participant_counts, rebuild_search_index
+)
+from app.rollups import rebuild_rollups
+from app.identity import issue_feed_token
+from app.instrumentation import is_transaction_control
+
+BENCHMARK_SEED = 2024
+BENCHMARK_PASSWORD = 'benchmark-haslo'
+BENCHMARK_SCALES = {'1k': 1_000, '10k': 10_000, '100k': 100_000}
+BUDGETS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmark_budgets.json')
+
+FIRST_NAMES = ['Anna', 'Piotr', 'Katarzyna', 'Tomasz', 'Magdalena', 'Paweł', 'Agnieszka', 'Łukasz', 'Zofia', 'Michał']
+LAST_NAMES = ['Nowak', 'Kowalski', 'Wiśniewska', 'Wójcik', 'Kamińska', 'Lewandowski', 'Zieliński', 'Szymańska', 'Woźniak', 'Dąbrowski']
+
+# Scenariusz: nazwa trasy (klucz budżetu), rola zalogowanego użytkownika, metoda, adres i dane formularza
+Scenario = namedtuple('Scenario', 'name role method endpoint params data')
+
+SCENARIOS = [
+    Scenario('main.index', None, 'GET', 'main.index', {}, None),
+    Scenario('main.index[owner]', 'owner', 'GET', 'main.index', {}, None),
+    Scenario('auth.login', None, 'GET', 'auth.login', {}, None),
+    Scenario('auth.login[post]', None, 'POST', 'auth.login', {}, {'username': 'bench_client', 'password': BENCHMARK_PASSWORD}),
+    Scenario('clients.index', 'employee', 'GET', 'clients.index', {}, None),
+    Scenario('clients.index[search]', 'employee', 'GET', 'clients.index', {'search': 'kowal'}, None),
+    Scenario('clients.index[search:pesel]', 'employee', 'GET', 'clients.index', {'search': '0000001'}, None),
+    Scenario('clients.index[membership]', 'employee', 'GET', 'clients.index', {'membership': 'active'}, None),
+    Scenario('clients.view_membership', 'employee', 'GET', 'clients.view_membership', {'id': 'client_id'}, None),
+    Scenario('gym.view_membership_types', 'employee', 'GET', 'gym.view_membership_types', {}, None),
+    Scenario('gym.view_trainers', None, 'GET', 'gym.view_trainers', {}, None),
+    Scenario('gym.view_employees', 'owner', 'GET', 'gym.view_employees', {}, None),
+    Scenario('gym.view_classes', 'client', 'GET', 'gym.view_classes', {}, None),
+    Scenario('gym.view_class', 'client', 'GET', 'gym.view_class', {'id': 'class_id'}, None),
+    Scenario('gym.join_class', 'client', 'POST', 'gym.join_class', {'id': 'class_id'}, {}),
+    Scenario('gym.leave_class', 'client', 'POST', 'gym.leave_class', {'id': 'class_id'}, {}),
+    Scenario('calendar.feed', None, 'GET', 'calendar.feed', {'token': 'feed_token'}, None),
+]
+
+def seed_dataset(clients, seed=BENCHMARK_SEED):
+    """Deterministyczny zbiór danych: konta personelu, trenerzy, zajęcia i `clients` klientów z karnetami."""
+    rng = random.Random(seed)
+    today = date.today()
+    db.create_all()
+
+    staff = []
+    for username, role, profile_class in [('bench_owner', 'owner', Owner), ('bench_employee', 'employee', Employee), ('bench_client', 'client', Client)]:
+        user = User(username=username, email=f'{username}@example.com', role=role)
+        user.set_password(BENCHMARK_PASSWORD)
+        staff.append(profile_class(
+            first_name='Test', last_name=role.capitalize(), pesel=f'9{len(staff):010d}', phone_number='500000000', user=user
+        ))
+    trainers = [
+        Trainer(first_name=rng.choice(FIRST_NAMES), last_name=rng.choice(LAST_NAMES), pesel=f'8{i:010d}', phone_number='600000000')
+        for i in range(10)
+    ]
+    mem_types = [
+        MembershipType(name='Miesięczny', price=120, duration=30),
+        MembershipType(name='Kwartalny', price=330, duration=90),
+        MembershipType(name='Roczny', price=1200, duration=365),
+    ]
+    classes = [
+        GroupClass(
+            name=f'Zajęcia {i}', day=i % 7, start_hour=dtime(8 + i % 12), length=60, capacity=30,
+            trainer=trainers[i % len(trainers)]
+        )
+        for i in range(40)
+    ]
+    db.session.add_all(staff + trainers + mem_types + classes)
+    db.session.flush()
+    bench_client = staff[2]
+    db.session.add(Membership(client=bench_client, type=mem_types[2], start_date=today))
+
+    # każdy klient ma konto jak w produkcji, żeby zapytania N+1 po relacji user były widoczne;
+    # jeden wspólny hasz, bo argon2 dla każdego konta trwałby dłużej niż cały pomiar
+    password_hash = bench_client.user.password_hash
+    client_ids = []
+    for start in range(0, clients, 5000):
+        numbers = range(start, min(start + 5000, clients))
+        user_ids = db.session.scalars(
+            db.insert(User).returning(User.id, sort_by_parameter_order=True),
+            [{'username': f'klient{i}', 'email': f'klient{i}@example.com', 'password_hash': password_hash, 'role': 'client'}
+             for i in numbers]
+        ).all()
+        client_ids += db.session.scalars(
+            db.insert(Client).returning(Client.id, sort_by_parameter_order=True),
+            [{
+                'first_name': rng.choice(FIRST_NAMES), 'last_name': rng.choice(LAST_NAMES),
+                'pesel': f'{i:011d}', 'phone_number': f'5{rng.randrange(10 ** 8):08d}', 'active': rng.random() > 0.05,
+                'user_id': user_id,
+            } for i, user_id in zip(numbers, user_ids)]
+        ).all()
+
+    memberships = []
+    for client_id in client_ids:
+        if rng.random() < 0.6:
+            mem_type = rng.choice(mem_types)
+            memberships.append({
+                'client_id': client_id, 'type_id': mem_type.id, 'price': mem_type.price,
+                'start_date': today - timedelta(days=rng.randrange(400)), 'active': True,
+            })
+    if memberships:
+        db.session.execute(db.insert(Membership), memberships)
+
+    # zajęcie classes[0] zostaje puste - na nim mierzone są zapisy
+    participations = [
+        {'client_id': client_id, 'group_class_id': group_class.id}
+        for group_class in classes[1:]
+        for client_id in rng.sample(client_ids, min(20, len(client_ids)))
+    ]
+    if participations:
+        db.session.execute(db.insert(Participation), participations)
+
+    refresh_membership_valid_until()
+    refresh_participant_counts()
+    db.session.commit()
+    if db.engine.dialect.name == 'sqlite':
+        rebuild_search_index()
+    rebuild_rollups()
+    db.session.commit()
+    return {'client_id': bench_client.id, 'class_id': classes[0].id, 'feed_token': issue_feed_token('trainer', trainers[1].id, trainers[1].feed_secret)}
+
+def _percentile(samples, percent):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+def _make_client(app, role, login_url):
+    client = app.test_client()
+    if role is not None:
+        response = client.post(login_url, data={'username': f'bench_{role}', 'password': BENCHMARK_PASSWORD})
+        assert response.status_code == 302, f'logowanie {role} nie powiodło się'
+    return client
+
+def _resolve_urls(app, ids):
+    # adresy wyznaczane z góry - żądania nie mogą dzielić kontekstu aplikacji (g) z tym kontekstem
+    with app.test_request_context():
+        urls = {'login': url_for('auth.login')}
+        for scenario in SCENARIOS:
+            params = {key: ids.get(value, value) for key, value in scenario.params.items()}
+            urls[scenario.name] = url_for(scenario.endpoint, **params)
+    return urls
+
+def run_benchmark(app, ids, iterations=20, warmup=2, executed=None):
+    """Mierzy każdy scenariusz. Zwraca {nazwa: {'queries', 'p50_ms', 'p95_ms', 'p99_ms'}}.
+
+    Jeśli podano słownik `executed`, zbiera w nim wykonane zapytania (zapytanie -> parametry) dla explain_full_scans.
+    """
+    urls = _resolve_urls(app, ids)
+    statements = []
+    with app.app_context():
+        engines = list(db.engines.values())  # także pula odczytu widoków @read_only
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        if is_transaction_control(statement):
+            return
+        statements.append(1)
+        if executed is not None and not executemany:
+            executed.setdefault(statement, parameters)
+
+    for engine in engines:
+        event.listen(engine, 'before_cursor_execute', count_statement)
+    results = {}
+    try:
+        for scenario in SCENARIOS:
+            client = _make_client(app, scenario.role, urls['login'])
+            timings, queries = [], []
+            # jak timeit: odśmiecanie poza pomiarem, inaczej pauza GC trafia zawsze w ten sam scenariusz
+            gc.collect()
+            gc.disable()
+            for iteration in range(warmup + iterations):
+                if scenario.name == 'auth.login[post]':
+                    client = app.test_client()  # zalogowany użytkownik zostałby przekierowany bez sprawdzania hasła
+                statements.clear()
+                started = time.perf_counter()
+                response = client.open(urls[scenario.name], method=scenario.method, data=scenario.data)
+                elapsed = (time.perf_counter() - started) * 1000
+                if iteration >= warmup:  # pierwsze żądania rozgrzewają pamięci podręczne i szablony
+                    timings.append(elapsed)
+                    queries.append(len(statements))
+                if response.status_code >= 400:
+                    raise click.ClickException(f'{scenario.name}: HTTP {response.status_code}')
+                # przywrócenie stanu, żeby każda iteracja mierzyła to samo
+                if scenario.name == 'gym.join_class':
+                    client.post(urls['gym.leave_class'])
+                elif scenario.name == 'gym.leave_class':
+                    client.post(urls['gym.join_class'])
+            gc.enable()
+            results[scenario.name] = {
+                'queries': max(queries),
+                'p50_ms': round(_percentile(timings, 50), 2),
+                'p95_ms': round(_percentile(timings, 95), 2),
+                'p99_ms': round(_percentile(timings, 99), 2),
+            }
+    finally:
+        gc.enable()
+        for engine in engines:
+            event.remove(engine, 'before_cursor_execute', count_statement)
+    return results
+
+# tabele czytane w całości celowo: małe słowniki i tygodniowy grafik zajęć
+EXPLAIN_SCAN_ALLOWED = {'membership_type', 'cache_version', 'group_class'}
+# pełny odczyt tabeli albo całego indeksu (skan tabeli wirtualnej FTS i CONSTANT ROW nie pasują)
+_FULL_SCAN = re.compile(r'^SCAN (\w+)(?: USING (?:COVERING )?INDEX \w+)?$')
+# ORDER BY ... LIMIT zamykające całe zapytanie (a nie podzapytanie)
+_OUTER_PAGE = re.compile(r'\sORDER BY\s[^()]*\sLIMIT\s+\S+(?:\s+OFFSET\s+\S+)?\s*$')
+
+def explain_full_scans(engine, executed):
+    """EXPLAIN QUERY PLAN (SQLite) dla każdego zapytania - lista (tabela, zapytanie) czytanych w całości.
+
+    Pomijana jest tylko zewnętrzna pętla stronicowania: ORDER BY ... LIMIT całego zapytania bez USE TEMP B-TREE,
+    czyli skan indeksu (albo klucza rowid) w kolejności sortowania, przerwany po jednej stronie.
+    Skany w podzapytaniach i w wewnętrznych pętlach złączeń są zgłaszane także przy LIMIT.
+    """
+    scans = []
+    with engine.connect() as connection:
+        for statement, parameters in executed.items():
+            plan = [(row[1], row[3]) for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)]
+            paginated = _OUTER_PAGE.search(statement) and not any(step.startswith('USE TEMP B-TREE') for _, step in plan)
+            outer = next((i for i, (parent, _) in enumerate(plan) if parent == 0), None)
+            for i, (parent, step) in enumerate(plan):
+                match = _FULL_SCAN.match(step)
+                if match is None or match.group(1) in EXPLAIN_SCAN_ALLOWED or (paginated and i == outer):
+                    continue
+                scans.append((match.group(1), ' '.join(statement.split())))
+    return scans
+
+def check_budgets(results, budgets, scale):
+    """Lista przekroczeń budżetu: liczba zapytań nie zależy od skali, opóźnienie p95 - tak."""
+    failures = []
+    for name, result in results.items():
+        budget = budgets.get(name)
+        if budget is None:
+            failures.append(f'{name}: brak budżetu')
+            continue
+        if result['queries'] > budget['queries']:
+            failures.append(f"{name}: {result['queries']} zapytań SQL (budżet {budget['queries']})")
+        limit = budget['p95_ms'].get(scale)
+        if limit is not None and result['p95_ms'] > limit:
+            failures.append(f"{name}: p95 {result['p95_ms']} ms (budżet {limit} ms)")
+    return failures
+
+def _benchmark_app(database_path, **config):
+    from app import create_app
+    return create_app(test_config={
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + database_path,
+        'WTF_CSRF_ENABLED': False,
+        'ARGON2_PROFILE': 'fast',  # mierzymy aplikację, a nie koszt haszowania
+        'PASSWORD_HASH_WORKERS': 0,
+        'JOB_WORKER_IN_PROCESS': False,  # odpytywanie kolejki zawyżałoby liczbę zapytań
+        'USER_CACHE_SYNC_INTERVAL': 3600,  # tak samo okresowe sprawdzanie licznika tożsamości
+        **config,
+    })
+
+@click.command('benchmark')
+@click.option('--scale', 'scales', multiple=True, type=click.Choice(list(BENCHMARK_SCALES)), default=['1k'], show_default=True,
+              help='Dataset size (repeatable)')
+@click.option('--iterations', default=20, show_default=True, help='Requests per route')
+@click.option('--budgets', 'budgets_path', type=click.Path(dir_okay=False), default=BUDGETS_PATH, help='Budget file')
+@click.option('--update-budgets', is_flag=True, help='Store the measured values (with headroom) as the new budgets')
+@click.option('--explain', is_flag=True, help='Fail on queries whose SQLite plan reads a whole table')
+def benchmark_command(scales, iterations, budgets_path, update_budgets, explain):
+    """Benchmarks every route on synthetic datasets and checks query-count and latency budgets"""
+    budgets = {}
+    if os.path.exists(budgets_path):
+        with open(budgets_path, encoding='utf-8') as f:
+            budgets = json.load(f)
+
+    failures = []
+    for scale in scales:
+        workdir = tempfile.mkdtemp(prefix='benchmark-')
+        try:
+            app = _benchmark_app(os.path.join(workdir, 'benchmark.db'))
+            with app.app_context():
+                ids = seed_dataset(BENCHMARK_SCALES[scale])
+            executed = {} if explain else None
+            results = run_benchmark(app, ids, iterations, executed=executed)
+            if explain:
+                with app.app_context():
+                    scans = explain_full_scans(db.engine, executed)
+                failures += [f'[{scale}] pełny odczyt tabeli {table}: {statement[:200]}' for table, statement in scans]
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        click.echo(f'== {scale} klientów ==')
+        for name, result in results.items():
+            click.echo(f"{name:32} {result['queries']:3} zapytań  p50 {result['p50_ms']:8.2f} ms  p95 {result['p95_ms']:8.2f} ms  p99 {result['p99_ms']:8.2f} ms")
+
+        if update_budgets:
+            for name, result in results.items():
+                budget = budgets.setdefault(name, {'queries': 0, 'p95_ms': {}})
+                budget['queries'] = result['queries']
+                budget['p95_ms'][scale] = round(max(result['p95_ms'] * 2, result['p95_ms'] + 20), 1)
+        else:
+            failures += [f'[{scale}] {failure}' for failure in check_budgets(results, budgets, scale)]
+
+    if update_budgets:
+        with open(budgets_path, 'w', encoding='utf-8') as f:
+            json.dump(budgets, f, indent=2, ensure_ascii=False, sort_keys=True)
+            f.write('\n')
+        click.echo(f'Zapisano budżety do {budgets_path}')
+    for failure in failures:
+        click.echo(click.style(failure, fg='red'))
+    if failures:
+        raise SystemExit(1)
+
+# Start procesu roboczego: od startu procesu (albo od forka) do obsłużenia pierwszych żądań
+STARTUP_SCENARIOS = ('main.index', 'auth.login', 'auth.login[post]', 'gym.view_classes', 'gym.view_class')
+
+def _serve_first_requests(app, ids):
+    urls = _resolve_urls(app, ids)
+    scenarios = {scenario.name: scenario for scenario in SCENARIOS}
+    client = app.test_client()  # po auth.login[post] kolejne żądania są już żądaniami zalogowanego klienta
+    for name in STARTUP_SCENARIOS:
+        response = client.open(urls[name], method=scenarios[name].method, data=scenarios[name].data)
+        if response.status_code >= 400:
+            raise RuntimeError(f'{name}: HTTP {response.status_code}')
+
+def _cold_worker(started, database_path, ids, bytecode_dir):
+    """Wejście procesu `python -c` - worker bez preloadu: import pakietu, create_app i pierwsze żądania."""
+    config = {'TEMPLATE_BYTECODE_DIR': bytecode_dir} if bytecode_dir else {'TEMPLATE_BYTECODE_CACHE': False}
+    app = _benchmark_app(database_path, **config)
+    _serve_first_requests(app, json.loads(ids))
+    print((time.perf_counter() - started) * 1000)
+
+def _spawn_cold_worker(database_path, ids, bytecode_dir=''):
+    code = 'import sys, time; started = time.perf_counter(); from app.benchmark import _cold_worker; _cold_worker(started, *sys.argv[1:])'
+    result = subprocess.run(
+        [sys.executable, '-c', code, database_path, json.dumps(ids), bytecode_dir],
+        cwd=os.path.dirname(BUDGETS_PATH), capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise click.ClickException(f'worker bez preloadu: {result.stderr.strip()[-500:]}')
+    return float(result.stdout.strip().splitlines()[-1])
+
+def _fork_worker(app, ids):
+    """Worker po forku z rozgrzanego procesu nadrzędnego (jak gunicorn --preload)."""
+    read_fd, write_fd = os.pipe()
+    started = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(read_fd)
+            _serve_first_requests(app, ids)
+            os.write(write_fd, str((time.perf_counter() - started) * 1000).encode())
+            status = 0
+        finally:
+            os._exit(status)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        elapsed = f.read()
+    os.waitpid(pid, 0)
+    if not elapsed:
+        raise click.ClickException('worker po forku zakończył się błędem')
+    return float(elapsed)
+
+def benchmark_startup(workers=4, clients=1_000):
+    """Czas startu workera w trzech trybach. Zwraca {tryb: [ms dla kolejnych workerów]} i czas rozgrzewki (ms)."""
+    from app.warmup import warmup
+    workdir = tempfile.mkdtemp(prefix='benchmark-startup-')
+    try:
+        database_path = os.path.join(workdir, 'benchmark.db')
+        bytecode_dir = os.path.join(workdir, 'jinja_cache')
+        app = _benchmark_app(database_path, TEMPLATE_BYTECODE_DIR=bytecode_dir)
+        with app.app_context():
+            ids = seed_dataset(clients)
+            db.session.remove()
+            for engine in db.engines.values():
+                engine.dispose()
+
+        results = {'cold': [_spawn_cold_worker(database_path, ids) for _ in range(workers)]}
+        _spawn_cold_worker(database_path, ids, bytecode_dir)  # zapełnia pamięć kodu bajtowego (precompile-templates)
+        results['bytecode'] = [_spawn_cold_worker(database_path, ids, bytecode_dir) for _ in range(workers)]
+
+        app = _benchmark_app(database_path, TEMPLATE_BYTECODE_DIR=bytecode_dir)
+        started = time.perf_counter()
+        warmup(app)
+        warmup_ms = (time.perf_counter() - started) * 1000
+        results['preload'] = [_fork_worker(app, ids) for _ in range(workers)]
+        return results, warmup_ms
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+@click.command('benchmark-startup')
+@click.option('--workers', default=4, show_default=True, help='Workers started per mode')
+@click.option('--scale', type=click.Choice(list(BENCHMARK_SCALES)), default='1k', show_default=True, help='Dataset size')
+def benchmark_startup_command(workers, scale):
+    """Measures worker start-up time without preload, with a bytecode cache and forked from a warmed-up master"""
+    if not hasattr(os, 'fork'):
+        raise click.ClickException('benchmark-startup wymaga os.fork (Linux / macOS)')
+    results, warmup_ms = benchmark_startup(workers, BENCHMARK_SCALES[scale])
+    click.echo(f'Pierwsze żądania workera: {", ".join(STARTUP_SCENARIOS)}')
+    labels = {
+        'cold': 'bez preloadu (import, create_app, kompilacja szablonów)',
+        'bytecode': 'bez preloadu, szablony z pamięci kodu bajtowego',
+        'preload': f'fork po rozgrzewce procesu nadrzędnego ({warmup_ms:.0f} ms raz)',
+    }
+    for mode, timings in results.items():
+        click.echo(f"{mode:9} mediana {statistics.median(timings):8.1f} ms  max {max(timings):8.1f} ms  - {labels[mode]}")
+
+def init_app(app):
+    app.cli.add_command(benchmark_command)
+    app.cli.add_command(benchmark_startup_command)
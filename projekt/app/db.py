@@ -1,17 +1,26 @@
 from flask_sqlalchemy import SQLAlchemy
 from typing import List, Optional
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from sqlalchemy import String, Integer, ForeignKey, Date, Time, Boolean
-from datetime import date, time, timedelta
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, query_expression
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy import String, Integer, ForeignKey, Date, DateTime, Time, Boolean, Index, UniqueConstraint, DDL, event, table, column
+from datetime import date, datetime, time, timedelta
+import csv
+from collections import Counter
+import json
+import secrets
+import unicodedata
 import click
 from flask import current_app
 from flask_login import UserMixin
-from passlib.hash import argon2
+from app.passwords import password_hasher
+from app.routing import RoutingSession, configure_read_bind
 
 class Base(DeclarativeBase):
     pass
 
-db = SQLAlchemy(model_class=Base)
+db = SQLAlchemy(model_class=Base, session_options={'class_': RoutingSession})
 
 class User(UserMixin, db.Model):
     __tablename__ = "user"
@@ -26,10 +35,16 @@ class User(UserMixin, db.Model):
     person_profile: Mapped[Optional["Person"]] = relationship(back_populates="user", uselist=False)
 
     def set_password(self, password):
-        self.password_hash = argon2.hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password):
-        return argon2.verify(password, self.password_hash)
+        valid, new_hash = password_hasher.verify(password, self.password_hash)
+        if new_hash:
+            self.password_hash = new_hash  # hasz z nieaktualnym profilem kosztu - zapisywany przy commicie
+        return valid
+
+def new_feed_secret():
+    return secrets.token_urlsafe(12)
 
 class Person(db.Model):
     __tablename__ = "person"
@@ -43,6 +58,8 @@ class Person(db.Model):
     active: Mapped[bool] = mapped_column(Boolean, nullable=False, default=True)
     user_id: Mapped[int] = mapped_column(ForeignKey("user.id"), nullable=True, unique=True)
     user: Mapped["User"] = relationship(back_populates="person_profile")
+    # część tokenu kanału iCalendar - nowy sekret unieważnia wszystkie wcześniej wydane adresy kanału
+    feed_secret: Mapped[Optional[str]] = mapped_column(String(32), nullable=True, default=new_feed_secret)
 
     type: Mapped[str] = mapped_column(String(50))
 
@@ -51,6 +68,55 @@ class Person(db.Model):
         "polymorphic_on": "type",
     }
 
+    __table_args__ = (
+        Index('ix_person_type_active', 'type', 'active'),
+    )
+
+# Indeks pełnotekstowy (FTS5, trigramy) po danych osobowych - rowid = person.id.
+# Treść jest już znormalizowana przez fold_text, więc wyszukiwanie ignoruje wielkość liter i polskie znaki.
+person_fts = table('person_fts', column('rowid', Integer), column('content', String))
+
+PERSON_SEARCH_COLUMNS = ('first_name', 'last_name', 'pesel', 'phone_number')
+
+event.listen(
+    Person.__table__, 'after_create',
+    DDL("CREATE VIRTUAL TABLE IF NOT EXISTS person_fts USING fts5(content, tokenize='trigram')").execute_if(dialect='sqlite')
+)
+
+def fold_text(value):
+    value = value.lower().replace('ł', 'l')
+    return ''.join(ch for ch in unicodedata.normalize('NFKD', value) if not unicodedata.combining(ch))
+
+def person_search_text(first_name, last_name, pesel, phone_number):
+    return fold_text(' '.join([first_name, last_name, pesel, phone_number]))
+
+def _write_search_entry(connection, target):
+    connection.execute(person_fts.delete().where(person_fts.c.rowid == target.id))
+    connection.execute(person_fts.insert().values(
+        rowid=target.id,
+        content=person_search_text(*(getattr(target, c) for c in PERSON_SEARCH_COLUMNS))
+    ))
+
+@event.listens_for(Person, 'after_insert', propagate=True)
+def _index_new_person(mapper, connection, target):
+    if connection.dialect.name == 'sqlite':
+        _write_search_entry(connection, target)
+
+@event.listens_for(Person, 'after_update', propagate=True)
+def _reindex_person(mapper, connection, target):
+    if connection.dialect.name != 'sqlite':
+        return
+    state = db.inspect(target)
+    # miękkie usunięcie (active=False) nie zmienia treści indeksu - osoba dalej jest wyszukiwalna w archiwum
+    if any(state.attrs[c].history.has_changes() for c in PERSON_SEARCH_COLUMNS):
+        _write_search_entry(connection, target)
+
+@event.listens_for(Person, 'after_delete', propagate=True)
+def _unindex_person(mapper, connection, target):
+    if connection.dialect.name != 'sqlite':
+        return
+    connection.execute(person_fts.delete().where(person_fts.c.rowid == target.id))
+
 class Client(Person):
     __tablename__ = "client"
     
@@ -59,10 +125,36 @@ class Client(Person):
     memberships: Mapped[List["Membership"]] = relationship(back_populates="client")
     participations: Mapped[List["Participation"]] = relationship(back_populates="client")
 
+    # data końca najdłuższego rozpoczętego, nieanulowanego karnetu - patrz refresh_membership_valid_until
+    membership_valid_until: Mapped[Optional[date]] = mapped_column(Date, nullable=True, index=True)
+    created_on: Mapped[Optional[date]] = mapped_column(Date, nullable=True, default=date.today) # data rejestracji (statystyki)
+
     __mapper_args__ = {
         "polymorphic_identity": "client",
     }
 
+    @hybrid_property
+    def has_active_membership(self):
+        return any(m.is_active for m in self.memberships)
+
+    @has_active_membership.expression
+    def has_active_membership(cls):
+        return db.exists().where(Membership.client_id == cls.id, Membership.is_active)
+
+    @hybrid_property
+    def has_valid_membership(self):
+        return self.membership_valid_until is not None and self.membership_valid_until >= date.today()
+
+    @has_valid_membership.expression
+    def has_valid_membership(cls):
+        return cls.membership_valid_until >= date.today()
+
+    def extend_membership_valid_until(self, membership):
+        """Przyrostowa aktualizacja po sprzedaży karnetu (bez ładowania pozostałych karnetów)."""
+        end_date = membership.start_date + timedelta(days=membership.type.duration)
+        if membership.start_date <= date.today() and (self.membership_valid_until is None or end_date > self.membership_valid_until):
+            self.membership_valid_until = end_date
+
 class Trainer(Person):
     __tablename__ = "trainer"
     id: Mapped[int] = mapped_column(ForeignKey("person.id"), primary_key=True)
@@ -84,6 +176,21 @@ class Owner(Person):
     __mapper_args__ = { "polymorphic_identity": "owner" }
 
 
+class add_days(FunctionElement):
+    """Data przesunięta o liczbę dni - SQL zależny od dialektu (SQLite: date(), PostgreSQL: make_interval)."""
+    type = Date()
+    inherit_cache = True
+
+@compiles(add_days)
+def _add_days_sqlite(element, compiler, **kw):
+    start, days = list(element.clauses)
+    return "date(%s, '+' || CAST(%s AS VARCHAR) || ' days')" % (compiler.process(start, **kw), compiler.process(days, **kw))
+
+@compiles(add_days, 'postgresql')
+def _add_days_postgresql(element, compiler, **kw):
+    start, days = list(element.clauses)
+    return 'CAST(%s + make_interval(days => %s) AS DATE)' % (compiler.process(start, **kw), compiler.process(days, **kw))
+
 class MembershipType(db.Model):
     __tablename__ = "membership_type"
 
@@ -95,6 +202,13 @@ class MembershipType(db.Model):
     
     memberships: Mapped[List['Membership']] = relationship(back_populates="type")
 
+    active_memberships: Mapped[Optional[int]] = query_expression()
+
+
+def _sale_price(context):
+    # cena typu z chwili sprzedaży - późniejsza zmiana cennika nie przepisuje przychodu z przeszłości
+    type_id = context.get_current_parameters()['type_id']
+    return context.connection.execute(db.select(MembershipType.price).where(MembershipType.id == type_id)).scalar()
 
 class Membership(db.Model):
     __tablename__ = "membership"
@@ -103,21 +217,40 @@ class Membership(db.Model):
     start_date: Mapped[date] = mapped_column(Date, nullable=False) 
     client_id: Mapped[int] = mapped_column(ForeignKey("client.id")) 
     client: Mapped["Client"] = relationship(back_populates="memberships")
-    type_id: Mapped[int] = mapped_column(ForeignKey("membership_type.id"))
+    type_id: Mapped[int] = mapped_column(ForeignKey("membership_type.id"), index=True)
     type: Mapped['MembershipType'] = relationship(back_populates="memberships")
     active: Mapped[bool] = mapped_column(Boolean, nullable=False, default=True)
+    price: Mapped[Optional[float]] = mapped_column(nullable=True, default=_sale_price)  # cena w dniu sprzedaży
+
+    # indeks złożony obsługuje też samo client_id (klucz obcy)
+    __table_args__ = (
+        Index('ix_membership_client_active', 'client_id', 'active', 'start_date'),
+    )
 
-    @property
+    @hybrid_property
     def end_date(self):
         if self.start_date and self.type:
             return self.start_date + timedelta(days=self.type.duration)
         return None
 
-    @property
+    @end_date.expression
+    def end_date(cls):
+        duration = (
+            db.select(MembershipType.duration).where(MembershipType.id == cls.type_id)
+            .correlate_except(MembershipType).scalar_subquery()
+        )
+        return add_days(cls.start_date, duration)
+
+    @hybrid_property
     def is_active(self):
         today = date.today()
         return self.start_date <= today and self.end_date >= today and self.active
 
+    @is_active.expression
+    def is_active(cls):
+        today = date.today()
+        return db.and_(cls.active == True, cls.start_date <= today, cls.end_date >= today)
+
 class GroupClass(db.Model):
     __tablename__ = "group_class"
 
@@ -126,23 +259,43 @@ class GroupClass(db.Model):
     day: Mapped[int] = mapped_column(Integer, nullable=False) # 0=Pon, 1=Wt...
     start_hour: Mapped[time] = mapped_column(Time, nullable=False)
     length: Mapped[int] = mapped_column(Integer, nullable=False) # w minutach
+    capacity: Mapped[int] = mapped_column(Integer, nullable=False, default=20, server_default='20')
+    participant_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default='0') # utrzymywane przez enroll/unenroll
 
-    trainer_id: Mapped[int] = mapped_column(ForeignKey("trainer.id"))
+    trainer_id: Mapped[int] = mapped_column(ForeignKey("trainer.id"), index=True)
 
     trainer: Mapped["Trainer"] = relationship(back_populates="group_classes")
     participations: Mapped[List["Participation"]] = relationship(back_populates="group_class")
 
+    __table_args__ = (
+        Index('ix_group_class_day_start_hour', 'day', 'start_hour'),
+    )
+
 class Participation(db.Model):
     __tablename__ = "participation"
 
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
 
     client_id: Mapped[int] = mapped_column(ForeignKey("client.id"))
-    group_class_id: Mapped[int] = mapped_column(ForeignKey("group_class.id"))
+    group_class_id: Mapped[int] = mapped_column(ForeignKey("group_class.id"), index=True)
+    created_on: Mapped[Optional[date]] = mapped_column(Date, nullable=True, default=date.today) # data zapisu (statystyki)
 
     client: Mapped["Client"] = relationship(back_populates="participations")
     group_class: Mapped["GroupClass"] = relationship(back_populates="participations")
 
+    # ograniczenie unikalności zaczyna się od client_id, więc służy też jako indeks tego klucza obcego
+    __table_args__ = (
+        UniqueConstraint('client_id', 'group_class_id', name='uq_participation_client_class'),
+    )
+
+class CacheVersion(db.Model):
+    """Licznik wersji danych współdzielony przez procesy - zmiana wersji unieważnia ich pamięci podręczne."""
+    __tablename__ = "cache_version"
+
+    name: Mapped[str] = mapped_column(String(50), primary_key=True)
+    version: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    updated_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)  # UTC, nagłówek Last-Modified w API
+
 def init_db():
     with current_app.app_context():
         db.create_all()
@@ -151,12 +304,249 @@ def init_db():
 def init_db_command():
     """Clear the existing data and create new tables"""
     init_db()
+    from app.migrations import stamp
+    stamp()  # nowa baza ma już najnowszy schemat
     click.echo('Initialized the database')
 
+def rebuild_search_index():
+    """Buduje indeks person_fts od zera (bez commita - zatwierdza wywołujący). Zwraca liczbę osób."""
+    db.session.execute(db.text("CREATE VIRTUAL TABLE IF NOT EXISTS person_fts USING fts5(content, tokenize='trigram')"))
+    db.session.execute(person_fts.delete())
+
+    rows = db.session.execute(db.select(Person.id, *(getattr(Person, c) for c in PERSON_SEARCH_COLUMNS)))
+    entries = [{'rowid': row[0], 'content': person_search_text(*row[1:])} for row in rows]
+    if entries:
+        db.session.execute(person_fts.insert(), entries)
+    return len(entries)
+
+@click.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Rebuilds the full-text person search index"""
+    count = rebuild_search_index()
+    db.session.commit()
+    click.echo(f'Reindexed {count} people')
+
+def refresh_membership_valid_until(client_id=None):
+    """Przelicza Client.membership_valid_until od zera - dla jednego klienta, listy klientów albo dla wszystkich.
+
+    Karnety z przyszłą datą startu są pomijane, dopóki się nie zaczną,
+    dlatego przeliczenie wszystkich klientów uruchamia codziennie zadanie 'refresh-memberships' (app.jobs).
+    """
+    stmt = _valid_until_update()
+    client_table = Client.__table__
+    if isinstance(client_id, (list, tuple, set, frozenset)):
+        stmt = stmt.where(client_table.c.id.in_(client_id))
+    elif client_id is not None:
+        stmt = stmt.where(client_table.c.id == client_id)
+    return db.session.execute(stmt).rowcount
+
+def _valid_until_update():
+    client_table = Client.__table__
+    latest_end = (
+        db.select(db.func.max(Membership.end_date))
+        .where(Membership.client_id == client_table.c.id, Membership.active == True, Membership.start_date <= date.today())
+        .scalar_subquery()
+    )
+    return db.update(client_table).values(membership_valid_until=latest_end)
+
+@event.listens_for(MembershipType, 'after_update')
+def _membership_type_updated(mapper, connection, target):
+    # zmiana długości przesuwa koniec każdego karnetu tego typu - wiersz membership_type jest już zapisany
+    if db.inspect(target).attrs.duration.history.has_changes():
+        holders = db.select(Membership.client_id).where(Membership.type_id == target.id)
+        connection.execute(_valid_until_update().where(Client.__table__.c.id.in_(holders)))
+
+def refresh_participant_counts():
+    class_table = GroupClass.__table__
+    count = (
+        db.select(db.func.count(Participation.id))
+        .where(Participation.group_class_id == class_table.c.id)
+        .scalar_subquery()
+    )
+    return db.session.execute(db.update(class_table).values(participant_count=count)).rowcount
+
+@click.command('refresh-participant-counts')
+def refresh_participant_counts_command():
+    """Recomputes the participant counter of every group class"""
+    count = refresh_participant_counts()
+    db.session.commit()
+    click.echo(f'Refreshed {count} classes')
+
+@click.command('refresh-memberships')
+def refresh_memberships_command():
+    """Recomputes the membership validity date of every client"""
+    count = refresh_membership_valid_until()
+    db.session.commit()
+    click.echo(f'Refreshed {count} clients')
+
+IMPORT_COLUMNS = ('username', 'email', 'password', 'first_name', 'last_name', 'pesel', 'phone_number')
+
+def _read_import_rows(path):
+    """Zwraca (wiersze, błędy) - plik JSON o złej strukturze jest zgłaszany jako błąd, a nie przerywa importu wyjątkiem."""
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        if path.lower().endswith('.json'):
+            try:
+                rows = json.load(f)
+            except json.JSONDecodeError as e:
+                return [], [(e.lineno, f'niepoprawny plik JSON: {e.msg}')]
+            if not isinstance(rows, list):
+                return [], [(1, 'plik JSON musi zawierać listę obiektów')]
+        else:
+            rows = list(csv.DictReader(f))
+    # numer wiersza liczony jak w pliku CSV (1 = nagłówek)
+    parsed, errors = [], []
+    for i, row in enumerate(rows):
+        if isinstance(row, dict):
+            parsed.append((i + 2, {k: str(v).strip() for k, v in row.items() if v is not None}))
+        else:
+            errors.append((i + 2, 'element listy nie jest obiektem'))
+    return parsed, errors
+
+def _validate_import_row(row, membership_types):
+    for name in IMPORT_COLUMNS:
+        if not row.get(name):
+            return f'brak pola {name}'
+    if not (4 <= len(row['username']) <= 25):
+        return 'login musi mieć od 4 do 25 znaków'
+    if '@' not in row['email']:
+        return 'niepoprawny email'
+    if len(row['pesel']) != 11 or not row['pesel'].isdigit():
+        return 'PESEL musi mieć 11 cyfr'
+    if not (9 <= len(row['phone_number']) <= 15):
+        return 'telefon musi mieć od 9 do 15 znaków'
+    if row.get('membership_type'):
+        if row['membership_type'] not in membership_types:
+            return f'nieznany typ karnetu {row["membership_type"]}'
+        try:
+            date.fromisoformat(row.get('membership_start') or date.today().isoformat())
+        except ValueError:
+            return 'niepoprawna data startu karnetu'
+    return None
+
+def _import_batch(batch, membership_types, errors):
+    """Waliduje i wstawia jedną paczkę wierszy w jednej transakcji. Zwraca liczbę dodanych klientów."""
+    valid = []
+    seen = {'username': set(), 'email': set(), 'pesel': set()}
+    for line, row in batch:
+        error = _validate_import_row(row, membership_types)
+        for name, values in seen.items():
+            if error is None and row[name] in values:
+                error = f'{name} {row[name]} powtarza się w pliku'
+        if error:
+            errors.append((line, error))
+            continue
+        for name, values in seen.items():
+            values.add(row[name])
+        valid.append((line, row))
+
+    taken = {
+        'username': set(db.session.scalars(db.select(User.username).where(User.username.in_(seen['username'])))),
+        'email': set(db.session.scalars(db.select(User.email).where(User.email.in_(seen['email'])))),
+        'pesel': set(db.session.scalars(db.select(Person.pesel).where(Person.pesel.in_(seen['pesel'])))),
+    }
+    accepted = []
+    for line, row in valid:
+        duplicate = next((name for name in taken if row[name] in taken[name]), None)
+        if duplicate:
+            errors.append((line, f'{duplicate} {row[duplicate]} już istnieje w bazie'))
+        else:
+            accepted.append((line, row))
+    if not accepted:
+        return 0
+    rows = [row for _, row in accepted]
+
+    hashes = password_hasher.hash_many([row['password'] for row in rows])
+    try:
+        user_ids = db.session.scalars(
+            db.insert(User).returning(User.id, sort_by_parameter_order=True),
+            [{'username': row['username'], 'email': row['email'], 'password_hash': password_hash, 'role': 'client'}
+             for row, password_hash in zip(rows, hashes)]
+        ).all()
+
+        today = date.today()
+        memberships = []
+        for row in rows:
+            membership = None
+            if row.get('membership_type'):
+                start_date = date.fromisoformat(row.get('membership_start') or today.isoformat())
+                membership = (start_date, membership_types[row['membership_type']])
+            memberships.append(membership)
+
+        client_ids = db.session.scalars(
+            db.insert(Client).returning(Client.id, sort_by_parameter_order=True),
+            [{
+                'first_name': row['first_name'], 'last_name': row['last_name'], 'pesel': row['pesel'],
+                'phone_number': row['phone_number'], 'user_id': user_id, 'active': True,
+                'membership_valid_until': (
+                    membership[0] + timedelta(days=membership[1].duration)
+                    if membership and membership[0] <= today else None
+                ),
+                'created_on': today,
+            } for row, user_id, membership in zip(rows, user_ids, memberships)]
+        ).all()
+
+        membership_rows = [
+            {'client_id': client_id, 'type_id': membership[1].id, 'price': membership[1].price, 'start_date': membership[0], 'active': True}
+            for client_id, membership in zip(client_ids, memberships) if membership
+        ]
+        if membership_rows:
+            db.session.execute(db.insert(Membership), membership_rows)
+
+        # statystyki właściciela - wstawianie wsadowe nie wywołuje zdarzeń mappera
+        from app.rollups import apply_deltas, membership_deltas
+        deltas = Counter({(today, 'signups', 0): len(client_ids)})
+        for start_date, mem_type in filter(None, memberships):
+            membership_deltas(start_date, mem_type.id, mem_type.price, mem_type.duration, True, deltas=deltas)
+        apply_deltas(db.session.connection(), deltas)
+        if membership_rows:
+            from app.schedule_cache import MEMBERSHIPS, bump_version
+            bump_version(MEMBERSHIPS)
+
+        # wstawianie wsadowe pomija zdarzenia mapperów - indeks wyszukiwania uzupełniamy sami
+        if db.engine.dialect.name == 'sqlite':
+            db.session.execute(person_fts.insert(), [
+                {'rowid': client_id, 'content': person_search_text(*(row[c] for c in PERSON_SEARCH_COLUMNS))}
+                for client_id, row in zip(client_ids, rows)
+            ])
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        errors.extend((line, f'błąd bazy danych: {e}') for line, _ in accepted)
+        return 0
+    return len(rows)
+
+def import_clients(path, batch_size=500):
+    """Import klientów (i opcjonalnie ich karnetów) z pliku CSV lub JSON. Zwraca (liczba_dodanych, błędy)."""
+    membership_types = {}
+    for mem_type in db.session.scalars(db.select(MembershipType).where(MembershipType.active == True)):
+        membership_types[str(mem_type.id)] = mem_type
+        membership_types[mem_type.name] = mem_type
+
+    rows, errors = _read_import_rows(path)
+    imported = 0
+    for start in range(0, len(rows), batch_size):
+        imported += _import_batch(rows[start:start + batch_size], membership_types, errors)
+    return imported, sorted(errors)
+
+@click.command('import-clients')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=500, show_default=True, help='Number of rows per transaction')
+def import_clients_command(path, batch_size):
+    """Imports clients (and optional memberships) from a CSV or JSON file"""
+    imported, errors = import_clients(path, batch_size)
+    for line, error in errors:
+        click.echo(click.style(f"Wiersz {line}: {error}", fg='red'))
+    click.echo(click.style(f"Zaimportowano {imported} klientów, odrzucono {len(errors)} wierszy.", fg='green' if not errors else 'yellow'))
+
 def init_app(app):
+    configure_read_bind(app)
     db.init_app(app)
     app.cli.add_command(init_db_command)
+    app.cli.add_command(rebuild_search_index_command)
+    app.cli.add_command(refresh_memberships_command)
+    app.cli.add_command(refresh_participant_counts_command)
     app.cli.add_command(add_owner_command)
+    app.cli.add_command(import_clients_command)
 
 def add_owner(username, email, password, first_name, last_name, pesel, phone):
     existing_user = db.session.execute(
@@ -0,0 +1,154 @@
+import functools
+import os
+import time
+import weakref
+from datetime import date, timedelta, time as dtime
+from concurrent.futures import ThreadPoolExecutor
+import click
+from flask import current_app, has_request_context, request
+from sqlalchemy import event, exc
+from app.db import db, Client, Trainer, GroupClass, Participation
+from app.services import enroll, unenroll
+from app.routing import READ_BIND
+from app.jobs import periodic
+
+# metody żądań, które tylko czytają - bez BEGIN IMMEDIATE
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+def _set_sqlite_pragmas(pragmas, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+@periodic('optimize-database', at=dtime(3, 30))
+def optimize_database():
+    """Nocna konserwacja SQLite: statystyki planisty (PRAGMA optimize) i scalenie segmentów indeksu FTS."""
+    if db.engine.dialect.name != 'sqlite':
+        return  # PostgreSQL - autovacuum / autoanalyze
+    db.session.execute(db.text('PRAGMA optimize'))
+    db.session.execute(db.text("INSERT INTO person_fts(person_fts) VALUES ('optimize')"))
+
+def _begin_transaction(connection):
+    # w trybie WAL transakcja, która najpierw czyta, a potem pisze (np. join_class: sprawdzenie karnetu, potem zapis),
+    # dostaje SQLITE_BUSY_SNAPSHOT, gdy ktoś zapisał w międzyczasie - a tego busy_timeout nie ponawia.
+    # Żądania zapisujące (POST, DELETE...) biorą więc blokadę zapisu od razu i czekają na nią busy_timeout.
+    # Pozostałe transakcje otwiera jak dotąd sterownik sqlite3 - dopiero przed pierwszym zapisem
+    if has_request_context() and request.method not in SAFE_METHODS:
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+def check_concurrency(writers=4, readers=4, iterations=50):
+    """Równoległe zapisy i wypisy (enroll / unenroll) oraz odczyty grafiku na tymczasowych zajęciach.
+
+    Każdy piszący, jak join_class, najpierw czyta (ważność karnetu), potem zapisuje; na koniec zostaje zapisany,
+    więc oczekiwane participant_count to min(writers, capacity). Zwraca (participant_count, liczba_zapisów,
+    oczekiwane, błędy, czas). Dane testowe są usuwane po sprawdzeniu.
+    """
+    app = current_app._get_current_object()
+    capacity = max(1, writers // 2)
+    trainer = Trainer(first_name='Test', last_name='Współbieżności', pesel='T0000000000', phone_number='0')
+    clients = [
+        Client(first_name='Test', last_name=f'Współbieżności {i}', pesel=f'K{i:010d}', phone_number='0',
+               membership_valid_until=date.today() + timedelta(days=1))
+        for i in range(writers)
+    ]
+    group_class = GroupClass(name='Test współbieżności', day=0, start_hour=dtime(0), length=1, capacity=capacity, trainer=trainer)
+    db.session.add_all([trainer, group_class, *clients])
+    db.session.flush()
+    trainer_id, class_id, client_ids = trainer.id, group_class.id, [client.id for client in clients]
+    db.session.commit()
+    errors = []
+
+    def write(client_id):
+        for i in range(iterations + 1):
+            # osobny kontekst żądania - własna sesja i zachowanie transakcji jak w widoku POST
+            with app.test_request_context(method='POST'):
+                try:
+                    if db.session.get(Client, client_id).has_valid_membership:
+                        success, _ = enroll(client_id, class_id)
+                        db.session.commit()
+                        if i < iterations and success:
+                            unenroll(client_id, class_id)
+                            db.session.commit()
+                except exc.OperationalError as e:
+                    db.session.rollback()
+                    errors.append(f"zapis {client_id}: {e.orig}")
+
+    def read(worker):
+        for _ in range(iterations):
+            with app.test_request_context(method='GET'):
+                try:
+                    db.session.execute(db.select(GroupClass.participant_count).where(GroupClass.id == class_id)).scalar()
+                    db.session.execute(
+                        db.select(db.func.count()).select_from(Participation).where(Participation.group_class_id == class_id)
+                    ).scalar()
+                except exc.OperationalError as e:
+                    errors.append(f"odczyt {worker}: {e.orig}")
+
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=writers + readers) as pool:
+            futures = [pool.submit(write, c) for c in client_ids] + [pool.submit(read, r) for r in range(readers)]
+            for future in futures:
+                future.result()
+        elapsed = time.perf_counter() - started
+        participant_count = db.session.execute(db.select(GroupClass.participant_count).where(GroupClass.id == class_id)).scalar()
+        enrolled = db.session.execute(
+            db.select(db.func.count()).select_from(Participation).where(Participation.group_class_id == class_id)
+        ).scalar()
+    finally:
+        db.session.rollback()
+        for client_id in client_ids:
+            unenroll(client_id, class_id)
+        db.session.delete(db.session.get(GroupClass, class_id))
+        for client_id in client_ids:
+            db.session.delete(db.session.get(Client, client_id))
+        db.session.delete(db.session.get(Trainer, trainer_id))
+        db.session.commit()
+    return participant_count, enrolled, min(writers, capacity), errors, elapsed
+
+@click.command('check-concurrency')
+@click.option('--writers', default=4, show_default=True, help='Number of concurrent clients enrolling and leaving')
+@click.option('--readers', default=4, show_default=True, help='Number of concurrent reader threads')
+@click.option('--iterations', default=50, show_default=True, help='Enrol/leave cycles per writer (reads per reader)')
+def check_concurrency_command(writers, readers, iterations):
+    """Runs concurrent enrolments and reads against a temporary class in the configured database"""
+    participant_count, enrolled, expected, errors, elapsed = check_concurrency(writers, readers, iterations)
+    for error in errors[:10]:
+        click.echo(click.style(error, fg='red'))
+    click.echo(
+        f"Silnik: {db.engine.dialect.name}, participant_count {participant_count}, zapisanych {enrolled}, "
+        f"oczekiwane {expected}, błędów: {len(errors)}, czas: {elapsed:.2f} s"
+    )
+    if errors or participant_count != expected or enrolled != expected:
+        raise SystemExit(1)
+
+# silniki wszystkich aplikacji procesu - jeden hak fork dla nich wszystkich, a nie nowy przy każdym create_app()
+_engines = weakref.WeakSet()
+
+def _reset_pools_after_fork():
+    # połączenia z puli rodzica (gunicorn --preload) nie mogą trafić do procesu potomnego - close=False,
+    # bo zamknięcie gniazda / pliku SQLite tutaj zepsułoby je także rodzicowi
+    for engine in list(_engines):
+        engine.dispose(close=False)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_pools_after_fork)
+
+def init_app(app):
+    pragmas = app.config.get('SQLITE_PRAGMAS')
+    with app.app_context():
+        engines = dict(db.engines)
+    if pragmas:
+        for key, engine in engines.items():
+            if engine.dialect.name == 'sqlite':
+                # tryb dziennika ustawia baza główna - połączenie mode=ro nie może go zmienić
+                engine_pragmas = {k: v for k, v in pragmas.items() if k != 'journal_mode'} if key == READ_BIND else pragmas
+                event.listen(engine, 'connect', functools.partial(_set_sqlite_pragmas, engine_pragmas))
+    if app.config['SQLITE_BEGIN_IMMEDIATE']:
+        for key, engine in engines.items():
+            # pula odczytu (mode=ro) nie może brać blokady zapisu
+            if engine.dialect.name == 'sqlite' and key != READ_BIND:
+                event.listen(engine, 'begin', _begin_transaction)
+    _engines.update(engines.values())
+    app.cli.add_command(check_concurrency_command)
@@ -0,0 +1,106 @@
+import csv
+import io
+import click
+from datetime import date
+from app.db import db, User, Client, Membership, MembershipType, Participation, GroupClass
+
+# liczba wierszy pobieranych naraz z kursora po stronie serwera
+EXPORT_CHUNK_SIZE = 1000
+
+def _clients_query(active_only=False, date_from=None, date_to=None):
+    stmt = (
+        db.select(
+            Client.id.label('id'), Client.first_name.label('first_name'), Client.last_name.label('last_name'),
+            Client.pesel.label('pesel'), Client.phone_number.label('phone_number'), User.email.label('email'),
+            Client.active.label('active'), Client.membership_valid_until.label('membership_valid_until'),
+            Client.created_on.label('created_on')
+        )
+        .outerjoin(User, User.id == Client.user_id)
+        .order_by(Client.id)
+    )
+    if active_only:
+        stmt = stmt.where(Client.active == True)
+    if date_from:
+        stmt = stmt.where(Client.created_on >= date_from)
+    if date_to:
+        stmt = stmt.where(Client.created_on <= date_to)
+    return stmt
+
+def _memberships_query(active_only=False, date_from=None, date_to=None):
+    stmt = (
+        db.select(
+            Membership.id.label('id'), Membership.client_id.label('client_id'),
+            Client.first_name.label('first_name'), Client.last_name.label('last_name'),
+            MembershipType.name.label('type'), Membership.price.label('price'),
+            Membership.start_date.label('start_date'), Membership.end_date.label('end_date'),
+            Membership.active.label('active')
+        )
+        .join(Client, Client.id == Membership.client_id)
+        .join(MembershipType, MembershipType.id == Membership.type_id)
+        .order_by(Membership.id)
+    )
+    if active_only:
+        stmt = stmt.where(Membership.is_active)
+    if date_from:
+        stmt = stmt.where(Membership.start_date >= date_from)
+    if date_to:
+        stmt = stmt.where(Membership.start_date <= date_to)
+    return stmt
+
+def _participations_query(active_only=False, date_from=None, date_to=None):
+    stmt = (
+        db.select(
+            Participation.id.label('id'), Participation.client_id.label('client_id'),
+            Client.first_name.label('first_name'), Client.last_name.label('last_name'),
+            Participation.group_class_id.label('group_class_id'), GroupClass.name.label('class_name'),
+            GroupClass.day.label('day'), GroupClass.start_hour.label('start_hour'),
+            Participation.created_on.label('created_on')
+        )
+        .join(Client, Client.id == Participation.client_id)
+        .join(GroupClass, GroupClass.id == Participation.group_class_id)
+        .order_by(Participation.id)
+    )
+    if active_only:
+        stmt = stmt.where(Client.active == True)
+    if date_from:
+        stmt = stmt.where(Participation.created_on >= date_from)
+    if date_to:
+        stmt = stmt.where(Participation.created_on <= date_to)
+    return stmt
+
+# zakres dat: klienci - data rejestracji, karnety - data rozpoczęcia, zapisy - data zapisu
+EXPORTS = {
+    'clients': _clients_query,
+    'memberships': _memberships_query,
+    'participations': _participations_query,
+}
+
+def export_rows(name, active_only=False, date_from=None, date_to=None):
+    """Generator linii CSV - wiersze czytane partiami z kursora, pamięć nie rośnie z rozmiarem tabeli."""
+    stmt = EXPORTS[name](active_only=active_only, date_from=date_from, date_to=date_to)
+    result = db.session.execute(stmt.execution_options(yield_per=EXPORT_CHUNK_SIZE))
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(result.keys())
+    for partition in result.partitions():
+        writer.writerows(partition)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+@click.command('export')
+@click.argument('name', type=click.Choice(list(EXPORTS)))
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8'), default='-', help='Output file (default: stdout)')
+@click.option('--active-only', is_flag=True, help='Only active clients / memberships')
+@click.option('--from', 'date_from', type=click.DateTime(['%Y-%m-%d']), help='Clients registered / memberships starting / enrolments made on or after this date')
+@click.option('--to', 'date_to', type=click.DateTime(['%Y-%m-%d']), help='Clients registered / memberships starting / enrolments made on or before this date')
+def export_command(name, output, active_only, date_from, date_to):
+    """Exports clients, memberships or participations as CSV"""
+    for chunk in export_rows(name, active_only, date_from and date_from.date(), date_to and date_to.date()):
+        output.write(chunk)
+
+def init_app(app):
+    app.cli.add_command(export_command)
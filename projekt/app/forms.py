@@ -1,7 +1,8 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, EmailField, BooleanField, IntegerField, FloatField, DateField, SelectField, TimeField
+from wtforms import StringField, PasswordField, EmailField, BooleanField, IntegerField, FloatField, DateField, SelectField, TimeField, TextAreaField
 from wtforms.validators import DataRequired, Length, Regexp, Email, EqualTo, ValidationError, NumberRange, InputRequired
 from app.db import db, User
+from app.services import parse_client_ids, BULK_MAX_CLIENTS, CLIENT_ID_MAX
 from datetime import date
 
 class PersonDataForm(FlaskForm):
@@ -53,6 +54,24 @@ class AssignMembershipForm(FlaskForm):
     
     start_date = DateField('Data rozpoczęcia', default=date.today, validators=[DataRequired()])
 
+class BulkClientsForm(FlaskForm):
+    client_ids = TextAreaField('Numery klientów', validators=[DataRequired()])
+
+    def validate_client_ids(self, client_ids):
+        ids = parse_client_ids(client_ids.data)
+        if not ids:
+            raise ValidationError('Podaj co najmniej jeden numer klienta.')
+        if len(ids) > BULK_MAX_CLIENTS:
+            raise ValidationError(f'Jednorazowo można wybrać najwyżej {BULK_MAX_CLIENTS} klientów.')
+        if max(ids) > CLIENT_ID_MAX:
+            raise ValidationError(f'Numer klienta {max(ids)} jest poza zakresem.')
+
+class BulkMembershipForm(BulkClientsForm, AssignMembershipForm):
+    pass
+
+class BulkEnrollForm(BulkClientsForm):
+    group_class_id = SelectField('Zajęcia', coerce=int, validators=[InputRequired()])
+
 class GroupClassForm(FlaskForm):
     name = StringField('Nazwa zajęć', validators=[
         DataRequired(), 
@@ -76,4 +95,9 @@ class GroupClassForm(FlaskForm):
         NumberRange(min=15, max=240, message="Zajęcia muszą trwać od 15 do 240 minut")
     ])
     
+    capacity = IntegerField('Liczba miejsc', default=20, validators=[
+        DataRequired(),
+        NumberRange(min=1, max=500, message="Liczba miejsc musi wynosić od 1 do 500")
+    ])
+
     trainer_id = SelectField('Prowadzący Trener', coerce=int, validators=[DataRequired()])
@@ -0,0 +1,160 @@
+import time
+from collections import namedtuple
+from flask import current_app
+from flask_login import UserMixin
+from itsdangerous import BadSignature, URLSafeSerializer, URLSafeTimedSerializer
+from sqlalchemy import event
+from app.db import db, User, Person
+from app.cache import LRUCache
+from app.schedule_cache import IDENTITIES, bump_version, data_versions
+
+class Identity(UserMixin):
+    """Lekka tożsamość zalogowanego użytkownika - zamiast pełnego obiektu User w current_user."""
+
+    def __init__(self, id, role, profile_id, active, first_name):
+        self.id = id
+        self.role = role
+        self.profile_id = profile_id
+        self.active = active
+        self.first_name = first_name
+
+    @property
+    def is_active(self):
+        return self.active
+
+    @property
+    def person_profile(self):
+        if self.profile_id is None:
+            return None
+        return db.session.get(Person, self.profile_id)
+
+class IdentityCache:
+    """Pamięć podręczna LRU z TTL dla user_loadera - unieważniana zdarzeniami modeli User i Person.
+
+    Zdarzenia działają tylko w procesie, który zapisał zmianę. Pozostałe procesy co `sync_interval` s
+    czytają wspólny licznik IDENTITIES (cache_version) i po jego zmianie czyszczą całą pamięć.
+    """
+
+    def __init__(self, app=None):
+        self._entries = LRUCache(max_size=1024, ttl=60)
+        self.sync_interval = 2
+        self._version = None
+        self._synced_at = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._entries = LRUCache(max_size=app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL'])
+        self.sync_interval = app.config['USER_CACHE_SYNC_INTERVAL']
+        self._version = None
+        self._synced_at = None
+        app.extensions['identity_cache'] = self
+
+    def _sync(self):
+        now = time.monotonic()
+        if self._synced_at is not None and now - self._synced_at < self.sync_interval:
+            return
+        version = data_versions(IDENTITIES)[IDENTITIES].version
+        if version != self._version:
+            self._entries.clear()
+            self._version = version
+        self._synced_at = now
+
+    def get(self, user_id):
+        self._sync()
+        identity = self._entries.get(user_id)
+        if identity is None:
+            identity = self._load(user_id)
+            if identity is not None:
+                self._entries.set(user_id, identity)
+        return identity
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id)
+
+    def clear(self):
+        self._entries.clear()
+
+    def _load(self, user_id):
+        row = db.session.execute(
+            db.select(User.id, User.role, Person.id, Person.active, Person.first_name)
+            .outerjoin(Person, Person.user_id == User.id)
+            .where(User.id == user_id)
+        ).first()
+        if row is None:
+            return None
+        return Identity(row[0], row[1], row[2], row[3] if row[3] is not None else True, row[4])
+
+identity_cache = IdentityCache()
+
+# zmiany roli, aktywności i powiązania profilu podbijają też wspólny licznik - dla pozostałych procesów
+@event.listens_for(User, 'after_update')
+def _invalidate_user(mapper, connection, target):
+    identity_cache.invalidate(target.id)
+    if db.inspect(target).attrs.role.history.has_changes():
+        bump_version(IDENTITIES, connection)
+
+@event.listens_for(User, 'after_delete')
+def _invalidate_deleted_user(mapper, connection, target):
+    identity_cache.invalidate(target.id)
+    bump_version(IDENTITIES, connection)
+
+def _profile_users(target):
+    # także poprzedni właściciel profilu, jeśli zmienił się user_id
+    return [user_id for user_id in [target.user_id, *db.inspect(target).attrs.user_id.history.deleted] if user_id is not None]
+
+@event.listens_for(Person, 'after_update', propagate=True)
+def _invalidate_person(mapper, connection, target):
+    user_ids = _profile_users(target)
+    for user_id in user_ids:
+        identity_cache.invalidate(user_id)
+    state = db.inspect(target)
+    if user_ids and any(state.attrs[c].history.has_changes() for c in ('active', 'user_id')):
+        bump_version(IDENTITIES, connection)
+
+@event.listens_for(Person, 'after_delete', propagate=True)
+def _invalidate_deleted_person(mapper, connection, target):
+    user_ids = _profile_users(target)
+    for user_id in user_ids:
+        identity_cache.invalidate(user_id)
+    if user_ids:
+        bump_version(IDENTITIES, connection)
+
+# Tokeny API - podpisane (SECRET_KEY) i z datą wystawienia. Rola i aktywność konta są przy każdym żądaniu
+# porównywane z identity_cache, więc zmiana roli lub dezaktywacja unieważnia token bez czekania na API_TOKEN_MAX_AGE.
+TokenIdentity = namedtuple('TokenIdentity', 'id role profile_id')
+
+def _token_serializer():
+    return URLSafeTimedSerializer(current_app.secret_key, salt='api-token')
+
+def issue_token(user_id, role, profile_id):
+    return _token_serializer().dumps([user_id, role, profile_id])
+
+def verify_token(token):
+    """TokenIdentity albo None (zły podpis, wygasły lub uszkodzony token, nieaktywne konto albo zmieniona rola)."""
+    try:
+        data = _token_serializer().loads(token, max_age=current_app.config['API_TOKEN_MAX_AGE'])
+        token_identity = TokenIdentity(*data)
+    except (BadSignature, TypeError):
+        return None
+    identity = identity_cache.get(token_identity.id)
+    if (identity is None or not identity.is_active or identity.role != token_identity.role
+            or identity.profile_id != token_identity.profile_id):
+        return None
+    return token_identity
+
+# Tokeny kanałów iCalendar - bez daty ważności, bo adres kanału wkleja się raz do kalendarza w telefonie.
+# Zawierają Person.feed_secret, więc wyciekły adres unieważnia się, losując nowy sekret.
+def _feed_serializer():
+    return URLSafeSerializer(current_app.secret_key, salt='calendar-feed')
+
+def issue_feed_token(kind, person_id, secret):
+    return _feed_serializer().dumps([kind, person_id, secret])
+
+def verify_feed_token(token):
+    """(rodzaj, id osoby, sekret) albo None - sekret porównuje z bazą dopiero budowanie kanału."""
+    try:
+        kind, person_id, secret = _feed_serializer().loads(token)
+        return kind, person_id, secret
+    except (BadSignature, TypeError, ValueError):
+        return None
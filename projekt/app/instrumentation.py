@@ -0,0 +1,112 @@
+import logging
+import re
+import time
+from collections import Counter
+from flask import g, has_app_context, has_request_context, request
+from sqlalchemy import event
+from app.db import db
+
+slow_query_logger = logging.getLogger('app.sql.slow')
+
+_IN_LIST = re.compile(r'\((?:\s*\?\s*,)+\s*\?\s*\)|\((?:\s*%\(\w+\)s\s*,)+\s*%\(\w+\)s\s*\)')
+_WHITESPACE = re.compile(r'\s+')
+# sterowanie transakcją (BEGIN IMMEDIATE z app.engine) - wlicza się do czasu bazy, ale nie do liczby zapytań
+_TRANSACTION_CONTROL = re.compile(r'\s*(BEGIN|COMMIT|ROLLBACK)\b', re.IGNORECASE)
+
+def statement_shape(statement):
+    """Kształt zapytania - bez białych znaków i z listami IN (?, ?, ...) zwiniętymi do jednego parametru."""
+    return _IN_LIST.sub('(?)', _WHITESPACE.sub(' ', statement).strip())
+
+def is_transaction_control(statement):
+    return _TRANSACTION_CONTROL.match(statement) is not None
+
+class RequestStats:
+    """Statystyki SQL jednego żądania (lub kontekstu aplikacji, np. polecenia CLI)."""
+
+    SLOWEST_KEPT = 5
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.slowest = []  # (czas_s, zapytanie), malejąco, najwyżej SLOWEST_KEPT
+        self.shapes = Counter()
+
+    def record(self, statement, elapsed):
+        self.total += elapsed
+        if not is_transaction_control(statement):
+            self.count += 1
+            self.shapes[statement_shape(statement)] += 1
+        if len(self.slowest) < self.SLOWEST_KEPT or elapsed > self.slowest[-1][0]:
+            self.slowest.append((elapsed, statement))
+            self.slowest.sort(key=lambda entry: entry[0], reverse=True)
+            del self.slowest[self.SLOWEST_KEPT:]
+
+    def repeated(self, threshold):
+        """Kształty wykonane co najmniej `threshold` razy - najpewniej pętla N+1 (leniwe ładowanie w szablonie)."""
+        return [(shape, count) for shape, count in self.shapes.most_common() if count >= threshold]
+
+class SQLInstrumentation:
+    """Liczba zapytań, czas bazy i podejrzenia N+1 na żądanie, oraz dziennik wolnych zapytań."""
+
+    def __init__(self, app=None):
+        self.slow_threshold = 0.1
+        self.n_plus_one_threshold = 10
+        self.headers = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.slow_threshold = app.config['SQL_SLOW_QUERY_MS'] / 1000
+        self.n_plus_one_threshold = app.config['SQL_N_PLUS_ONE_THRESHOLD']
+        self.headers = app.config['SQL_STATS_HEADERS']
+        if app.config['SQL_SLOW_QUERY_LOG'] and not slow_query_logger.handlers:
+            handler = logging.FileHandler(app.config['SQL_SLOW_QUERY_LOG'], encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            slow_query_logger.addHandler(handler)
+            slow_query_logger.setLevel(logging.WARNING)
+
+        with app.app_context():
+            for engine in db.engines.values():
+                if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+                    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+                    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+        app.after_request(self._after_request)
+        app.extensions['sql_instrumentation'] = self
+
+    def _after_request(self, response):
+        stats = current_stats()
+        if stats is None:
+            return response
+
+        for shape, count in stats.repeated(self.n_plus_one_threshold):
+            slow_query_logger.warning('N+1? %s %s: %d x %s', request.method, request.path, count, shape)
+        if self.headers:
+            response.headers['X-SQL-Queries'] = str(stats.count)
+            response.headers['X-SQL-Time'] = f'{stats.total * 1000:.1f}ms'
+            response.headers.add('Server-Timing', f'db;dur={stats.total * 1000:.1f};desc="{stats.count} queries"')
+        return response
+
+    def statement_finished(self, statement, elapsed):
+        stats = current_stats(create=True)
+        if stats is not None:
+            stats.record(statement, elapsed)
+        if elapsed >= self.slow_threshold:
+            where = f'{request.method} {request.path}' if has_request_context() else '-'
+            slow_query_logger.warning('%.1f ms %s: %s', elapsed * 1000, where, _WHITESPACE.sub(' ', statement))
+
+sql_instrumentation = SQLInstrumentation()
+
+def current_stats(create=False):
+    """Statystyki bieżącego kontekstu aplikacji (None poza kontekstem)."""
+    if not has_app_context():
+        return None
+    if create and 'sql_stats' not in g:
+        g.sql_stats = RequestStats()
+    return g.get('sql_stats')
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_start'] = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info.pop('query_start')
+    sql_instrumentation.statement_finished(statement, elapsed)
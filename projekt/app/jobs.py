@@ -0,0 +1,339 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time as dtime, timedelta, timezone
+from typing import Optional
+import click
+from flask import current_app
+from sqlalchemy import String, Integer, Text, DateTime, Index, event
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy.dialects import postgresql, sqlite
+from app.db import db, refresh_membership_valid_until
+
+logger = logging.getLogger('app.jobs')
+
+class Job(db.Model):
+    """Trwała kolejka zadań w tle (queued -> running -> done / failed)."""
+    __tablename__ = "job"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    name: Mapped[str] = mapped_column(String(100), nullable=False)
+    payload: Mapped[str] = mapped_column(Text, nullable=False, default='{}')  # argumenty nazwane jako JSON
+    status: Mapped[str] = mapped_column(String(10), nullable=False, default='queued')
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    max_attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=5)
+    run_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)  # czasy w UTC
+    locked_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    finished_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    # co najwyżej jedno oczekujące zadanie o danym kluczu (zadania okresowe) - zwalniany po zakończeniu
+    unique_key: Mapped[Optional[str]] = mapped_column(String(100), nullable=True, unique=True)
+
+    __table_args__ = (
+        Index('ix_job_status_run_at', 'status', 'run_at'),
+    )
+
+JobType = namedtuple('JobType', 'name function max_attempts')
+Periodic = namedtuple('Periodic', 'name every at')
+
+JOBS = {}
+PERIODIC = []
+
+def job(name, max_attempts=5):
+    """Rejestruje funkcję jako zadanie `name` - wywoływana w kontekście aplikacji z argumentami z enqueue."""
+    def register(function):
+        JOBS[name] = JobType(name, function, max_attempts)
+        return function
+    return register
+
+def periodic(name, every=None, at=None, max_attempts=3):
+    """Zadanie okresowe: co `every` (timedelta) albo codziennie o `at` (datetime.time, czas lokalny)."""
+    if (every is None) == (at is None):
+        raise ValueError('Podaj dokładnie jedno z: every, at')
+    def register(function):
+        job(name, max_attempts)(function)
+        PERIODIC.append(Periodic(name, every, at))
+        return function
+    return register
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def _insert(table):
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+def enqueue(name, payload=None, delay=0, unique_key=None):
+    """Dodaje zadanie w bieżącej transakcji - trafi do kolejki razem z commitem zmian, które je wywołały.
+    Zwraca False, jeśli zadanie z tym samym unique_key już czeka."""
+    if name not in JOBS:
+        raise KeyError(f'Nieznane zadanie {name}')
+    stmt = _insert(Job.__table__).values(
+        name=name, payload=json.dumps(payload or {}), status='queued', attempts=0,
+        max_attempts=JOBS[name].max_attempts, run_at=_now() + timedelta(seconds=delay), unique_key=unique_key
+    )
+    if unique_key is not None:
+        stmt = stmt.on_conflict_do_nothing(index_elements=['unique_key'])
+    inserted = db.session.execute(stmt).rowcount
+    db.session.info['jobs_enqueued'] = True
+    return bool(inserted)
+
+@event.listens_for(db.session, 'after_commit')
+def _jobs_committed(session):
+    # nowe zadania są widoczne dla wykonawcy dopiero po commicie - wtedy go budzimy
+    if session.info.pop('jobs_enqueued', False):
+        job_worker.notify()
+
+ClaimedJob = namedtuple('ClaimedJob', 'id name payload attempts max_attempts')
+
+def claim_next():
+    """Rezerwuje najstarsze wymagalne zadanie (status running) i zwraca ClaimedJob albo None."""
+    now = _now()
+    due = db.select(Job.id).where(Job.status == 'queued', Job.run_at <= now).order_by(Job.run_at, Job.id).limit(1)
+    # tani odczyt najpierw - pusta kolejka nie bierze blokady zapisu SQLite
+    if db.session.execute(due).first() is None:
+        db.session.rollback()
+        return None
+    row = db.session.execute(
+        db.update(Job)
+        .where(Job.id == due.with_for_update(skip_locked=True).scalar_subquery(), Job.status == 'queued')
+        .values(status='running', locked_at=now, attempts=Job.attempts + 1)
+        .returning(Job.id, Job.name, Job.payload, Job.attempts, Job.max_attempts)
+        .execution_options(synchronize_session=False)
+    ).first()
+    db.session.commit()
+    return ClaimedJob(*row) if row is not None else None
+
+def retry_delay(attempts, base):
+    """Wykładnicze opóźnienie ponowienia: base, 2*base, 4*base, ... najwyżej godzina."""
+    return min(base * 2 ** (attempts - 1), 3600)
+
+def _finish(claimed, error=None, retry_base=30):
+    values = {'locked_at': None, 'last_error': error}
+    if error is None:
+        values.update(status='done', finished_at=_now(), unique_key=None)
+    elif claimed.attempts < claimed.max_attempts:
+        values.update(status='queued', run_at=_now() + timedelta(seconds=retry_delay(claimed.attempts, retry_base)))
+    else:
+        values.update(status='failed', finished_at=_now(), unique_key=None)
+    db.session.execute(
+        db.update(Job).where(Job.id == claimed.id).values(**values).execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+def run_job(claimed, retry_base=30):
+    """Wykonuje zarezerwowane zadanie i zapisuje wynik. Zwraca True przy powodzeniu."""
+    job_type = JOBS.get(claimed.name)
+    try:
+        if job_type is None:
+            raise LookupError(f'Nieznane zadanie {claimed.name}')
+        job_type.function(**json.loads(claimed.payload))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.exception('Zadanie %s #%d (próba %d/%d) nie powiodło się', claimed.name, claimed.id, claimed.attempts, claimed.max_attempts)
+        _finish(claimed, f'{type(e).__name__}: {e}', retry_base)
+        return False
+    _finish(claimed)
+    return True
+
+def _next_run(periodic_job, now_local):
+    if periodic_job.every is not None:
+        return now_local + periodic_job.every
+    run = datetime.combine(now_local.date(), periodic_job.at)
+    return run if run > now_local else run + timedelta(days=1)
+
+def schedule_periodic():
+    """Dodaje brakujące wystąpienia zadań okresowych (unique_key pilnuje, by każde czekało najwyżej raz)."""
+    now_local = datetime.now()
+    for periodic_job in PERIODIC:
+        delay = (_next_run(periodic_job, now_local) - now_local).total_seconds()
+        enqueue(periodic_job.name, delay=delay, unique_key=f'periodic:{periodic_job.name}')
+    db.session.commit()
+
+def requeue_stale(timeout):
+    """Zadania 'running' dłużej niż `timeout` s (wykonawca przerwany) wracają do kolejki albo są oznaczane jako nieudane."""
+    stale = db.and_(Job.status == 'running', Job.locked_at < _now() - timedelta(seconds=timeout))
+    db.session.execute(
+        db.update(Job).where(stale, Job.attempts >= Job.max_attempts)
+        .values(status='failed', finished_at=_now(), unique_key=None, last_error='przekroczono czas wykonania')
+        .execution_options(synchronize_session=False)
+    )
+    requeued = db.session.execute(
+        db.update(Job).where(stale).values(status='queued', locked_at=None, run_at=_now())
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    return requeued
+
+class JobWorker:
+    """Wykonawca zadań: wątek rozdzielający odpytuje kolejkę, zadania wykonuje pula wątków.
+
+    Działa w procesie aplikacji (start przy pierwszym żądaniu, JOB_WORKER_IN_PROCESS) albo jako `flask worker`.
+    Wiele wykonawców może dzielić jedną bazę - rezerwacja zadania jest pojedynczym UPDATE.
+    """
+
+    MAINTENANCE_INTERVAL = 60
+
+    def __init__(self, app=None):
+        self.app = None
+        self.threads = 2
+        self.poll_interval = 1.0
+        self.timeout = 600
+        self.retry_base = 30
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.threads = app.config['JOB_WORKER_THREADS']
+        self.poll_interval = app.config['JOB_POLL_INTERVAL']
+        self.timeout = app.config['JOB_TIMEOUT']
+        self.retry_base = app.config['JOB_RETRY_DELAY']
+        if app.config['JOB_WORKER_IN_PROCESS'] and self.threads > 0:
+            app.before_request(self._ensure_started)
+        app.cli.add_command(worker_command)
+        app.cli.add_command(jobs_command)
+        app.extensions['job_worker'] = self
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _ensure_started(self):
+        if self._thread is None:
+            self.start()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopped.clear()
+            self._slots = threading.BoundedSemaphore(self.threads)
+            self._executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix='job')
+            self._thread = threading.Thread(target=self._dispatch, name='job-dispatcher', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Kończy odpytywanie i czeka na wykonywane zadania."""
+        with self._lock:
+            if self._thread is None:
+                return
+            self._stopped.set()
+            self._wake.set()
+            self._thread.join()
+            self._executor.shutdown(wait=True)
+            self._thread = None
+
+    def notify(self):
+        self._wake.set()
+
+    def _after_fork(self):
+        # wątki nie przechodzą przez fork - proces potomny uruchamia własnego wykonawcę przy pierwszym żądaniu
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _dispatch(self):
+        maintenance_at = 0.0
+        while not self._stopped.is_set():
+            self._wake.clear()
+            try:
+                with self.app.app_context():
+                    if time.monotonic() >= maintenance_at:
+                        requeue_stale(self.timeout)
+                        schedule_periodic()
+                        maintenance_at = time.monotonic() + self.MAINTENANCE_INTERVAL
+                    while not self._stopped.is_set() and self._slots.acquire(blocking=False):
+                        claimed = claim_next()
+                        if claimed is None:
+                            self._slots.release()
+                            break
+                        self._executor.submit(self._execute, claimed)
+            except Exception:
+                logger.exception('Błąd wątku rozdzielającego zadania')
+            self._wake.wait(self.poll_interval)
+
+    def _execute(self, claimed):
+        try:
+            with self.app.app_context():
+                run_job(claimed, self.retry_base)
+        finally:
+            self._slots.release()
+            self._wake.set()  # zwolnione miejsce - sprawdź kolejkę od razu
+
+job_worker = JobWorker()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=job_worker._after_fork)
+
+@periodic('purge-jobs', every=timedelta(hours=6))
+def purge_jobs():
+    """Usuwa zakończone zadania starsze niż JOB_KEEP_DAYS (nieudane zostają do wglądu)."""
+    cutoff = _now() - timedelta(days=current_app.config['JOB_KEEP_DAYS'])
+    db.session.execute(db.delete(Job).where(Job.status == 'done', Job.finished_at < cutoff))
+
+@periodic('refresh-memberships', at=dtime(0, 5))
+def refresh_memberships():
+    """Codzienne przeliczenie ważności karnetów - obejmuje karnety, których data startu właśnie nadeszła."""
+    refresh_membership_valid_until()
+    db.session.commit()
+
+@click.command('worker')
+@click.option('--threads', type=int, default=None, help='Worker threads (default: JOB_WORKER_THREADS)')
+def worker_command(threads):
+    """Runs background jobs until interrupted"""
+    if threads is not None:
+        job_worker.threads = threads
+    job_worker.threads = max(job_worker.threads, 1)
+    job_worker.start()
+    click.echo(f'Worker started with {job_worker.threads} threads, {len(JOBS)} job types, {len(PERIODIC)} periodic')
+    try:
+        while job_worker.running:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        click.echo('Stopping, waiting for running jobs...')
+    finally:
+        job_worker.stop()
+
+@click.command('jobs')
+@click.option('--retry-failed', is_flag=True, help='Queue failed jobs again')
+@click.option('--enqueue', 'name', default=None, help='Queue the named job to run now')
+def jobs_command(retry_failed, name):
+    """Shows the job queue, optionally re-queueing failed jobs or queueing a job"""
+    if name is not None:
+        if name not in JOBS:
+            raise click.BadParameter(f"unknown job, known: {', '.join(sorted(JOBS))}", param_hint='--enqueue')
+        enqueue(name)
+        db.session.commit()
+        click.echo(f'Queued {name}')
+    if retry_failed:
+        count = db.session.execute(
+            db.update(Job).where(Job.status == 'failed')
+            .values(status='queued', attempts=0, run_at=_now(), finished_at=None)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        db.session.commit()
+        click.echo(f'Re-queued {count} failed jobs')
+
+    for status, count in db.session.execute(db.select(Job.status, db.func.count()).group_by(Job.status).order_by(Job.status)):
+        click.echo(f'{status:<8} {count}')
+    upcoming = db.session.execute(
+        db.select(Job.name, Job.run_at).where(Job.status == 'queued').order_by(Job.run_at).limit(10)
+    )
+    for job_name, run_at in upcoming:
+        click.echo(f'  next {run_at:%Y-%m-%d %H:%M:%S} UTC {job_name}')
+    failures = db.session.execute(
+        db.select(Job.id, Job.name, Job.attempts, Job.last_error).where(Job.status == 'failed').order_by(Job.id.desc()).limit(10)
+    )
+    for job_id, job_name, attempts, error in failures:
+        click.echo(click.style(f'  failed #{job_id} {job_name} after {attempts} attempts: {error}', fg='red'))
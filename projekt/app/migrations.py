@@ -0,0 +1,196 @@
+from datetime import datetime
+import click
+from sqlalchemy import String, Integer, DateTime, inspect
+from sqlalchemy.orm import Mapped, mapped_column
+from app.db import (
+    db, Person, Client, Membership, MembershipType, GroupClass, Participation, CacheVersion,
+    rebuild_search_index, refresh_membership_valid_until, refresh_participant_counts, new_feed_secret
+)
+from app.rollups import DailyRollup, MonthlyRollup, rebuild_rollups
+from app.jobs import Job
+from app.sessions import ClassSession, materialize_sessions
+
+class SchemaMigration(db.Model):
+    """Zastosowane migracje schematu - najwyższa wersja to bieżąca wersja bazy."""
+    __tablename__ = "schema_migration"
+
+    version: Mapped[int] = mapped_column(Integer, primary_key=True)
+    description: Mapped[str] = mapped_column(String(200), nullable=False)
+    applied_at: Mapped[datetime] = mapped_column(DateTime, nullable=False, default=datetime.now)
+
+# (wersja, opis, funkcja) w kolejności stosowania; funkcje muszą być idempotentne,
+# bo baza utworzona przed wprowadzeniem migracji może mieć już część zmian
+MIGRATIONS = []
+
+def migration(version, description):
+    def register(fn):
+        MIGRATIONS.append((version, description, fn))
+        return fn
+    return register
+
+def _has_column(table_name, column_name):
+    return column_name in {c['name'] for c in inspect(db.session.connection()).get_columns(table_name)}
+
+def _add_columns(model, *names):
+    """ALTER TABLE ADD COLUMN dla kolumn modelu, których jeszcze nie ma w bazie."""
+    connection = db.session.connection()
+    table = model.__table__
+    for name in names:
+        column = table.c[name]
+        if _has_column(table.name, name):
+            continue
+        ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(connection.dialect)}'
+        if column.server_default is not None:
+            ddl += f" DEFAULT {column.server_default.arg}"
+            if not column.nullable:
+                ddl += ' NOT NULL'
+        connection.execute(db.text(ddl))
+
+def _create_indexes(model, *names):
+    connection = db.session.connection()
+    for index in model.__table__.indexes:
+        if index.name in names:
+            index.create(connection, checkfirst=True)
+
+def _create_tables(*models):
+    connection = db.session.connection()
+    for model in models:
+        model.__table__.create(connection, checkfirst=True)
+
+@migration(1, 'Person full-text search index')
+def _person_search_index():
+    if db.engine.dialect.name == 'sqlite':
+        rebuild_search_index()
+
+@migration(2, 'Denormalized membership validity, class capacity and participant counter')
+def _membership_validity_and_capacity():
+    _add_columns(Client, 'membership_valid_until')
+    _add_columns(GroupClass, 'capacity', 'participant_count')
+    _create_indexes(Client, 'ix_client_membership_valid_until')
+    _create_indexes(Membership, 'ix_membership_client_active')
+    refresh_membership_valid_until()
+    refresh_participant_counts()
+
+@migration(3, 'Unique enrolment per client and class')
+def _unique_enrolment():
+    connection = db.session.connection()
+    if 'uq_participation_client_class' in {c['name'] for c in inspect(connection).get_unique_constraints('participation')}:
+        return
+    duplicates = (
+        db.select(db.func.min(Participation.id))
+        .group_by(Participation.client_id, Participation.group_class_id)
+    )
+    db.session.execute(db.delete(Participation).where(Participation.id.not_in(duplicates)))
+    # SQLite nie dodaje ograniczeń do istniejącej tabeli - unikalny indeks działa tak samo (także dla ON CONFLICT)
+    connection.execute(db.text(
+        'CREATE UNIQUE INDEX IF NOT EXISTS uq_participation_client_class ON participation (client_id, group_class_id)'
+    ))
+    refresh_participant_counts()
+
+@migration(4, 'Shared cache version counters')
+def _cache_version():
+    _create_tables(CacheVersion)
+
+@migration(5, 'Statistics rollups and creation dates')
+def _rollups():
+    _add_columns(Client, 'created_on')
+    _add_columns(Participation, 'created_on')
+    _create_tables(DailyRollup, MonthlyRollup)
+    # agregaty wypełnia migracja 11 - ich przeliczenie potrzebuje już kolumny membership.price
+
+@migration(6, 'Indexes for foreign keys, person filters and the class schedule')
+def _hot_path_indexes():
+    _create_indexes(Person, 'ix_person_type_active')
+    _create_indexes(Membership, 'ix_membership_type_id')
+    _create_indexes(GroupClass, 'ix_group_class_trainer_id', 'ix_group_class_day_start_hour')
+    _create_indexes(Participation, 'ix_participation_group_class_id')
+
+@migration(7, 'Modification time of cache version counters')
+def _cache_version_updated_at():
+    _add_columns(CacheVersion, 'updated_at')
+
+@migration(8, 'Background job queue')
+def _job_queue():
+    _create_tables(Job)
+
+@migration(9, 'Materialized class sessions')
+def _class_sessions():
+    _create_tables(ClassSession)
+    materialize_sessions()
+
+@migration(10, 'Calendar feed secrets')
+def _feed_secrets():
+    _add_columns(Person, 'feed_secret')
+    person_ids = db.session.scalars(db.select(Person.id).where(Person.feed_secret == None)).all()
+    if person_ids:
+        db.session.execute(db.update(Person), [{'id': person_id, 'feed_secret': new_feed_secret()} for person_id in person_ids])
+
+@migration(11, 'Sale price of memberships and enrolment rollup metric')
+def _membership_price():
+    _add_columns(Membership, 'price')
+    # karnety sprzedane przed migracją - najlepsze przybliżenie to bieżąca cena typu
+    price = db.select(MembershipType.price).where(MembershipType.id == Membership.type_id).scalar_subquery()
+    db.session.execute(db.update(Membership).where(Membership.price == None).values(price=price))
+    # przeliczenie od zera zastępuje też dawną metrykę 'attendance' nową 'enrolments'
+    rebuild_rollups()
+
+LATEST_VERSION = max(version for version, _, _ in MIGRATIONS)
+
+def current_version():
+    _create_tables(SchemaMigration)
+    return db.session.execute(db.select(db.func.max(SchemaMigration.version))).scalar() or 0
+
+def upgrade(target=None):
+    """Stosuje kolejne brakujące migracje, każdą w osobnej transakcji. Zwraca listę zastosowanych (wersja, opis)."""
+    target = LATEST_VERSION if target is None else target
+    applied = []
+    for version, description, fn in sorted(MIGRATIONS, key=lambda m: m[0]):
+        if version > target or version <= current_version():
+            continue
+        try:
+            fn()
+            db.session.add(SchemaMigration(version=version, description=description))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        applied.append((version, description))
+    return applied
+
+def stamp(version=None):
+    """Oznacza migracje do `version` jako zastosowane bez ich uruchamiania (nowa baza z create_all)."""
+    version = LATEST_VERSION if version is None else version
+    current = current_version()
+    for number, description, _ in MIGRATIONS:
+        if current < number <= version:
+            db.session.add(SchemaMigration(version=number, description=description))
+    db.session.commit()
+
+@click.command('db-upgrade')
+@click.option('--to', 'target', type=int, default=None, help='Target schema version (default: latest)')
+@click.option('--backup', type=click.Path(dir_okay=False), default=None, help='Copy the SQLite database here first')
+def db_upgrade_command(target, backup):
+    """Upgrades the database schema in place"""
+    if backup:
+        if db.engine.dialect.name != 'sqlite':
+            raise click.UsageError('--backup is only supported for SQLite')
+        db.session.execute(db.text('VACUUM INTO :path'), {'path': backup})
+        click.echo(f'Backup written to {backup}')
+    applied = upgrade(target)
+    for version, description in applied:
+        click.echo(f'Applied {version}: {description}')
+    click.echo(f'Schema version {current_version()} (latest {LATEST_VERSION})')
+
+@click.command('db-version')
+def db_version_command():
+    """Shows the schema version and pending migrations"""
+    current = current_version()
+    db.session.commit()
+    click.echo(f'Schema version {current} (latest {LATEST_VERSION})')
+    for version, description, _ in MIGRATIONS:
+        if version > current:
+            click.echo(f'  pending {version}: {description}')
+
+def init_app(app):
+    app.cli.add_command(db_upgrade_command)
+    app.cli.add_command(db_version_command)
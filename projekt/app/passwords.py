@@ -0,0 +1,137 @@
+import functools
+from itertools import repeat
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from passlib.hash import argon2
+
+# Profile kosztu Argon2 - 'default' odpowiada domyślnym ustawieniom passlib (dotychczasowe hasze)
+ARGON2_PROFILES = {
+    'fast': {'rounds': 1, 'memory_cost': 8192, 'parallelism': 1},
+    'default': {'rounds': 3, 'memory_cost': 65536, 'parallelism': 4},
+    'strong': {'rounds': 4, 'memory_cost': 131072, 'parallelism': 4},
+}
+
+# porcja haseł przekazywana naraz do puli przez hash_many
+HASH_MANY_CHUNK = 64
+
+class HashingBusy(Exception):
+    """Pula haszująca jest pełna - klient powinien spróbować ponownie."""
+
+@functools.lru_cache
+def _hasher(settings):
+    return argon2.using(**dict(settings))
+
+def _hash(password, settings):
+    return _hasher(settings).hash(password)
+
+def _verify(password, password_hash, settings):
+    """Zwraca (czy_poprawne, nowy_hasz) - nowy hasz tylko gdy zapisany ma nieaktualne parametry."""
+    hasher = _hasher(settings)
+    if not hasher.verify(password, password_hash):
+        return False, None
+    if hasher.needs_update(password_hash):
+        return True, hasher.hash(password)
+    return True, None
+
+class PasswordHasher:
+    """Haszowanie haseł w ograniczonej puli procesów (PASSWORD_HASH_WORKERS = 0 - w bieżącym wątku)."""
+
+    def __init__(self, app=None):
+        self.settings = tuple(ARGON2_PROFILES['default'].items())
+        self.workers = 0
+        self.timeout = None
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.settings = tuple(ARGON2_PROFILES[app.config['ARGON2_PROFILE']].items())
+        self.workers = app.config['PASSWORD_HASH_WORKERS']
+        self.timeout = app.config['PASSWORD_HASH_TIMEOUT']
+        self._slots = threading.BoundedSemaphore(self.workers + app.config['PASSWORD_HASH_QUEUE_LIMIT'])
+        app.extensions['password_hasher'] = self
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._executor
+
+    def _discard_executor(self, executor):
+        # po śmierci procesu (OOM, segfault) pula jest trwale zepsuta - następne wywołanie zbuduje nową
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, fn, *args):
+        if self.workers == 0:
+            return fn(*args, self.settings)
+
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+        executor = self._get_executor()
+        try:
+            future = executor.submit(fn, *args, self.settings)
+        except BrokenProcessPool:
+            self._slots.release()
+            self._discard_executor(executor)
+            raise HashingBusy()
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            raise HashingBusy()
+        except BrokenProcessPool:
+            self._discard_executor(executor)
+            raise HashingBusy()
+
+    def hash(self, password):
+        return self._run(_hash, password)
+
+    def verify(self, password, password_hash):
+        return self._run(_verify, password, password_hash)
+
+    def hash_many(self, passwords):
+        """Haszowanie wsadowe (import) - rozkłada hasła na wszystkie procesy puli, bez PASSWORD_HASH_QUEUE_LIMIT.
+
+        Hasła trafiają do puli porcjami po HASH_MANY_CHUNK, więc w kolejce nie czeka naraz cała paczka importu.
+        """
+        if self.workers == 0:
+            return [_hash(password, self.settings) for password in passwords]
+        hashes = []
+        for start in range(0, len(passwords), HASH_MANY_CHUNK):
+            chunk = passwords[start:start + HASH_MANY_CHUNK]
+            chunksize = max(1, len(chunk) // (self.workers * 4))
+            executor = self._get_executor()
+            try:
+                hashes.extend(executor.map(_hash, chunk, repeat(self.settings), chunksize=chunksize))
+            except BrokenProcessPool:
+                self._discard_executor(executor)
+                raise HashingBusy()
+        return hashes
+
+    def _after_fork(self):
+        # pula procesów rodzica nie działa w procesie potomnym - własna powstanie przy pierwszym haszowaniu
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+password_hasher = PasswordHasher()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=password_hasher._after_fork)
@@ -0,0 +1,205 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+from flask import g, request
+from flask_login import current_user
+from app.instrumentation import current_stats
+from app.jobs import periodic
+
+# funkcje, których łączny czas (cumtime) opisuje, na co poszło żądanie
+PROFILE_CATEGORIES = {
+    'sql': [('sqlalchemy/engine/default.py', 'do_execute'), ('sqlalchemy/engine/default.py', 'do_executemany')],
+    'templates': [('flask/templating.py', '_render')],
+    'hashing': [('app/passwords.py', '_run'), ('app/passwords.py', 'hash_many')],
+}
+
+_SAFE_NAME = re.compile(r'[^A-Za-z0-9_.-]+')
+
+# w procesie może działać tylko jeden cProfile naraz (od Pythona 3.12 drugi rzuca ValueError),
+# więc współbieżne żądania z wylosowanym profilowaniem są po prostu obsługiwane bez niego
+_profiler_lock = threading.Lock()
+
+class StackSampler(threading.Thread):
+    """Próbkuje stos wątku żądania co `interval` s - wynik w formacie collapsed stacks (flame graph)."""
+
+    def __init__(self, thread_id, interval=0.001):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+class RequestProfiler:
+    """Profilowanie wybranych żądań: ?_profile=1 / nagłówek X-Profile (tylko właściciel) albo losowa próbka."""
+
+    def __init__(self, app=None):
+        self.directory = None
+        self.sample_rate = 0.0
+        self.keep = 200
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.directory = app.config['PROFILE_DIR'] or os.path.join(app.instance_path, 'profiles')
+        self.sample_rate = app.config['PROFILE_SAMPLE_RATE']
+        self.keep = app.config['PROFILE_KEEP']
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        app.teardown_request(self._abort)
+        app.extensions['request_profiler'] = self
+
+    def _requested(self):
+        if request.args.get('_profile') == '1' or request.headers.get('X-Profile') == '1':
+            return current_user.is_authenticated and current_user.role == 'owner'
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def _start(self):
+        if request.endpoint in (None, 'static') or not self._requested():
+            return
+        if not _profiler_lock.acquire(blocking=False):
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # profiler zajęty poza tą klasą (np. sys.monitoring debuggera)
+            _profiler_lock.release()
+            return
+        sampler = StackSampler(threading.get_ident())
+        sql_before = current_stats(create=True)
+        g.profiling = (profile, sampler, time.perf_counter(), sql_before.count, sql_before.total)
+        sampler.start()
+
+    def _stop(self):
+        profiling = g.pop('profiling', None)
+        if profiling is None:
+            return None
+        profiling[0].disable()
+        _profiler_lock.release()
+        profiling[1].stop()
+        return profiling
+
+    def _finish(self, response):
+        profiling = self._stop()
+        if profiling is not None:
+            profile, sampler, started, sql_count, sql_total = profiling
+            duration = time.perf_counter() - started
+            sql = current_stats(create=True)
+            self.save(profile, sampler, {
+                'endpoint': request.endpoint,
+                'method': request.method,
+                'path': request.full_path.rstrip('?'),
+                'status': response.status_code,
+                'duration_ms': round(duration * 1000, 2),
+                'sql_queries': sql.count - sql_count,
+                'sql_ms': round((sql.total - sql_total) * 1000, 2),
+                'user': current_user.get_id() if current_user.is_authenticated else None,
+                'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            })
+            response.headers['X-Profile-Id'] = g.profile_id
+        return response
+
+    def _abort(self, exc):
+        # wyjątek w widoku - after_request nie zostało wywołane
+        self._stop()
+
+    def save(self, profile, sampler, meta):
+        os.makedirs(self.directory, exist_ok=True)
+        now = time.time()
+        name = '{}{:03d}-{}-{:04d}'.format(
+            time.strftime('%Y%m%d-%H%M%S', time.localtime(now)), int(now % 1 * 1000),
+            _SAFE_NAME.sub('_', meta['endpoint']), random.randrange(10000)
+        )
+        stats = pstats.Stats(profile)
+        meta['id'] = name
+        meta['categories_ms'] = category_times(stats)
+        profile.dump_stats(os.path.join(self.directory, name + '.prof'))
+        with open(os.path.join(self.directory, name + '.folded'), 'w', encoding='utf-8') as f:
+            f.write(sampler.collapsed())
+        with open(os.path.join(self.directory, name + '.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        g.profile_id = name
+        return name
+
+    def prune(self):
+        """Zostawia PROFILE_KEEP najnowszych profili (zadanie okresowe - poza ścieżką żądania)."""
+        if not os.path.isdir(self.directory):
+            return
+        names = sorted(f[:-5] for f in os.listdir(self.directory) if f.endswith('.json'))
+        for name in names[:-self.keep] if len(names) > self.keep else []:
+            for extension in ('.json', '.prof', '.folded'):
+                try:
+                    os.remove(os.path.join(self.directory, name + extension))
+                except FileNotFoundError:
+                    pass
+
+    def recent(self, limit=100):
+        """Metadane ostatnich profili, od najnowszego."""
+        if not os.path.isdir(self.directory):
+            return []
+        names = sorted((f[:-5] for f in os.listdir(self.directory) if f.endswith('.json')), reverse=True)[:limit]
+        profiles = []
+        for name in names:
+            try:
+                with open(os.path.join(self.directory, name + '.json'), encoding='utf-8') as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return profiles
+
+    def load(self, name):
+        """(metadane, 40 najdroższych funkcji jako tekst pstats) albo None."""
+        if _SAFE_NAME.sub('_', name) != name:
+            return None
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path + '.json'):
+            return None
+        with open(path + '.json', encoding='utf-8') as f:
+            meta = json.load(f)
+        out = io.StringIO()
+        pstats.Stats(path + '.prof', stream=out).sort_stats('cumulative').print_stats(40)
+        return meta, out.getvalue()
+
+request_profiler = RequestProfiler()
+
+@periodic('prune-profiles', every=timedelta(minutes=10))
+def _prune_profiles():
+    request_profiler.prune()
+
+def category_times(stats):
+    """Łączny czas (ms) SQL, renderowania szablonów i haszowania haseł w profilu."""
+    times = {}
+    for category, functions in PROFILE_CATEGORIES.items():
+        total = 0.0
+        for (filename, _, function), (_, _, _, cumtime, _) in stats.stats.items():
+            if any(filename.replace('\\', '/').endswith(suffix) and function == name for suffix, name in functions):
+                total += cumtime
+        times[category] = round(total * 1000, 2)
+    return times
@@ -0,0 +1,29 @@
+from collections import namedtuple
+from app.db import db, User, Person, Client
+
+# Wiersze list (tylko do odczytu) - same wyświetlane kolumny zamiast pełnych encji z mapą tożsamości
+# i leniwie ładowanym użytkownikiem. Nazwy pól odpowiadają atrybutom modeli, więc szablony i kursor
+# paginacji (getattr po kluczu kolumny) działają bez zmian.
+ClientRow = namedtuple('ClientRow', 'id first_name last_name pesel phone_number active email has_valid_membership')
+StaffRow = namedtuple('StaffRow', 'id first_name last_name phone_number active username email')
+
+def client_rows():
+    """Zapytanie listy klientów: person JOIN client, e-mail z user i flaga ważnego karnetu w jednym SELECT."""
+    return (
+        db.select(
+            Client.id, Client.first_name, Client.last_name, Client.pesel, Client.phone_number, Client.active,
+            User.email, Client.has_valid_membership.label('has_valid_membership')
+        )
+        .outerjoin(User, User.id == Client.user_id)
+    )
+
+def staff_rows(person_type):
+    """Zapytanie listy trenerów / pracowników - wszystkie kolumny są w person, więc bez złączenia z tabelą podtypu."""
+    return (
+        db.select(
+            Person.id, Person.first_name, Person.last_name, Person.phone_number, Person.active,
+            User.username, User.email
+        )
+        .outerjoin(User, User.id == Person.user_id)
+        .where(Person.type == person_type)
+    )
@@ -0,0 +1,243 @@
+from collections import Counter, namedtuple
+from datetime import date, time, timedelta
+import click
+from sqlalchemy import String, Integer, Float, Date, event
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy.dialects import postgresql, sqlite
+from app.db import db, Client, Membership, MembershipType, Participation, GroupClass, Trainer
+from app.jobs import periodic
+
+# Metryki (klucz - id typu karnetu / id zajęć, 0 gdy brak):
+#   revenue, memberships_sold  - wg daty startu karnetu, także anulowanego; przychód z ceny sprzedaży (Membership.price)
+#   membership_starts/_ends    - nieanulowane karnety wg daty startu i końca; ich różnica to liczba aktywnych
+#   signups                    - nowi klienci wg Client.created_on
+#   enrolments                 - zapisy na zajęcia wg Participation.created_on (nie obecność)
+class _Rollup(db.Model):
+    __abstract__ = True
+
+    start: Mapped[date] = mapped_column(Date, primary_key=True)  # dzień albo pierwszy dzień miesiąca
+    metric: Mapped[str] = mapped_column(String(30), primary_key=True)
+    key: Mapped[int] = mapped_column(Integer, primary_key=True, default=0)
+    value: Mapped[float] = mapped_column(Float, nullable=False, default=0)
+
+class DailyRollup(_Rollup):
+    __tablename__ = "rollup_daily"
+
+class MonthlyRollup(_Rollup):
+    __tablename__ = "rollup_monthly"
+
+def _month(day):
+    return day.replace(day=1)
+
+def _upsert(connection, model, rows):
+    insert = postgresql.insert if connection.dialect.name == 'postgresql' else sqlite.insert
+    stmt = insert(model.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['start', 'metric', 'key'],
+        set_={'value': model.__table__.c.value + stmt.excluded.value}
+    )
+    connection.execute(stmt, rows)
+
+def apply_deltas(connection, deltas):
+    """Dodaje przyrosty {(dzień, metryka, klucz): wartość} do agregatów dziennych i miesięcznych."""
+    daily = Counter({k: v for k, v in deltas.items() if v})
+    if not daily:
+        return
+    monthly = Counter()
+    for (day, metric, key), value in daily.items():
+        monthly[(_month(day), metric, key)] += value
+    for model, counts in ((DailyRollup, daily), (MonthlyRollup, monthly)):
+        _upsert(connection, model, [
+            {'start': start, 'metric': metric, 'key': key, 'value': value}
+            for (start, metric, key), value in counts.items()
+        ])
+
+def membership_deltas(start_date, type_id, price, duration, active, sign=1, deltas=None):
+    deltas = Counter() if deltas is None else deltas
+    deltas[(start_date, 'revenue', type_id)] += sign * price
+    deltas[(start_date, 'memberships_sold', type_id)] += sign
+    if active:
+        deltas[(start_date, 'membership_starts', type_id)] += sign
+        deltas[(start_date + timedelta(days=duration), 'membership_ends', type_id)] += sign
+    return deltas
+
+def _duration(connection, type_id):
+    return connection.execute(db.select(MembershipType.duration).where(MembershipType.id == type_id)).scalar_one()
+
+def _old_value(state, name):
+    history = state.attrs[name].history
+    return history.deleted[0] if history.deleted else getattr(state.obj(), name)
+
+@event.listens_for(Membership, 'after_insert')
+def _membership_inserted(mapper, connection, target):
+    duration = _duration(connection, target.type_id)
+    apply_deltas(connection, membership_deltas(target.start_date, target.type_id, target.price, duration, target.active))
+
+@event.listens_for(Membership, 'after_update')
+def _membership_updated(mapper, connection, target):
+    state = db.inspect(target)
+    if not any(state.attrs[c].history.has_changes() for c in ('start_date', 'type_id', 'price', 'active')):
+        return
+    old_type_id = _old_value(state, 'type_id')
+    deltas = membership_deltas(
+        _old_value(state, 'start_date'), old_type_id, _old_value(state, 'price'), _duration(connection, old_type_id),
+        _old_value(state, 'active'), sign=-1
+    )
+    membership_deltas(target.start_date, target.type_id, target.price, _duration(connection, target.type_id), target.active, deltas=deltas)
+    apply_deltas(connection, deltas)
+
+@event.listens_for(Membership, 'after_delete')
+def _membership_deleted(mapper, connection, target):
+    duration = _duration(connection, target.type_id)
+    apply_deltas(connection, membership_deltas(target.start_date, target.type_id, target.price, duration, target.active, sign=-1))
+
+@event.listens_for(MembershipType, 'after_update')
+def _membership_type_updated(mapper, connection, target):
+    # koniec karnetu liczony jest z bieżącej długości typu - jej zmiana przesuwa końce wszystkich jego karnetów
+    # (cena nie - przychód pochodzi z Membership.price zapisanej przy sprzedaży)
+    state = db.inspect(target)
+    if not state.attrs.duration.history.has_changes():
+        return
+    old_duration = _old_value(state, 'duration')
+    deltas = Counter()
+    for start_date, count in connection.execute(
+        db.select(Membership.start_date, db.func.count())
+        .where(Membership.type_id == target.id, Membership.active == True)
+        .group_by(Membership.start_date)
+    ):
+        deltas[(start_date + timedelta(days=old_duration), 'membership_ends', target.id)] -= count
+        deltas[(start_date + timedelta(days=target.duration), 'membership_ends', target.id)] += count
+    apply_deltas(connection, deltas)
+
+@event.listens_for(Client, 'after_insert')
+def _client_inserted(mapper, connection, target):
+    if target.created_on is not None:
+        apply_deltas(connection, Counter({(target.created_on, 'signups', 0): 1}))
+
+@event.listens_for(Client, 'after_delete')
+def _client_deleted(mapper, connection, target):
+    if target.created_on is not None:
+        apply_deltas(connection, Counter({(target.created_on, 'signups', 0): -1}))
+
+def record_enrolment(day, group_class_id, change=1):
+    """Zapis / wypis z zajęć wykonany poleceniem SQL (enroll, unenroll) - bez zdarzeń mappera."""
+    if day is not None:
+        apply_deltas(db.session.connection(), Counter({(day, 'enrolments', group_class_id): change}))
+
+def rebuild_rollups():
+    """Przelicza agregaty od zera z tabel źródłowych (bez commita - zatwierdza wywołujący). Zwraca liczbę wierszy dziennych."""
+    deltas = Counter()
+    memberships = db.session.execute(
+        db.select(Membership.start_date, Membership.type_id, Membership.price, MembershipType.duration, Membership.active)
+        .join(MembershipType, MembershipType.id == Membership.type_id)
+    )
+    for row in memberships:
+        membership_deltas(*row, deltas=deltas)
+
+    signups = db.session.execute(
+        db.select(Client.created_on, db.func.count()).where(Client.created_on != None).group_by(Client.created_on)
+    )
+    for day, count in signups:
+        deltas[(day, 'signups', 0)] += count
+
+    enrolments = db.session.execute(
+        db.select(Participation.created_on, Participation.group_class_id, db.func.count())
+        .where(Participation.created_on != None, Participation.group_class_id != None)
+        .group_by(Participation.created_on, Participation.group_class_id)
+    )
+    for day, group_class_id, count in enrolments:
+        deltas[(day, 'enrolments', group_class_id)] += count
+
+    db.session.execute(db.delete(DailyRollup))
+    db.session.execute(db.delete(MonthlyRollup))
+    apply_deltas(db.session.connection(), deltas)
+    return len([v for v in deltas.values() if v])
+
+@periodic('rebuild-rollups', at=time(3, 0))
+def _nightly_rebuild():
+    # agregaty utrzymują zdarzenia mappera - nocne przeliczenie naprawia ewentualny dryf (zmiany poza ORM)
+    rebuild_rollups()
+    db.session.commit()
+
+@click.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Recomputes the daily and monthly statistics rollups from scratch"""
+    count = rebuild_rollups()
+    db.session.commit()
+    click.echo(f'Rebuilt {count} daily rollup rows')
+
+def _month_after(day):
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+def sum_metric(metric, date_from, date_to):
+    """{klucz: suma} w przedziale [date_from, date_to] - pełne miesiące z agregatów miesięcznych, brzegi z dziennych."""
+    first_full = date_from if date_from.day == 1 else _month_after(date_from)
+    end_full = _month(date_to + timedelta(days=1))  # pierwszy miesiąc, który nie mieści się w całości
+
+    if first_full < end_full:
+        ranges = [(MonthlyRollup, first_full, end_full - timedelta(days=1)), (DailyRollup, end_full, date_to)]
+        if date_from < first_full:
+            ranges.append((DailyRollup, date_from, first_full - timedelta(days=1)))
+    else:
+        ranges = [(DailyRollup, date_from, date_to)]
+
+    totals = Counter()
+    for model, start, end in ranges:
+        if start > end:
+            continue
+        rows = db.session.execute(
+            db.select(model.key, db.func.sum(model.value))
+            .where(model.metric == metric, model.start >= start, model.start <= end)
+            .group_by(model.key)
+        )
+        for key, value in rows:
+            totals[key] += value
+    return totals
+
+DashboardType = namedtuple('DashboardType', 'id name revenue sold active')
+DashboardTrainer = namedtuple('DashboardTrainer', 'id first_name last_name enrolments')
+
+def dashboard(date_from, date_to):
+    """Dane panelu właściciela - czas zależy od długości przedziału, a nie od liczby karnetów i zapisów."""
+    revenue = sum_metric('revenue', date_from, date_to)
+    sold = sum_metric('memberships_sold', date_from, date_to)
+    started = sum_metric('membership_starts', date.min, date_to)
+    ended = sum_metric('membership_ends', date.min, date_to - timedelta(days=1))  # karnet jest ważny jeszcze w dniu końca
+    types = [
+        DashboardType(type_id, name, revenue[type_id], int(sold[type_id]), int(started[type_id] - ended[type_id]))
+        for type_id, name in db.session.execute(db.select(MembershipType.id, MembershipType.name).order_by(MembershipType.id))
+    ]
+
+    enrolments = sum_metric('enrolments', date_from, date_to)
+    per_trainer = Counter()
+    if enrolments:
+        classes = db.session.execute(
+            db.select(GroupClass.id, GroupClass.trainer_id).where(GroupClass.id.in_(list(enrolments)))
+        )
+        for class_id, trainer_id in classes:
+            per_trainer[trainer_id] += enrolments[class_id]
+    trainers = [
+        DashboardTrainer(trainer_id, first_name, last_name, int(per_trainer[trainer_id]))
+        for trainer_id, first_name, last_name in db.session.execute(
+            db.select(Trainer.id, Trainer.first_name, Trainer.last_name).where(Trainer.id.in_(list(per_trainer)))
+        )
+    ]
+    trainers.sort(key=lambda trainer: trainer.enrolments, reverse=True)
+
+    signups = db.session.execute(
+        db.select(MonthlyRollup.start, MonthlyRollup.value)
+        .where(MonthlyRollup.metric == 'signups', MonthlyRollup.start >= _month(date_from), MonthlyRollup.start <= date_to)
+        .order_by(MonthlyRollup.start)
+    ).all()
+
+    return {
+        'types': types,
+        'revenue': sum(t.revenue for t in types),
+        'active': sum(t.active for t in types),
+        'trainers': trainers,
+        'signups': [(month, int(value)) for month, value in signups],
+        'signups_total': int(sum_metric('signups', date_from, date_to)[0]),
+    }
+
+def init_app(app):
+    app.cli.add_command(rebuild_rollups_command)
@@ -0,0 +1,345 @@
+import functools
+import hashlib
+from collections import namedtuple
+from datetime import date, datetime, time, timezone
+from flask import Blueprint, abort, current_app, g, jsonify, make_response, request
+from werkzeug.exceptions import HTTPException
+from app.db import db, User, Person, Client, Membership, MembershipType, GroupClass, Trainer
+from app.identity import issue_token, verify_token
+from app.passwords import HashingBusy
+from app.routing import read_only
+from app.services import paginate, enroll, unenroll, bulk_assign_membership, bulk_enroll, BULK_MAX_CLIENTS, CLIENT_ID_MAX, CLASS_NOT_FOUND
+from app.schedule_cache import (
+    SCHEDULE, MEMBERSHIPS, MEMBERSHIP_TYPES, data_versions, invalidate_schedule, get_classes, get_class
+)
+
+# JSON API dla aplikacji mobilnej i tabletów recepcji.
+# Autoryzacja: nagłówek "Authorization: Bearer <token>" z POST /api/v1/token - bez ciasteczka sesji; rola i aktywność
+# konta są sprawdzane w identity_cache, nie przez wczytanie użytkownika w każdym żądaniu.
+# Listy: ?after=<next_cursor>&page_size=N, ?fields=a,b (wybrane pola).
+# Odpowiedzi GET mają ETag i Last-Modified - If-None-Match / If-Modified-Since dają 304 bez budowania odpowiedzi.
+api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+STAFF_ROLES = ('employee', 'owner')
+
+@api_bp.errorhandler(HTTPException)
+def _error(e):
+    response = jsonify({'error': e.description})
+    response.status_code = e.code
+    if e.code == 401:
+        response.headers['WWW-Authenticate'] = 'Bearer'
+    return response
+
+def _identity():
+    """Tożsamość z tokenu (g.api_identity) albo None bez nagłówka - zły token to zawsze 401."""
+    if 'api_identity' not in g:
+        header = request.headers.get('Authorization')
+        identity = None
+        if header:
+            scheme, _, token = header.partition(' ')
+            identity = verify_token(token.strip()) if scheme.lower() == 'bearer' else None
+            if identity is None:
+                abort(401, 'Nieprawidłowy lub wygasły token.')
+        g.api_identity = identity
+    return g.api_identity
+
+def token_required(*roles):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped_view(**kwargs):
+            identity = _identity()
+            if identity is None:
+                abort(401, 'Wymagany token.')
+            if roles and identity.role not in roles:
+                abort(403, 'Brak uprawnień.')
+            return view(**kwargs)
+        return wrapped_view
+    return decorator
+
+def _json_value(value):
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    return value
+
+def _fields(available):
+    """Pola z ?fields=a,b (w kolejności `available`) - domyślnie wszystkie."""
+    requested = request.args.get('fields')
+    if not requested:
+        return list(available)
+    names = {name.strip() for name in requested.split(',') if name.strip()}
+    unknown = names - set(available)
+    if unknown:
+        abort(400, f"Nieznane pola: {', '.join(sorted(unknown))}. Dostępne: {', '.join(available)}.")
+    return [name for name in available if name in names]
+
+@functools.lru_cache(maxsize=None)
+def _row_type(names):
+    return namedtuple('ApiRow', names)
+
+def _page(stmt, columns, sort_keys, fields):
+    """Strona wyników zapytania wybierającego tylko `fields` (i klucze sortowania potrzebne do kursora)."""
+    names = tuple(dict.fromkeys(fields + [column.key for column, _ in sort_keys]))
+    stmt = stmt.add_columns(*[columns[name].label(name) for name in names])
+    rows, next_cursor = paginate(stmt, sort_keys, _row_type(names))
+    return {
+        'data': [{name: _json_value(getattr(row, name)) for name in fields} for row in rows],
+        'next_cursor': next_cursor,
+    }
+
+def _conditional(versions, build, per_user=False, daily=False):
+    """Odpowiedź warunkowa: walidatory z liczników cache_version (wynik data_versions), treść z `build()`
+    tylko gdy klient jej nie ma.
+
+    per_user - treść zależy od tożsamości, daily - od dzisiejszej daty (np. czy karnet jest aktywny).
+    """
+    identity = _identity()
+    key = [request.full_path] + [f'{name}:{version.version}' for name, version in sorted(versions.items())]
+    if per_user:
+        key.append(f'{identity.id}:{identity.role}:{identity.profile_id}' if identity else 'anonymous')
+    if daily:
+        key.append(date.today().isoformat())
+    etag = hashlib.sha1('|'.join(key).encode()).hexdigest()
+
+    modified = [v.updated_at.replace(tzinfo=timezone.utc) for v in versions.values() if v.updated_at is not None]
+    if daily:
+        modified.append(datetime.combine(date.today(), time()).astimezone(timezone.utc))
+    last_modified = max(modified).replace(microsecond=0) if modified else None
+
+    if request.if_none_match:
+        fresh = request.if_none_match.contains(etag)
+    else:
+        fresh = last_modified is not None and request.if_modified_since is not None and last_modified <= request.if_modified_since
+    response = make_response('', 304) if fresh else jsonify(build())
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@api_bp.route('/token', methods=['POST'])
+def token():
+    data = request.get_json(silent=True) or {}
+    username, password = data.get('username'), data.get('password')
+    if not isinstance(username, str) or not isinstance(password, str):
+        abort(400, 'Wymagane pola: username, password.')
+
+    user = db.session.execute(db.select(User).where(User.username == username)).scalar()
+    try:
+        valid = user is not None and user.check_password(password)
+    except HashingBusy:
+        response = jsonify({'error': 'Serwer jest chwilowo przeciążony. Spróbuj ponownie za chwilę.'})
+        return response, 503, {'Retry-After': '5'}
+    if not valid:
+        abort(401, 'Nieprawidłowy login lub hasło.')
+
+    profile_id = db.session.execute(db.select(Person.id).where(Person.user_id == user.id)).scalar()
+    db.session.commit()  # zapisuje ewentualnie przeliczony hasz
+    return jsonify({
+        'token': issue_token(user.id, user.role, profile_id),
+        'token_type': 'Bearer',
+        'expires_in': current_app.config['API_TOKEN_MAX_AGE'],
+        'role': user.role,
+    })
+
+SCHEDULE_FIELDS = (
+    'id', 'name', 'day', 'start_hour', 'length', 'capacity', 'participant_count', 'trainer_id', 'trainer_name', 'joined'
+)
+
+def _scheduled_class(group_class, fields, identity):
+    values = {
+        'id': group_class.id,
+        'name': group_class.name,
+        'day': group_class.day,
+        'start_hour': group_class.start_hour.isoformat(),
+        'length': group_class.length,
+        'capacity': group_class.capacity,
+        'participant_count': group_class.participant_count,
+        'trainer_id': group_class.trainer.id,
+        'trainer_name': f'{group_class.trainer.first_name} {group_class.trainer.last_name}',
+        'joined': (
+            identity is not None and identity.role == 'client' and identity.profile_id in group_class.participant_ids
+        ),
+    }
+    return {name: values[name] for name in fields}
+
+@api_bp.route('/schedule')
+@read_only
+def schedule():
+    """Cały grafik tygodnia z pamięci podręcznej grafiku (bez paginacji - liczba zajęć w tygodniu jest mała)."""
+    fields = _fields(SCHEDULE_FIELDS)
+    trainer_id = request.args.get('trainer_id', type=int)
+    identity = _identity()
+    versions = data_versions(SCHEDULE)
+
+    def build():
+        classes = get_classes(versions[SCHEDULE].version, trainer_id=trainer_id)
+        return {'data': [_scheduled_class(group_class, fields, identity) for group_class in classes]}
+    return _conditional(versions, build, per_user='joined' in fields)
+
+CLASS_COLUMNS = {
+    'id': GroupClass.id,
+    'name': GroupClass.name,
+    'day': GroupClass.day,
+    'start_hour': GroupClass.start_hour,
+    'length': GroupClass.length,
+    'capacity': GroupClass.capacity,
+    'participant_count': GroupClass.participant_count,
+    'trainer_id': GroupClass.trainer_id,
+    'trainer_name': Trainer.first_name + ' ' + Trainer.last_name,
+}
+
+@api_bp.route('/classes')
+@read_only
+def classes():
+    fields = _fields(tuple(CLASS_COLUMNS))
+    trainer_id = request.args.get('trainer_id', type=int)
+    day = request.args.get('day', type=int)
+
+    def build():
+        stmt = db.select().select_from(GroupClass)
+        if 'trainer_name' in fields:
+            stmt = stmt.join(Trainer, Trainer.id == GroupClass.trainer_id)
+        if trainer_id:
+            stmt = stmt.where(GroupClass.trainer_id == trainer_id)
+        if day is not None:
+            stmt = stmt.where(GroupClass.day == day)
+        return _page(stmt, CLASS_COLUMNS, [(GroupClass.id, False)], fields)
+    return _conditional(data_versions(SCHEDULE), build)
+
+@api_bp.route('/classes/<int:id>')
+@read_only
+def group_class(id: int):
+    identity = _identity()
+    versions = data_versions(SCHEDULE)
+    group_class = get_class(versions[SCHEDULE].version, id)
+    if group_class is None:
+        abort(404, f'Zajęcia {id} nie istnieją')
+    # lista uczestników tylko dla recepcji i prowadzącego trenera
+    show_participants = identity is not None and (
+        identity.role in STAFF_ROLES or (identity.role == 'trainer' and identity.profile_id == group_class.trainer.id)
+    )
+
+    def build():
+        body = _scheduled_class(group_class, SCHEDULE_FIELDS, identity)
+        if show_participants:
+            body['participants'] = [participant._asdict() for participant in group_class.participants]
+        return body
+    return _conditional(versions, build, per_user=True)
+
+@api_bp.route('/classes/<int:id>/enrolment', methods=['POST'])
+@token_required('client')
+def join_class(id: int):
+    client_id = g.api_identity.profile_id
+    has_membership = db.session.execute(db.select(Client.has_valid_membership).where(Client.id == client_id)).scalar()
+    if not has_membership:
+        abort(409, 'Nie możesz się zapisać. Nie masz aktywnego karnetu!')
+
+    success, message = enroll(client_id, id)
+    if message == CLASS_NOT_FOUND:
+        abort(404, f'Zajęcia {id} nie istnieją')
+    if not success:
+        abort(409, message)
+    invalidate_schedule()
+    db.session.commit()
+    return jsonify({'message': message}), 201
+
+@api_bp.route('/classes/<int:id>/enrolment', methods=['DELETE'])
+@token_required('client')
+def leave_class(id: int):
+    if not unenroll(g.api_identity.profile_id, id):
+        abort(404, 'Nie jesteś zapisany na te zajęcia.')
+    invalidate_schedule()
+    db.session.commit()
+    return '', 204
+
+def _bulk_client_ids(data):
+    client_ids = data.get('client_ids')
+    # type() zamiast isinstance - JSON true/false to w Pythonie też int
+    if (not isinstance(client_ids, list) or not client_ids
+            or not all(type(i) is int and 0 < i <= CLIENT_ID_MAX for i in client_ids)):
+        abort(400, 'Pole client_ids musi być niepustą listą liczb.')
+    if len(client_ids) > BULK_MAX_CLIENTS:
+        abort(400, f'Jednorazowo można wybrać najwyżej {BULK_MAX_CLIENTS} klientów.')
+    return list(dict.fromkeys(client_ids))
+
+def _bulk_response(success, message, results):
+    return jsonify({
+        'success': success,
+        'message': message,
+        'results': [result._asdict() for result in results],
+    })
+
+@api_bp.route('/classes/<int:id>/enrolments', methods=['POST'])
+@token_required(*STAFF_ROLES)
+def bulk_join_class(id: int):
+    client_ids = _bulk_client_ids(request.get_json(silent=True) or {})
+    success, message, results = bulk_enroll(client_ids, id)
+    if not results:
+        abort(404, message)
+    if success:
+        invalidate_schedule()
+        db.session.commit()
+    return _bulk_response(success, message, results)
+
+MEMBERSHIP_TYPE_COLUMNS = {
+    'id': MembershipType.id,
+    'name': MembershipType.name,
+    'price': MembershipType.price,
+    'duration': MembershipType.duration,
+}
+
+@api_bp.route('/membership-types')
+@read_only
+def membership_types():
+    fields = _fields(tuple(MEMBERSHIP_TYPE_COLUMNS))
+
+    def build():
+        stmt = db.select().where(MembershipType.active == True)
+        return _page(stmt, MEMBERSHIP_TYPE_COLUMNS, [(MembershipType.id, False)], fields)
+    return _conditional(data_versions(MEMBERSHIP_TYPES), build)
+
+@api_bp.route('/memberships/bulk', methods=['POST'])
+@token_required(*STAFF_ROLES)
+def bulk_memberships():
+    data = request.get_json(silent=True) or {}
+    client_ids = _bulk_client_ids(data)
+    try:
+        start_date = date.fromisoformat(data['start_date']) if data.get('start_date') else date.today()
+        type_id = int(data['type_id'])
+    except (KeyError, TypeError, ValueError):
+        abort(400, 'Wymagane pole type_id i opcjonalne start_date (RRRR-MM-DD).')
+    success, message, results = bulk_assign_membership(client_ids, type_id, start_date)
+    if not results:
+        abort(409, message)
+    if success:
+        db.session.commit()
+    return _bulk_response(success, message, results)
+
+MEMBERSHIP_COLUMNS = {
+    'id': Membership.id,
+    'type_id': Membership.type_id,
+    'type_name': MembershipType.name,
+    'start_date': Membership.start_date,
+    'end_date': Membership.end_date,
+    'active': Membership.active,
+    'is_active': Membership.is_active,
+}
+
+@api_bp.route('/me/memberships')
+@read_only
+@token_required('client')
+def my_memberships():
+    fields = _fields(tuple(MEMBERSHIP_COLUMNS))
+    client_id = g.api_identity.profile_id
+
+    def build():
+        stmt = db.select().select_from(Membership).where(Membership.client_id == client_id)
+        if 'type_name' in fields:
+            stmt = stmt.join(MembershipType, MembershipType.id == Membership.type_id)
+        page = _page(stmt, MEMBERSHIP_COLUMNS, [(Membership.id, True)], fields)
+        for item in page['data']:
+            for name in ('active', 'is_active'):
+                if name in item:
+                    item[name] = bool(item[name])
+        return page
+    return _conditional(data_versions(MEMBERSHIPS), build, per_user=True, daily=True)
@@ -6,6 +6,7 @@ from flask import (
 from app.db import db, User, Client
 from app.forms import RegistrationForm, LoginForm
 from app.services import create_user_with_profile
+from app.passwords import HashingBusy
 from flask_login import login_user, logout_user, login_required, current_user
 
 auth_bp = Blueprint('auth', __name__, url_prefix='/')
@@ -38,10 +39,17 @@ def login():
             db.select(User).where(User.username == form.username.data)
         ).scalar()
 
-        if user is None or not user.check_password(form.password.data):
+        try:
+            valid = user is not None and user.check_password(form.password.data)
+        except HashingBusy:
+            flash('Serwer jest chwilowo przeciążony. Spróbuj zalogować się ponownie za chwilę.', 'warning')
+            return render_template('auth/login.html', form=form), 503, {'Retry-After': '5'}
+
+        if not valid:
             flash('Nieprawidłowy login lub hasło.', 'danger')
             return redirect(url_for('auth.login'))
 
+        db.session.commit()  # zapisuje ewentualnie przeliczony hasz
         login_user(user, remember=form.remember_me.data)
         
         next_page = request.args.get('next')
@@ -0,0 +1,36 @@
+import hashlib
+from datetime import date
+from flask import Blueprint, Response, abort, current_app, make_response, request
+from app.identity import verify_feed_token
+from app.routing import read_only
+from app.schedule_cache import SCHEDULE, CALENDAR_FEEDS, data_versions
+from app.sessions import FEED_KINDS, get_feed
+
+calendar_bp = Blueprint('calendar', __name__, url_prefix='/calendar')
+
+@calendar_bp.route('/<token>.ics')
+@read_only
+def feed(token):
+    """Kanał iCalendar bez logowania - adres z podpisanym tokenem działa jak hasło."""
+    identity = verify_feed_token(token)
+    if identity is None or identity[0] not in FEED_KINDS:
+        abort(404)
+    kind, person_id, secret = identity
+
+    # okno kanału przesuwa się z dniem, więc data jest częścią wersji
+    versions = data_versions(SCHEDULE, CALENDAR_FEEDS)
+    version = (versions[SCHEDULE].version, versions[CALENDAR_FEEDS].version, date.today())
+    etag = hashlib.sha1(f'{version}|{kind}|{person_id}|{secret}'.encode()).hexdigest()
+    max_age = current_app.config['CALENDAR_MAX_AGE']
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        chunks = get_feed(kind, person_id, secret, version)
+        if chunks is None:
+            abort(404)
+        response = Response(iter(chunks), mimetype='text/calendar')
+        response.content_length = sum(len(chunk) for chunk in chunks)
+        response.headers['Content-Disposition'] = f'inline; filename={kind}-{person_id}.ics'
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f'private, max-age={max_age}'
+    return response
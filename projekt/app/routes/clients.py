@@ -2,26 +2,36 @@ import functools
 import re
 
 from flask import (
-    Blueprint, flash, g, redirect, render_template, url_for
+    Blueprint, flash, g, redirect, render_template, request, url_for, abort
 )
-from app.db import db, Client, Membership, MembershipType
+from sqlalchemy.orm import selectinload
+from app.db import db, Client, Membership, MembershipType, GroupClass, refresh_membership_valid_until
 from app.routes.auth import employee_required
-from app.forms import AssignMembershipForm, RegistrationForm, PersonForm
-from app.services import create_user_with_profile, search
+from app.forms import AssignMembershipForm, RegistrationForm, PersonForm, BulkMembershipForm, BulkEnrollForm, GroupClassForm
+from app.services import (
+    create_user_with_profile, search, filter_active, paginate, parse_client_ids, bulk_assign_membership, bulk_enroll
+)
+from app.schedule_cache import invalidate_schedule
+from app.read_models import ClientRow, client_rows
+from app.routing import read_only
 
 clients_bp = Blueprint('clients', __name__, url_prefix='/client')
 
 @clients_bp.route('/')
+@read_only
 @employee_required
 def index():  # clients list
-    stmt = db.select(Client)
+    stmt = client_rows()
 
     search_columns = ['first_name', 'last_name', 'pesel', 'phone_number']
 
     stmt = search(stmt, search_columns, Client)
+    stmt = filter_active(stmt, Client)
+    if request.args.get('membership') == 'active':
+        stmt = stmt.where(Client.has_valid_membership)
 
-    clients = db.session.execute(stmt).scalars().all()
-    return render_template('clients/clients_list.html', clients=clients)
+    clients, next_cursor = paginate(stmt, [(Client.id, False)], ClientRow)
+    return render_template('clients/clients_list.html', clients=clients, next_cursor=next_cursor)
 
 @clients_bp.route('/add', methods=['GET', 'POST'])
 @employee_required
@@ -50,6 +60,7 @@ def edit_client(id: int):
     form = PersonForm(obj=client)
     if form.validate_on_submit():
         form.populate_obj(client)
+        invalidate_schedule()  # dane uczestników widoczne w szczegółach zajęć
         db.session.commit()
         flash('Zaktualizowano dane klienta', 'success')
         return redirect(url_for('clients.index'))
@@ -67,7 +78,12 @@ def delete_client(id: int):
 @clients_bp.route('/<int:id>/membership')
 @employee_required
 def view_membership(id: int): #select membership
-    client = db.get_or_404(Client, id)
+    client = db.session.execute(
+        db.select(Client).where(Client.id == id)
+        .options(selectinload(Client.memberships).joinedload(Membership.type))
+    ).scalar()
+    if client is None:
+        abort(404, f'Klient {id} nie istnieje')
     return render_template('clients/membership_info.html', client=client)
 
 @clients_bp.route('/<int:client_id>/membership/add', methods=['GET', 'POST'])
@@ -84,9 +100,70 @@ def add_membership(client_id: int):
         membership = Membership(
             start_date=form.start_date.data,
             client_id=client_id,
-            type_id=form.membership_type_id.data
+            type=db.session.get(MembershipType, form.membership_type_id.data)
         )
         db.session.add(membership)
+        client.extend_membership_valid_until(membership)
         db.session.commit()
         return redirect(url_for('clients.view_membership', id=client_id))
-    return render_template('clients/add_membership.html', form=form, client=client)
\ No newline at end of file
+    return render_template('clients/add_membership.html', form=form, client=client)
+
+@clients_bp.route('/<int:client_id>/membership/<int:membership_id>/delete', methods=['POST'])
+@employee_required
+def delete_membership(client_id: int, membership_id: int):
+    membership = db.session.execute(
+        db.select(Membership).where(Membership.id == membership_id, Membership.client_id == client_id)
+    ).scalar()
+    if membership is None:
+        abort(404, f'Karnet id {membership_id} nie istnieje')
+    membership.active = False
+    db.session.flush()
+    refresh_membership_valid_until(client_id)
+    db.session.commit()
+    flash('Anulowano karnet', 'success')
+    return redirect(url_for('clients.view_membership', id=client_id))
+
+
+def _preselect(form):
+    # zaznaczeni na liście klientów przychodzą jako ?client_ids=1&client_ids=2
+    if not form.is_submitted() and request.args.getlist('client_ids'):
+        form.client_ids.data = ', '.join(request.args.getlist('client_ids'))
+
+@clients_bp.route('/bulk/membership', methods=['GET', 'POST'])
+@employee_required
+def bulk_membership():
+    form = BulkMembershipForm()
+    form.membership_type_id.choices = [
+        (m.id, m.name) for m in db.session.execute(db.select(MembershipType).where(MembershipType.active == True)).scalars()
+    ]
+    _preselect(form)
+    if form.validate_on_submit():
+        success, message, results = bulk_assign_membership(
+            parse_client_ids(form.client_ids.data), form.membership_type_id.data, form.start_date.data
+        )
+        if success:
+            db.session.commit()
+        flash(message, 'success' if success else 'warning')
+        return render_template('clients/bulk_report.html', title='Sprzedaż grupowa karnetu', results=results)
+    return render_template('clients/bulk_membership.html', form=form)
+
+@clients_bp.route('/bulk/enroll', methods=['GET', 'POST'])
+@employee_required
+def bulk_enroll_clients():
+    form = BulkEnrollForm()
+    days = dict(GroupClassForm.day.kwargs['choices'])
+    form.group_class_id.choices = [
+        (c.id, f'{c.name} - {days[c.day]} {c.start_hour:%H:%M}')
+        for c in db.session.execute(
+            db.select(GroupClass.id, GroupClass.name, GroupClass.day, GroupClass.start_hour).order_by(GroupClass.day, GroupClass.start_hour)
+        )
+    ]
+    _preselect(form)
+    if form.validate_on_submit():
+        success, message, results = bulk_enroll(parse_client_ids(form.client_ids.data), form.group_class_id.data)
+        if success:
+            invalidate_schedule()
+            db.session.commit()
+        flash(message, 'success' if success else 'warning')
+        return render_template('clients/bulk_report.html', title='Grupowy zapis na zajęcia', results=results)
+    return render_template('clients/bulk_enroll.html', form=form)
@@ -0,0 +1,24 @@
+from datetime import date
+from flask import Blueprint, Response, abort, request, stream_with_context
+from app.exports import EXPORTS, export_rows
+from app.routes.auth import owner_required
+
+exports_bp = Blueprint('exports', __name__, url_prefix='/export')
+
+@exports_bp.route('/<name>.csv')
+@owner_required
+def export_csv(name):
+    if name not in EXPORTS:
+        abort(404, f'Eksport {name} nie istnieje')
+
+    rows = export_rows(
+        name,
+        active_only=request.args.get('active') == '1',
+        date_from=request.args.get('from', type=date.fromisoformat),
+        date_to=request.args.get('to', type=date.fromisoformat),
+    )
+    return Response(
+        stream_with_context(rows),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename={name}.csv'}
+    )
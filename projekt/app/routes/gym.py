@@ -1,24 +1,36 @@
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, session, url_for, Response
+    Blueprint, flash, g, redirect, render_template, request, session, url_for, Response, send_from_directory
 )
-from app.db import db, Client, Membership, MembershipType, Employee, Trainer, GroupClass
+from app.db import db, Person, Client, Membership, MembershipType, Employee, Trainer, GroupClass
 from flask_login import login_user, logout_user, login_required, current_user
 from app.routes.auth import employee_required, owner_required
 from app.forms import MembershipTypeForm, RegistrationForm, PersonForm, GroupClassForm, PersonDataForm
 from flask import abort
-from app.services import create_user_with_profile, search
+from sqlalchemy.orm import with_expression
+from app.services import create_user_with_profile, search, paginate, enroll, unenroll, CLASS_NOT_FOUND
+from app.profiling import request_profiler
+from app.schedule_cache import schedule_version, invalidate_schedule, get_classes, get_class, not_modified, conditional
+from app.read_models import StaffRow, staff_rows
+from app.timetable import get_index, conflict_message
+from app.routing import read_only
 
 gym_bp = Blueprint('gym', __name__, url_prefix='/')
 
 @gym_bp.route('/membership/type')
+@read_only
 @employee_required
 def view_membership_types():
-    stmt = db.select(MembershipType).order_by(MembershipType.active.desc())
+    active_count = (
+        db.select(db.func.count(Membership.id))
+        .where(Membership.type_id == MembershipType.id, Membership.is_active)
+        .scalar_subquery()
+    )
+    stmt = db.select(MembershipType).options(with_expression(MembershipType.active_memberships, active_count))
     search_columns = ['name', 'price']
     stmt = search(stmt, search_columns, MembershipType)
 
-    mem_types = db.session.execute(stmt).scalars().all()
-    return render_template('gym/view_membership_types.html', mem_types=mem_types)
+    mem_types, next_cursor = paginate(stmt, [(MembershipType.active, True), (MembershipType.id, False)])
+    return render_template('gym/view_membership_types.html', mem_types=mem_types, next_cursor=next_cursor)
 
 @gym_bp.route('/membership/type/add', methods=['GET', 'POST'])
 @owner_required
@@ -66,16 +78,17 @@ def edit_membership_type(id: int):
 
 
 @gym_bp.route('/employee')
+@read_only
 @owner_required
 def view_employees():
-    stmt = db.select(Employee).order_by(Employee.active.desc())
+    stmt = staff_rows('employee')
 
     search_columns = ['first_name', 'last_name', 'pesel', 'phone_number']
 
-    stmt = search(stmt, search_columns, Employee)
+    stmt = search(stmt, search_columns, Person)
 
-    employees = db.session.execute(stmt).scalars().all()
-    return render_template('gym/view_employees.html', employees=employees)
+    employees, next_cursor = paginate(stmt, [(Person.active, True), (Person.id, False)], StaffRow)
+    return render_template('gym/view_employees.html', employees=employees, next_cursor=next_cursor)
 
 @gym_bp.route('/employee/<int:id>')
 @owner_required
@@ -128,13 +141,14 @@ def edit_employee(id: int):
 
 
 @gym_bp.route('/trainer')
+@read_only
 def view_trainers():
-    stmt = db.select(Trainer).order_by(Trainer.active.desc())
+    stmt = staff_rows('trainer')
     search_columns = ['first_name', 'last_name', 'pesel', 'phone_number']
-    stmt = search(stmt, search_columns, Trainer)
+    stmt = search(stmt, search_columns, Person)
 
-    trainers = db.session.execute(stmt).scalars().all()
-    return render_template('gym/view_trainers.html', trainers=trainers)
+    trainers, next_cursor = paginate(stmt, [(Person.active, True), (Person.id, False)], StaffRow)
+    return render_template('gym/view_trainers.html', trainers=trainers, next_cursor=next_cursor)
 
 @gym_bp.route('/trainer/<int:id>')
 def view_trainer(id):
@@ -174,6 +188,7 @@ def edit_trainer(id: int):
     form = PersonForm(obj=trainer)
     if form.validate_on_submit():
         form.populate_obj(trainer)
+        invalidate_schedule()
         db.session.commit()
         flash('Zaktualizowano dane trenera', 'success')
         return redirect(url_for('gym.view_trainers'))
@@ -181,28 +196,32 @@ def edit_trainer(id: int):
 
 
 @gym_bp.route('/classes')
+@read_only
 def view_classes():
     trainer_id = request.args.get('trainer_id', type=int)
     client_id = request.args.get('client_id', type=int)
-    
-    stmt = db.select(GroupClass)
-    
-    if client_id:
-        stmt = stmt.join(GroupClass.participations).where(Participation.client_id == client_id)
 
-    if trainer_id:
-        stmt = stmt.where(GroupClass.trainer_id == trainer_id)
+    version = schedule_version()
+    response = not_modified(version)
+    if response is not None:
+        return response
 
-    stmt = stmt.order_by(GroupClass.day, GroupClass.start_hour)
-
-    classes = db.session.execute(stmt).scalars().all()
+    classes = get_classes(version, trainer_id=trainer_id, client_id=client_id)
     
-    return render_template('gym/view_classes.html', classes=classes)
+    return conditional(version, render_template('gym/view_classes.html', classes=classes))
 
 @gym_bp.route('/classes/<int:id>')
+@read_only
 def view_class(id: int):
-    group_class = db.get_or_404(GroupClass, id)
-    return render_template('gym/view_class.html', group_class=group_class)
+    version = schedule_version()
+    response = not_modified(version)
+    if response is not None:
+        return response
+
+    group_class = get_class(version, id)
+    if group_class is None:
+        abort(404)
+    return conditional(version, render_template('gym/view_class.html', group_class=group_class))
 
 @gym_bp.route('/classes/add', methods=['GET', 'POST'])
 @employee_required
@@ -217,15 +236,23 @@ def add_class():
         (t.id, f"{t.first_name} {t.last_name}") for t in active_trainers
     ]
     if form.validate_on_submit():
+        conflict = conflict_message(
+            get_index(schedule_version()), form.trainer_id.data, form.day.data, form.start_hour.data, form.length.data
+        )
+        if conflict:
+            form.start_hour.errors.append(conflict)
+            return render_template('gym/add_class.html', form=form)
         new_class = GroupClass(
             name=form.name.data,
             day=form.day.data,
             start_hour=form.start_hour.data,
             length=form.length.data,
+            capacity=form.capacity.data,
             trainer_id=form.trainer_id.data
         )
         
         db.session.add(new_class)
+        invalidate_schedule()
         db.session.commit()
         
         flash(f'Dodano zajęcia "{new_class.name}" do grafiku.', 'success')
@@ -239,6 +266,7 @@ def add_class():
 def delete_class(id: int):
     group_class = db.get_or_404(GroupClass, id)
     db.session.delete(group_class)
+    invalidate_schedule()
     db.session.commit()
     return redirect(url_for('gym.view_classes'))
 
@@ -252,10 +280,20 @@ def edit_class(id: int):
     form.trainer_id.choices = [(t.id, f'{t.first_name} {t.last_name}') for t in active_trainers]
 
     if form.validate_on_submit():
-        form.populate_obj(group_class)
-        db.session.commit()
-        flash('Zaktualizowano dane zajęć grupowych', 'success')
-        return redirect(url_for('gym.view_classes'))
+        conflict = conflict_message(
+            get_index(schedule_version()), form.trainer_id.data, form.day.data, form.start_hour.data, form.length.data,
+            exclude_id=group_class.id
+        )
+        if form.capacity.data < group_class.participant_count:
+            form.capacity.errors.append(f'Na zajęcia zapisanych jest już {group_class.participant_count} osób.')
+        elif conflict:
+            form.start_hour.errors.append(conflict)
+        else:
+            form.populate_obj(group_class)
+            invalidate_schedule()
+            db.session.commit()
+            flash('Zaktualizowano dane zajęć grupowych', 'success')
+            return redirect(url_for('gym.view_classes'))
     return render_template('gym/edit_class.html', form=form, group_class=group_class)
 
 from app.db import Participation # Pamiętaj o imporcie modelu Participation!
@@ -269,26 +307,21 @@ def join_class(id):
 
     client = current_user.person_profile #
 
-    has_active_membership = any(m.is_active for m in client.memberships)
-    
-    if not has_active_membership:
+    if not client.has_valid_membership:
         flash('Nie możesz się zapisać. Nie masz aktywnego karnetu!', 'danger')
         return redirect(url_for('gym.view_classes'))
 
-    already_joined = any(p.group_class_id == id for p in client.participations)
-    
-    if already_joined:
-        flash('Jesteś już zapisany na te zajęcia.', 'info')
+    success, message = enroll(client.id, id)
+    if message == CLASS_NOT_FOUND:
+        abort(404, f'Zajęcia {id} nie istnieją')
+    if not success:
+        flash(message, 'info')
         return redirect(url_for('gym.view_classes'))
 
-    participation = Participation(
-        client_id=client.id,
-        group_class_id=id
-    )
-    db.session.add(participation)
+    invalidate_schedule()
     db.session.commit()
     
-    flash('Pomyślnie zapisano na zajęcia!', 'success')
+    flash(message, 'success')
     return redirect(request.referrer or url_for('gym.view_classes'))
 
 
@@ -298,20 +331,31 @@ def leave_class(id):
     if current_user.role != 'client':
         return redirect(url_for('gym.view_classes'))
 
-    client = current_user.person_profile
-
-    participation = db.session.execute(
-        db.select(Participation).where(
-            Participation.client_id == client.id,
-            Participation.group_class_id == id
-        )
-    ).scalar()
-
-    if participation:
-        db.session.delete(participation)
+    if unenroll(current_user.profile_id, id):
+        invalidate_schedule()
         db.session.commit()
         flash('Wypisano z zajęć.', 'info')
     else:
         flash('Nie byłeś zapisany na te zajęcia.', 'warning')
 
-    return redirect(request.referrer or url_for('gym.view_classes'))
\ No newline at end of file
+    return redirect(request.referrer or url_for('gym.view_classes'))
+
+
+@gym_bp.route('/profiles')
+@owner_required
+def view_profiles():
+    return render_template('gym/view_profiles.html', profiles=request_profiler.recent())
+
+@gym_bp.route('/profiles/<name>')
+@owner_required
+def view_profile(name):
+    profile = request_profiler.load(name)
+    if profile is None:
+        abort(404, f'Profil {name} nie istnieje')
+    meta, top_functions = profile
+    return render_template('gym/view_profile.html', profile=meta, top_functions=top_functions)
+
+@gym_bp.route('/profiles/<name>/<any(prof, folded):kind>')
+@owner_required
+def download_profile(name, kind):
+    return send_from_directory(request_profiler.directory, f'{name}.{kind}', as_attachment=True)
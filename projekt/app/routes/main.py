@@ -1,10 +1,18 @@
-from flask import Blueprint, render_template
+from datetime import date
+from flask import Blueprint, flash, redirect, render_template, request, url_for
 
-from flask_login import current_user
-from app.db import db, MembershipType
+from flask_login import current_user, login_required
+from app.db import db, MembershipType, Person, new_feed_secret
+from app.rollups import dashboard
+from app.identity import issue_feed_token
 
 main_bp = Blueprint('main', __name__, url_prefix='/')
 
+def _calendar_url():
+    secret = db.session.scalar(db.select(Person.feed_secret).where(Person.id == current_user.profile_id))
+    token = issue_feed_token(current_user.role, current_user.profile_id, secret)
+    return url_for('calendar.feed', token=token, _external=True)
+
 @main_bp.route('')
 def index():
     if not current_user.is_authenticated:
@@ -13,10 +21,26 @@ def index():
     if current_user.role == 'employee':
         return render_template('main/employee.html')
     if current_user.role == 'trainer':
-        return render_template('main/trainer.html')
+        return render_template('main/trainer.html', calendar_url=_calendar_url())
     if current_user.role == 'client':
-        return render_template('main/client.html')
+        return render_template('main/client.html', calendar_url=_calendar_url())
     if current_user.role == 'owner':
-        return render_template('main/owner.html')
+        date_to = request.args.get('to', type=date.fromisoformat) or date.today()
+        date_from = request.args.get('from', type=date.fromisoformat) or date_to.replace(day=1)
+        if date_from > date_to:
+            date_from, date_to = date_to, date_from
+        return render_template('main/owner.html', stats=dashboard(date_from, date_to), date_from=date_from, date_to=date_to)
     else:
-        return render_template('main/default.html')
\ No newline at end of file
+        return render_template('main/default.html')
+
+@main_bp.route('calendar/reset', methods=['POST'])
+@login_required
+def reset_calendar():
+    if current_user.role not in ('trainer', 'client') or current_user.profile_id is None:
+        return redirect(url_for('main.index'))
+
+    person = db.session.get(Person, current_user.profile_id)
+    person.feed_secret = new_feed_secret()
+    db.session.commit()
+    flash('Wygenerowano nowy adres kalendarza - poprzedni przestał działać.', 'info')
+    return redirect(url_for('main.index'))
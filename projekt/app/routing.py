@@ -0,0 +1,54 @@
+import functools
+from flask import current_app
+from flask_sqlalchemy.session import Session
+from sqlalchemy.engine import make_url
+from sqlalchemy.sql.dml import UpdateBase
+
+# klucz w SQLALCHEMY_BINDS puli połączeń tylko do odczytu
+READ_BIND = 'read'
+
+class RoutingSession(Session):
+    """Sesja kierująca zapytania widoków @read_only do puli odczytu.
+
+    Zapisy (flush oraz INSERT / UPDATE / DELETE wykonywane wprost) zawsze idą do bazy głównej,
+    więc widok oznaczony przez pomyłkę nie psuje danych - co najwyżej nie odciąża bazy głównej.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.info.get('read_only') and not self._flushing and not isinstance(clause, UpdateBase):
+            engine = self._db.engines.get(READ_BIND)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+def read_only(view):
+    """Widok tylko czytający dane - jego zapytania obsługuje pula odczytu (replika / SQLite mode=ro)."""
+    @functools.wraps(view)
+    def wrapped_view(*args, **kwargs):
+        session = current_app.extensions['sqlalchemy'].session
+        session.info['read_only'] = True
+        try:
+            return view(*args, **kwargs)
+        finally:
+            session.info.pop('read_only', None)
+    return wrapped_view
+
+def read_url(config):
+    """Adres puli odczytu: DATABASE_READ_URL, a dla pliku SQLite ten sam plik w trybie mode=ro; None - bez podziału."""
+    if not config['DATABASE_READ_ROUTING']:
+        return None
+    if config.get('DATABASE_READ_URL'):
+        return config['DATABASE_READ_URL']
+    primary = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if primary.get_backend_name() != 'sqlite' or primary.database in (None, '', ':memory:') or 'uri' in primary.query:
+        return None
+    return primary.set(database=f'file:{primary.database}', query={**primary.query, 'mode': 'ro', 'uri': 'true'})
+
+def configure_read_bind(app):
+    """Dopisuje pulę odczytu do SQLALCHEMY_BINDS - przed db.init_app, który tworzy silniki."""
+    url = read_url(app.config)
+    if url is None:
+        return
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    binds[READ_BIND] = {'url': url, 'pool_size': app.config['DATABASE_READ_POOL_SIZE']}
+    app.config['SQLALCHEMY_BINDS'] = binds
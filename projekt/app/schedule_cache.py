@@ -0,0 +1,146 @@
+import hashlib
+from collections import namedtuple
+from datetime import datetime, timezone
+from flask import request, session, make_response
+from flask_login import current_user
+from sqlalchemy import event
+from app.db import db, CacheVersion, GroupClass, Trainer, Participation, Client, Membership, MembershipType
+from app.cache import LRUCache
+
+ScheduledTrainer = namedtuple('ScheduledTrainer', 'id first_name last_name')
+ScheduledClass = namedtuple('ScheduledClass', 'id name day start_hour length capacity participant_count trainer participant_ids participants')
+Participant = namedtuple('Participant', 'client_id first_name last_name phone_number')
+
+# nazwy liczników w cache_version
+SCHEDULE = 'schedule'
+MEMBERSHIPS = 'memberships'
+MEMBERSHIP_TYPES = 'membership_types'
+CALENDAR_FEEDS = 'calendar_feeds'  # dostęp do kanałów iCalendar (aktywność i sekret osoby)
+IDENTITIES = 'identities'  # role i aktywność kont - identity_cache innych procesów
+
+DataVersion = namedtuple('DataVersion', 'version updated_at')
+
+_entries = LRUCache(max_size=512)
+
+def data_versions(*names):
+    """{nazwa: DataVersion} dla podanych liczników jednym zapytaniem (brak wiersza - wersja 0)."""
+    rows = db.session.execute(
+        db.select(CacheVersion.name, CacheVersion.version, CacheVersion.updated_at).where(CacheVersion.name.in_(names))
+    )
+    versions = {name: DataVersion(0, None) for name in names}
+    for name, version, updated_at in rows:
+        versions[name] = DataVersion(version, updated_at)
+    return versions
+
+def bump_version(name, connection=None):
+    """Podbija licznik w bieżącej transakcji. `connection` - wywołanie ze zdarzenia mappera (w trakcie flush)."""
+    connection = connection if connection is not None else db.session.connection()
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    updated = connection.execute(
+        db.update(CacheVersion).where(CacheVersion.name == name).values(version=CacheVersion.version + 1, updated_at=now)
+    ).rowcount
+    if not updated:
+        connection.execute(db.insert(CacheVersion).values(name=name, version=1, updated_at=now))
+
+def schedule_version():
+    return data_versions(SCHEDULE)[SCHEDULE].version
+
+def invalidate_schedule():
+    """Podbija wersję grafiku w bieżącej transakcji - wywoływać przed commitem każdej zmiany grafiku."""
+    bump_version(SCHEDULE)
+
+# karnety i typy karnetów zmieniane są w wielu miejscach - licznik podbijają zdarzenia mappera
+# (wstawianie wsadowe w imporcie klientów robi to samo ręcznie)
+@event.listens_for(Membership, 'after_insert')
+@event.listens_for(Membership, 'after_update')
+@event.listens_for(Membership, 'after_delete')
+def _membership_changed(mapper, connection, target):
+    bump_version(MEMBERSHIPS, connection)
+
+@event.listens_for(MembershipType, 'after_insert')
+@event.listens_for(MembershipType, 'after_update')
+@event.listens_for(MembershipType, 'after_delete')
+def _membership_type_changed(mapper, connection, target):
+    bump_version(MEMBERSHIP_TYPES, connection)
+    bump_version(MEMBERSHIPS, connection)  # nazwa typu jest częścią danych karnetu
+
+def cached(key, version, load):
+    """Wartość z pamięci podręcznej procesu, ważna, dopóki nie zmieni się podana wersja."""
+    entry = _entries.get(key)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    value = load()
+    _entries.set(key, (version, value))
+    return value
+
+def _load_classes(class_ids=None, trainer_id=None, client_id=None, with_participants=False):
+    stmt = db.select(
+        GroupClass.id, GroupClass.name, GroupClass.day, GroupClass.start_hour, GroupClass.length,
+        GroupClass.capacity, GroupClass.participant_count, Trainer.id, Trainer.first_name, Trainer.last_name
+    ).join(GroupClass.trainer)
+
+    if class_ids is not None:
+        stmt = stmt.where(GroupClass.id.in_(class_ids))
+    if client_id:
+        stmt = stmt.where(GroupClass.id.in_(
+            db.select(Participation.group_class_id).where(Participation.client_id == client_id)
+        ))
+    if trainer_id:
+        stmt = stmt.where(GroupClass.trainer_id == trainer_id)
+    stmt = stmt.order_by(GroupClass.day, GroupClass.start_hour)
+    rows = db.session.execute(stmt).all()
+
+    participants = {row[0]: [] for row in rows}
+    if rows:
+        columns = [Participation.group_class_id, Participation.client_id]
+        if with_participants:
+            columns += [Client.first_name, Client.last_name, Client.phone_number]
+        participants_stmt = db.select(*columns).where(Participation.group_class_id.in_(list(participants)))
+        if with_participants:
+            participants_stmt = participants_stmt.join(Client, Client.id == Participation.client_id)
+        for row in db.session.execute(participants_stmt):
+            participants[row[0]].append(row[1:])
+
+    return [
+        ScheduledClass(
+            id=row[0], name=row[1], day=row[2], start_hour=row[3], length=row[4],
+            capacity=row[5], participant_count=row[6], trainer=ScheduledTrainer(*row[7:10]),
+            participant_ids=frozenset(p[0] for p in participants[row[0]]),
+            participants=tuple(Participant(*p) for p in participants[row[0]]) if with_participants else (),
+        )
+        for row in rows
+    ]
+
+def get_classes(version, trainer_id=None, client_id=None):
+    return cached(('classes', trainer_id, client_id), version,
+                   lambda: _load_classes(trainer_id=trainer_id, client_id=client_id))
+
+def get_class(version, id):
+    classes = cached(('class', id), version, lambda: _load_classes(class_ids=[id], with_participants=True))
+    return classes[0] if classes else None
+
+def _etag(version):
+    # strona zależy od danych grafiku i od zalogowanego użytkownika (rola, przyciski, powitanie)
+    if current_user.is_authenticated:
+        user_key = f'{current_user.id}:{current_user.role}:{current_user.profile_id}:{current_user.first_name}'
+    else:
+        user_key = 'anonymous'
+    key = f'{version}|{request.full_path}|{user_key}'
+    return hashlib.sha1(key.encode()).hexdigest()
+
+def not_modified(version):
+    """Odpowiedź 304, jeśli klient ma aktualną wersję strony - inaczej None."""
+    if '_flashes' in session:
+        return None
+    etag = _etag(version)
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+    return None
+
+def conditional(version, body):
+    response = make_response(body)
+    response.set_etag(_etag(version))
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
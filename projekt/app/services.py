@@ -1,5 +1,15 @@
-from app.db import db, User, Client, Trainer, Employee
-from flask import request
+import re
+from collections import Counter, namedtuple
+from app.db import (
+    db, User, Person, Client, Trainer, Employee, GroupClass, Participation, Membership, MembershipType,
+    person_fts, fold_text, refresh_membership_valid_until
+)
+from sqlalchemy.dialects import postgresql, sqlite
+from app.passwords import HashingBusy
+from app.rollups import record_enrolment, apply_deltas, membership_deltas
+from app.schedule_cache import MEMBERSHIPS, bump_version
+from flask import request, current_app
+from datetime import date
 
 def create_user_with_profile(form_data, role):
     try:
@@ -41,6 +51,9 @@ def create_user_with_profile(form_data, role):
         db.session.commit()
         return True, "Konto zostało utworzone pomyślnie."
 
+    except HashingBusy:
+        db.session.rollback()
+        return False, "Serwer jest chwilowo przeciążony. Spróbuj ponownie za chwilę."
     except Exception as e:
         db.session.rollback()
         return False, f"Błąd bazy danych: {str(e)}"
@@ -48,6 +61,9 @@ def create_user_with_profile(form_data, role):
 def search(stmt, search_columns, table):
     search_query = request.args.get('search')
 
+    if search_query and issubclass(table, Person) and db.engine.dialect.name == 'sqlite':
+        return stmt.where(table.id.in_(_person_search_ids(search_query)))
+
     if search_query:
         search_terms = search_query.split()
         
@@ -61,3 +77,245 @@ def search(stmt, search_columns, table):
 
             stmt = stmt.where(db.or_(*or_filters))
     return stmt
+
+def _person_search_ids(search_query):
+    ids = db.select(person_fts.c.rowid)
+    for term in fold_text(search_query).split():
+        term = term.replace('%', '').replace('_', '')
+        if term:
+            ids = ids.where(person_fts.c.content.like(f'%{term}%'))
+    return ids
+
+def filter_active(stmt, table, default='active'):
+    status = request.args.get('status', default)
+
+    if status == 'active':
+        stmt = stmt.where(table.active == True)
+    elif status == 'inactive':
+        stmt = stmt.where(table.active == False)
+    return stmt
+
+def _seek_filter(col, value, descending):
+    if isinstance(value, bool):
+        # kolumny logiczne mają tylko dwie wartości - "za" True jest tylko False i odwrotnie
+        return col == (not value) if value == descending else db.false()
+    return col < value if descending else col > value
+
+def paginate(stmt, sort_keys, row_type=None):
+    """Keyset (seek) pagination. sort_keys to lista par (kolumna, malejąco).
+    Z row_type (namedtuple) zapytanie wybiera kolumny, a wynikiem są wiersze tego typu zamiast encji."""
+    page_size = request.args.get('page_size', type=int) or current_app.config['PAGE_SIZE']
+    page_size = max(1, min(page_size, current_app.config['MAX_PAGE_SIZE']))
+
+    after = request.args.get('after')
+    if after:
+        try:
+            values = [col.type.python_type(int(v)) for (col, _), v in zip(sort_keys, after.split('.'), strict=True)]
+        except ValueError:
+            values = None
+
+        if values is not None:
+            seek_filters = []
+            for i, ((col, descending), value) in enumerate(zip(sort_keys, values)):
+                prefix = [c == v for (c, _), v in zip(sort_keys[:i], values[:i])]
+                seek_filters.append(db.and_(*prefix, _seek_filter(col, value, descending)))
+            stmt = stmt.where(db.or_(*seek_filters))
+
+    stmt = stmt.order_by(*[col.desc() if descending else col.asc() for col, descending in sort_keys])
+    result = db.session.execute(stmt.limit(page_size + 1))
+    items = [row_type._make(row) for row in result] if row_type is not None else result.scalars().all()
+
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        next_cursor = '.'.join(str(int(getattr(items[-1], col.key))) for col, _ in sort_keys)
+    return items, next_cursor
+
+
+def _upsert_insert(table):
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql.insert(table)
+    return sqlite.insert(table)
+
+# komunikat enroll / bulk_enroll dla nieistniejących zajęć - widoki zamieniają go na 404
+CLASS_NOT_FOUND = 'Zajęcia nie istnieją.'
+
+def enroll(client_id, group_class_id):
+    """Zapis na zajęcia jednym warunkowym INSERT-em - limit miejsc i unikalność pilnuje baza."""
+    has_seat = db.exists().where(GroupClass.id == group_class_id, GroupClass.participant_count < GroupClass.capacity)
+    inserted = db.session.execute(
+        _upsert_insert(Participation.__table__)
+        .from_select(
+            ['client_id', 'group_class_id', 'created_on'],
+            db.select(db.literal(client_id), db.literal(group_class_id), db.literal(date.today())).where(has_seat)
+        )
+        .on_conflict_do_nothing(index_elements=['client_id', 'group_class_id'])
+    ).rowcount
+
+    if inserted:
+        # licznik zwiększany tylko póki jest miejsce - chroni przed wyścigiem na bazach z wieloma piszącymi
+        reserved = db.session.execute(
+            db.update(GroupClass)
+            .where(GroupClass.id == group_class_id, GroupClass.participant_count < GroupClass.capacity)
+            .values(participant_count=GroupClass.participant_count + 1)
+        ).rowcount
+        if reserved:
+            record_enrolment(date.today(), group_class_id)
+            return True, 'Pomyślnie zapisano na zajęcia!'
+        db.session.rollback()
+        return False, 'Brak wolnych miejsc na te zajęcia.'
+
+    class_exists, already_joined = db.session.execute(db.select(
+        db.exists().where(GroupClass.id == group_class_id),
+        db.exists().where(Participation.client_id == client_id, Participation.group_class_id == group_class_id),
+    )).one()
+    if not class_exists:
+        return False, CLASS_NOT_FOUND
+    if already_joined:
+        return False, 'Jesteś już zapisany na te zajęcia.'
+    return False, 'Brak wolnych miejsc na te zajęcia.'
+
+def unenroll(client_id, group_class_id):
+    deleted = db.session.execute(
+        db.delete(Participation).where(Participation.client_id == client_id, Participation.group_class_id == group_class_id)
+        .returning(Participation.created_on)
+    ).scalars().all()
+    for created_on in deleted:
+        record_enrolment(created_on, group_class_id, -1)
+    if deleted:
+        db.session.execute(
+            db.update(GroupClass).where(GroupClass.id == group_class_id)
+            .values(participant_count=GroupClass.participant_count - len(deleted))
+        )
+    return bool(deleted)
+
+BULK_MAX_CLIENTS = 500
+# największa wartość mieszcząca się w kolumnie INTEGER SQLite
+CLIENT_ID_MAX = 2**63 - 1
+
+# wiersz raportu operacji grupowej
+BulkResult = namedtuple('BulkResult', 'client_id name success message')
+
+def parse_client_ids(text):
+    """Numery klientów z dowolnego tekstu (przecinki, spacje, nowe linie) - bez powtórzeń, w kolejności podania."""
+    return list(dict.fromkeys(int(number) for number in re.findall(r'\d+', text or '')))
+
+def _bulk_clients(client_ids):
+    rows = db.session.execute(
+        db.select(Client.id, Client.first_name, Client.last_name, Client.active, Client.membership_valid_until)
+        .where(Client.id.in_(client_ids))
+    )
+    return {row.id: row for row in rows}
+
+def _client_problem(client):
+    if client is None:
+        return 'Klient nie istnieje.'
+    if not client.active:
+        return 'Konto klienta jest usunięte.'
+    return None
+
+def _name(client):
+    return f'{client.first_name} {client.last_name}' if client is not None else ''
+
+def bulk_assign_membership(client_ids, type_id, start_date):
+    """Sprzedaż jednego typu karnetu wielu klientom jednym INSERT-em (bez commitu).
+
+    Sprawdzenia są zbiorcze: jedno zapytanie o klientów i jedno o istniejące karnety tego typu z tą samą datą startu.
+    Zwraca (sukces, komunikat, lista BulkResult).
+    """
+    mem_type = db.session.get(MembershipType, type_id)
+    if mem_type is None or not mem_type.active:
+        return False, 'Wybrany karnet nie jest dostępny.', []
+
+    clients = _bulk_clients(client_ids)
+    duplicates = set(db.session.scalars(
+        db.select(Membership.client_id).where(
+            Membership.client_id.in_(client_ids), Membership.type_id == type_id,
+            Membership.start_date == start_date, Membership.active == True
+        )
+    ))
+    results, accepted = [], []
+    for client_id in client_ids:
+        client = clients.get(client_id)
+        problem = _client_problem(client)
+        if problem is None and client_id in duplicates:
+            problem = 'Klient ma już ten karnet z tą datą rozpoczęcia.'
+        if problem is None:
+            accepted.append(client_id)
+        results.append(BulkResult(client_id, _name(client), problem is None, problem or 'Sprzedano karnet.'))
+    if not accepted:
+        return False, 'Żaden klient nie spełnia warunków.', results
+
+    db.session.execute(db.insert(Membership), [
+        {'client_id': client_id, 'type_id': type_id, 'price': mem_type.price, 'start_date': start_date, 'active': True}
+        for client_id in accepted
+    ])
+    # wstawianie wsadowe pomija zdarzenia mappera - statystyki, ważność karnetów i wersję danych API aktualizujemy sami
+    deltas = Counter()
+    for _ in accepted:
+        membership_deltas(start_date, type_id, mem_type.price, mem_type.duration, True, deltas=deltas)
+    apply_deltas(db.session.connection(), deltas)
+    refresh_membership_valid_until(accepted)
+    bump_version(MEMBERSHIPS)
+    return True, f'Sprzedano karnet {mem_type.name} {len(accepted)} z {len(client_ids)} klientów.', results
+
+def bulk_enroll(client_ids, group_class_id):
+    """Zapis wielu klientów na jedne zajęcia jednym INSERT-em (bez commitu) - kolejność listy decyduje o wolnych miejscach.
+
+    Zwraca (sukces, komunikat, lista BulkResult).
+    """
+    group_class = db.session.execute(
+        db.select(GroupClass.name, GroupClass.capacity, GroupClass.participant_count).where(GroupClass.id == group_class_id)
+    ).first()
+    if group_class is None:
+        return False, CLASS_NOT_FOUND, []
+
+    today = date.today()
+    clients = _bulk_clients(client_ids)
+    enrolled = set(db.session.scalars(
+        db.select(Participation.client_id)
+        .where(Participation.group_class_id == group_class_id, Participation.client_id.in_(client_ids))
+    ))
+    free = group_class.capacity - group_class.participant_count
+    results, accepted = [], []
+    for client_id in client_ids:
+        client = clients.get(client_id)
+        problem = _client_problem(client)
+        if problem is None and (client.membership_valid_until is None or client.membership_valid_until < today):
+            problem = 'Klient nie ma aktywnego karnetu.'
+        if problem is None and client_id in enrolled:
+            problem = 'Klient jest już zapisany na te zajęcia.'
+        if problem is None and len(accepted) >= free:
+            problem = 'Brak wolnych miejsc na te zajęcia.'
+        if problem is None:
+            accepted.append(client_id)
+        results.append(BulkResult(client_id, _name(client), problem is None, problem or 'Zapisano na zajęcia.'))
+    if not accepted:
+        return False, 'Nikogo nie zapisano.', results
+
+    inserted = set(db.session.scalars(
+        _upsert_insert(Participation.__table__)
+        .values([{'client_id': client_id, 'group_class_id': group_class_id, 'created_on': today} for client_id in accepted])
+        .on_conflict_do_nothing(index_elements=['client_id', 'group_class_id'])
+        .returning(Participation.__table__.c.client_id)
+    ))
+    # miejsca rezerwowane warunkowo, jak w enroll - chroni przed równoległym zapisem na te same zajęcia
+    reserved = db.session.execute(
+        db.update(GroupClass)
+        .where(GroupClass.id == group_class_id, GroupClass.participant_count + len(inserted) <= GroupClass.capacity)
+        .values(participant_count=GroupClass.participant_count + len(inserted))
+    ).rowcount
+    if not reserved:
+        db.session.rollback()
+        results = [
+            r._replace(success=False, message='Brak wolnych miejsc na te zajęcia.') if r.success else r for r in results
+        ]
+        return False, 'Miejsca zostały zajęte w międzyczasie - nikogo nie zapisano.', results
+
+    results = [
+        r._replace(success=False, message='Klient jest już zapisany na te zajęcia.')
+        if r.success and r.client_id not in inserted else r
+        for r in results
+    ]
+    record_enrolment(today, group_class_id, len(inserted))
+    return bool(inserted), f'Zapisano {len(inserted)} z {len(client_ids)} klientów na zajęcia {group_class.name}.', results
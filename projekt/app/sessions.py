@@ -0,0 +1,193 @@
+from datetime import date, datetime, time, timedelta, timezone
+import click
+from flask import current_app
+from sqlalchemy import Date, DateTime, ForeignKey, Index, UniqueConstraint, event
+from sqlalchemy.orm import Mapped, mapped_column
+from sqlalchemy.dialects import postgresql, sqlite
+from app.db import db, GroupClass, Person, Trainer, Participation
+from app.jobs import periodic
+from app.cache import LRUCache
+from app.schedule_cache import CALENDAR_FEEDS, bump_version
+
+class ClassSession(db.Model):
+    """Konkretne terminy zajęć z tygodniowego szablonu GroupClass - od SESSION_KEEP_DAYS wstecz do SESSION_HORIZON_DAYS naprzód."""
+    __tablename__ = "class_session"
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    group_class_id: Mapped[int] = mapped_column(ForeignKey("group_class.id"), nullable=False)
+    date: Mapped[date] = mapped_column(Date, nullable=False)
+    starts_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)  # czas lokalny siłowni
+    ends_at: Mapped[datetime] = mapped_column(DateTime, nullable=False)
+
+    # ograniczenie zaczyna się od group_class_id, więc służy też jako indeks klucza obcego
+    __table_args__ = (
+        UniqueConstraint('group_class_id', 'date', name='uq_class_session_class_date'),
+        Index('ix_class_session_starts_at', 'starts_at'),
+    )
+
+def _insert(connection):
+    insert = postgresql.insert if connection.dialect.name == 'postgresql' else sqlite.insert
+    return insert(ClassSession.__table__).on_conflict_do_nothing(index_elements=['group_class_id', 'date'])
+
+def session_rows(group_class_id, day, start_hour, length, date_from, date_to):
+    """Wiersze class_session dla terminów zajęć w [date_from, date_to)."""
+    first = date_from + timedelta(days=(day - date_from.weekday()) % 7)
+    rows = []
+    for offset in range(0, (date_to - first).days, 7):
+        day_date = first + timedelta(days=offset)
+        starts_at = datetime.combine(day_date, start_hour)
+        rows.append({'group_class_id': group_class_id, 'date': day_date,
+                     'starts_at': starts_at, 'ends_at': starts_at + timedelta(minutes=length)})
+    return rows
+
+def _horizon():
+    today = date.today()
+    return today, today + timedelta(days=current_app.config['SESSION_HORIZON_DAYS'])
+
+def materialize_sessions():
+    """Uzupełnia terminy wszystkich zajęć do końca horyzontu i usuwa najstarsze. Zwraca liczbę dodanych wierszy.
+
+    Istniejące terminy zostają (ON CONFLICT DO NOTHING), więc codzienne wywołanie dopisuje tylko nowy dzień.
+    """
+    connection = db.session.connection()
+    date_from, date_to = _horizon()
+    rows = []
+    for class_id, day, start_hour, length in db.session.execute(
+        db.select(GroupClass.id, GroupClass.day, GroupClass.start_hour, GroupClass.length)
+    ):
+        rows.extend(session_rows(class_id, day, start_hour, length, date_from, date_to))
+    added = connection.execute(_insert(connection), rows).rowcount if rows else 0
+    cutoff = date_from - timedelta(days=current_app.config['SESSION_KEEP_DAYS'])
+    db.session.execute(db.delete(ClassSession).where(ClassSession.date < cutoff))
+    return added
+
+def _resync(connection, target):
+    """Przyszłe terminy jednych zajęć od nowa - przeszłe zostają takie, jakie się odbyły."""
+    date_from, date_to = _horizon()
+    connection.execute(
+        db.delete(ClassSession).where(ClassSession.group_class_id == target.id, ClassSession.date >= date_from)
+    )
+    rows = session_rows(target.id, target.day, target.start_hour, target.length, date_from, date_to)
+    if rows:
+        connection.execute(_insert(connection), rows)
+
+@event.listens_for(GroupClass, 'after_insert')
+def _class_inserted(mapper, connection, target):
+    _resync(connection, target)
+
+@event.listens_for(GroupClass, 'after_update')
+def _class_updated(mapper, connection, target):
+    state = db.inspect(target)
+    if any(state.attrs[c].history.has_changes() for c in ('day', 'start_hour', 'length')):
+        _resync(connection, target)
+
+@event.listens_for(GroupClass, 'before_delete')
+def _class_deleted(mapper, connection, target):
+    connection.execute(db.delete(ClassSession).where(ClassSession.group_class_id == target.id))
+
+@periodic('extend-sessions', at=time(2, 30))
+def _extend_sessions():
+    materialize_sessions()
+
+# Kanały iCalendar trenera (prowadzone zajęcia) i klienta (zajęcia, na które jest zapisany).
+# Treść jest budowana raz na wersję grafiku i dzień, a potem podawana z pamięci jako gotowe fragmenty bajtów.
+FEED_KINDS = ('trainer', 'client')
+FEED_PAST_DAYS = 7
+
+_feeds = LRUCache(max_size=2048)
+
+def _escape(text):
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+def _fold(line):
+    """Linie dłuższe niż 75 bajtów zawijane wg RFC 5545 (kontynuacja zaczyna się spacją)."""
+    data = line.encode()
+    if len(data) <= 75:
+        return data + b'\r\n'
+    parts, current = [], b''
+    for char in line:
+        encoded = char.encode()
+        if len(current) + len(encoded) > (75 if not parts else 74):
+            parts.append(current)
+            current = b''
+        current += encoded
+    parts.append(current)
+    return b'\r\n '.join(parts) + b'\r\n'
+
+def _lines(*lines):
+    return b''.join(_fold(line) for line in lines)
+
+def _build_feed(kind, person_id, secret):
+    person = db.session.execute(
+        db.select(Person.first_name, Person.last_name)
+        .where(Person.id == person_id, Person.type == kind, Person.active == True, Person.feed_secret == secret)
+    ).first()
+    if person is None:
+        return None
+    since = datetime.combine(date.today() - timedelta(days=FEED_PAST_DAYS), time())
+    stmt = (
+        db.select(ClassSession.group_class_id, ClassSession.date, ClassSession.starts_at, ClassSession.ends_at,
+                  GroupClass.name, Trainer.first_name, Trainer.last_name)
+        .join(GroupClass, GroupClass.id == ClassSession.group_class_id)
+        .join(Trainer, Trainer.id == GroupClass.trainer_id)
+        .where(ClassSession.starts_at >= since)
+        .order_by(ClassSession.starts_at)
+    )
+    if kind == 'trainer':
+        stmt = stmt.where(GroupClass.trainer_id == person_id)
+    else:
+        stmt = stmt.join(Participation, Participation.group_class_id == ClassSession.group_class_id).where(Participation.client_id == person_id)
+
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    host = current_app.config['CALENDAR_UID_DOMAIN']
+    chunks = [_lines(
+        'BEGIN:VCALENDAR', 'VERSION:2.0', 'PRODID:-//Silownia//Grafik zajec//PL', 'CALSCALE:GREGORIAN', 'METHOD:PUBLISH',
+        f'X-WR-CALNAME:{_escape(f"Grafik - {person.first_name} {person.last_name}")}',
+        f'REFRESH-INTERVAL;VALUE=DURATION:PT{current_app.config["CALENDAR_MAX_AGE"] // 60}M',
+    )]
+    for class_id, day, starts_at, ends_at, name, trainer_first, trainer_last in db.session.execute(stmt):
+        chunks.append(_lines(
+            'BEGIN:VEVENT',
+            f'UID:{class_id}-{day:%Y%m%d}@{host}',
+            f'DTSTAMP:{stamp}',
+            f'DTSTART:{starts_at:%Y%m%dT%H%M%S}',
+            f'DTEND:{ends_at:%Y%m%dT%H%M%S}',
+            f'SUMMARY:{_escape(name)}',
+            f'DESCRIPTION:{_escape(f"Trener: {trainer_first} {trainer_last}")}',
+            'END:VEVENT',
+        ))
+    chunks.append(_lines('END:VCALENDAR'))
+    return tuple(chunks)
+
+def get_feed(kind, person_id, secret, version):
+    """Kanał iCalendar jako krotka fragmentów bajtów (None - brak aktywnej osoby z tym sekretem); ważny, dopóki nie zmieni się `version`."""
+    key = (kind, person_id, secret)
+    entry = _feeds.get(key)
+    if entry is not None and entry[0] == version:
+        return entry[1]
+    chunks = _build_feed(kind, person_id, secret)
+    _feeds.set(key, (version, chunks))
+    return chunks
+
+# dezaktywacja osoby albo nowy sekret muszą od razu zamknąć kanał we wszystkich procesach,
+# także dla klientów z zapamiętanym ETag - stąd wspólny licznik, który jest częścią wersji kanału
+@event.listens_for(Person, 'after_update', propagate=True)
+def _feed_access_changed(mapper, connection, target):
+    state = db.inspect(target)
+    if any(state.attrs[c].history.has_changes() for c in ('active', 'feed_secret')):
+        bump_version(CALENDAR_FEEDS, connection)
+
+@event.listens_for(Person, 'after_delete', propagate=True)
+def _feed_person_deleted(mapper, connection, target):
+    bump_version(CALENDAR_FEEDS, connection)
+
+@click.command('materialize-sessions')
+def materialize_sessions_command():
+    """Generates dated class sessions up to SESSION_HORIZON_DAYS ahead"""
+    added = materialize_sessions()
+    db.session.commit()
+    click.echo(f'Added {added} sessions')
+
+def init_app(app):
+    _feeds.max_size = app.config['CALENDAR_CACHE_SIZE']
+    app.cli.add_command(materialize_sessions_command)
@@ -0,0 +1,83 @@
+import os
+import time
+import click
+from flask import current_app
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from app.cache import LRUCache
+
+class FragmentCache:
+    """Wyrenderowane fragmenty szablonów w pamięci procesu, wg nazwy i kluczy podanych w tagu {% cache %}.
+
+    Klucze mają opisywać wszystko, od czego fragment zależy (np. rola i imię zalogowanego w nawigacji) -
+    wtedy zmiana danych sama trafia pod nowy klucz, także w pozostałych procesach.
+    """
+
+    def __init__(self, max_size=4096):
+        self._entries = LRUCache(max_size=max_size)
+        self.enabled = True
+
+    def init_app(self, app):
+        self._entries = LRUCache(max_size=app.config['FRAGMENT_CACHE_SIZE'])
+        self.enabled = app.config['FRAGMENT_CACHE_SIZE'] > 0
+        app.extensions['fragment_cache'] = self
+
+    def render(self, name, keys, render):
+        if not self.enabled:
+            return render()
+        key = (name, keys)
+        html = self._entries.get(key)
+        if html is None:
+            html = Markup(render())
+            self._entries.set(key, html)
+        return html
+
+    def clear(self):
+        self._entries.clear()
+
+fragment_cache = FragmentCache()
+
+class FragmentCacheExtension(Extension):
+    """{% cache 'nazwa', klucz1, klucz2 %}...{% endcache %} - klucze muszą być haszowalne."""
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        name = parser.parse_expression()
+        keys = []
+        while parser.stream.skip_if('comma'):
+            keys.append(parser.parse_expression())
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        call = self.call_method('_render', [name, nodes.Tuple(keys, 'load', lineno=lineno)])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _render(self, name, keys, caller):
+        return fragment_cache.render(name, keys, caller)
+
+def precompile_templates(app):
+    """Kompiluje wszystkie szablony .html do pamięci środowiska Jinja (i do pamięci kodu bajtowego). Zwraca ich liczbę."""
+    names = app.jinja_env.list_templates(extensions=['html'])
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+@click.command('precompile-templates')
+def precompile_templates_command():
+    """Compiles all templates into the Jinja bytecode cache (run after each deploy)"""
+    started = time.perf_counter()
+    count = precompile_templates(current_app)
+    elapsed = (time.perf_counter() - started) * 1000
+    directory = current_app.config['TEMPLATE_BYTECODE_DIR'] or os.path.join(current_app.instance_path, 'jinja_cache')
+    target = directory if current_app.config['TEMPLATE_BYTECODE_CACHE'] else 'memory only (TEMPLATE_BYTECODE_CACHE off)'
+    click.echo(f'Compiled {count} templates in {elapsed:.0f} ms -> {target}')
+
+def init_app(app):
+    # kod bajtowy jest unieważniany sumą kontrolną źródła, więc katalog może przetrwać wdrożenia
+    if app.config['TEMPLATE_BYTECODE_CACHE']:
+        directory = app.config['TEMPLATE_BYTECODE_DIR'] or os.path.join(app.instance_path, 'jinja_cache')
+        os.makedirs(directory, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    fragment_cache.init_app(app)
+    app.cli.add_command(precompile_templates_command)
@@ -0,0 +1,211 @@
+import bisect
+from collections import namedtuple
+from datetime import time
+import click
+from app.db import db, GroupClass, Trainer, _read_import_rows
+from app.schedule_cache import cached, invalidate_schedule
+from app.sessions import materialize_sessions
+
+DAY_NAMES = ('Poniedziałek', 'Wtorek', 'Środa', 'Czwartek', 'Piątek', 'Sobota', 'Niedziela')
+
+# godziny, w których można planować zajęcia (minuty od północy) i siatka proponowanych godzin
+OPEN_MINUTE = 6 * 60
+CLOSE_MINUTE = 23 * 60
+SLOT_STEP = 15
+
+Interval = namedtuple('Interval', 'start end class_id name')
+Slot = namedtuple('Slot', 'day start_hour')
+
+def to_minutes(value):
+    return value.hour * 60 + value.minute
+
+def to_time(minutes):
+    return time(minutes // 60, minutes % 60)
+
+class DayIntervals:
+    """Zajęcia jednego trenera w jednym dniu: przedziały posortowane po początku i maksima końców prefiksów.
+
+    Czy coś nachodzi na [start, end): wśród przedziałów zaczynających się przed `end` (bisect)
+    wystarczy porównać największy koniec z `start` - O(log n), także gdy istniejące zajęcia same się nakładają.
+    """
+
+    def __init__(self):
+        self.starts = []
+        self.intervals = []
+        self.max_ends = []
+
+    def add(self, interval):
+        i = bisect.bisect_right(self.starts, interval.start)
+        self.starts.insert(i, interval.start)
+        self.intervals.insert(i, interval)
+        self.max_ends[i:] = []
+        running = self.max_ends[-1] if self.max_ends else 0
+        for item in self.intervals[i:]:
+            running = max(running, item.end)
+            self.max_ends.append(running)
+
+    def overlapping(self, start, end, exclude_id=None):
+        k = bisect.bisect_left(self.starts, end)
+        if k == 0 or self.max_ends[k - 1] <= start:
+            return []
+        return [item for item in self.intervals[:k] if item.end > start and item.class_id != exclude_id]
+
+    def gaps(self, exclude_id=None):
+        """Wolne przedziały [od, do) w godzinach otwarcia."""
+        free, cursor = [], OPEN_MINUTE
+        for item in self.intervals:
+            if item.class_id == exclude_id:
+                continue
+            if item.start > cursor:
+                free.append((cursor, min(item.start, CLOSE_MINUTE)))
+            cursor = max(cursor, item.end)
+        if cursor < CLOSE_MINUTE:
+            free.append((cursor, CLOSE_MINUTE))
+        return [(a, b) for a, b in free if a < b]
+
+class ScheduleIndex:
+    """Indeks przedziałowy grafiku: (trener, dzień tygodnia) -> DayIntervals."""
+
+    def __init__(self, rows=()):
+        self._days = {}
+        for row in rows:
+            self.add(*row)
+
+    def add(self, class_id, name, trainer_id, day, start_hour, length):
+        start = to_minutes(start_hour)
+        self._days.setdefault((trainer_id, day), DayIntervals()).add(Interval(start, start + length, class_id, name))
+
+    def conflicts(self, trainer_id, day, start_hour, length, exclude_id=None):
+        """Zajęcia trenera nachodzące na podany termin (Interval, z czasami w minutach)."""
+        day_intervals = self._days.get((trainer_id, day))
+        if day_intervals is None:
+            return []
+        start = to_minutes(start_hour)
+        return day_intervals.overlapping(start, start + length, exclude_id)
+
+    def suggest(self, trainer_id, day, start_hour, length, exclude_id=None, limit=3):
+        """Najbliższe wolne terminy trenera: najpierw tego samego dnia (wg odległości), potem ta sama godzina w inne dni."""
+        wanted = to_minutes(start_hour)
+        day_intervals = self._days.get((trainer_id, day), DayIntervals())
+        same_day = []
+        for a, b in day_intervals.gaps(exclude_id):
+            latest = b - length
+            if latest < a:
+                continue
+            # punkt siatki najbliższy żądanej godzinie, a gdy w luce nie ma punktu siatki - początek luki
+            first = -(-a // SLOT_STEP) * SLOT_STEP
+            last = latest // SLOT_STEP * SLOT_STEP
+            if first <= last:
+                candidate = min(max(round(wanted / SLOT_STEP) * SLOT_STEP, first), last)
+            else:
+                candidate = a
+            same_day.append(candidate)
+        same_day.sort(key=lambda minutes: abs(minutes - wanted))
+        slots = [Slot(day, to_time(minutes)) for minutes in same_day[:limit]]
+
+        if wanted + length <= CLOSE_MINUTE:
+            for offset in (1, -1, 2, -2, 3, -3):
+                other = (day + offset) % 7
+                if len(slots) >= limit:
+                    break
+                if not self.conflicts(trainer_id, other, start_hour, length, exclude_id):
+                    slots.append(Slot(other, start_hour))
+        return slots[:limit]
+
+def build_index():
+    rows = db.session.execute(
+        db.select(GroupClass.id, GroupClass.name, GroupClass.trainer_id, GroupClass.day, GroupClass.start_hour, GroupClass.length)
+    )
+    return ScheduleIndex(rows)
+
+def get_index(version):
+    """Indeks aktualnego grafiku - współdzielony i tylko do odczytu (do sprawdzania nowych zajęć budować własny)."""
+    return cached(('index',), version, build_index)
+
+def _format(minutes):
+    return f'{minutes // 60:02d}:{minutes % 60:02d}'
+
+def conflict_message(index, trainer_id, day, start_hour, length, exclude_id=None):
+    """Opis konfliktu z propozycjami wolnych terminów albo None, gdy trener jest wolny."""
+    conflicts = index.conflicts(trainer_id, day, start_hour, length, exclude_id)
+    if not conflicts:
+        return None
+    busy = ', '.join(f'{item.name} ({_format(item.start)}-{_format(item.end)})' for item in conflicts)
+    message = f'Trener prowadzi w tym czasie: {busy}.'
+    slots = index.suggest(trainer_id, day, start_hour, length, exclude_id)
+    if slots:
+        message += ' Wolne terminy: ' + ', '.join(f'{DAY_NAMES[slot.day]} {slot.start_hour:%H:%M}' for slot in slots) + '.'
+    return message
+
+SCHEDULE_COLUMNS = ('name', 'day', 'start_hour', 'length', 'trainer_id')
+
+def _parse_schedule_row(row, trainers):
+    """Wartości kolumn GroupClass z wiersza importu albo komunikat błędu."""
+    for name in SCHEDULE_COLUMNS:
+        if not row.get(name):
+            return None, f'brak pola {name}'
+    if not (2 <= len(row['name']) <= 100):
+        return None, 'nazwa musi mieć od 2 do 100 znaków'
+    try:
+        values = dict(
+            name=row['name'], day=int(row['day']), start_hour=time.fromisoformat(row['start_hour']),
+            length=int(row['length']), capacity=int(row.get('capacity') or 20), trainer_id=int(row['trainer_id'])
+        )
+    except ValueError:
+        return None, 'niepoprawna liczba lub godzina'
+    if not (0 <= values['day'] <= 6):
+        return None, 'dzień tygodnia musi być liczbą od 0 (poniedziałek) do 6'
+    if not (15 <= values['length'] <= 240):
+        return None, 'zajęcia muszą trwać od 15 do 240 minut'
+    if not (1 <= values['capacity'] <= 500):
+        return None, 'liczba miejsc musi wynosić od 1 do 500'
+    if values['trainer_id'] not in trainers:
+        return None, f'brak aktywnego trenera {values["trainer_id"]}'
+    return values, None
+
+def import_schedule(path, dry_run=False):
+    """Import zajęć z pliku CSV/JSON: cały plik albo nic. Zwraca (liczba zajęć, [(wiersz, błąd)]).
+
+    Wiersze są sprawdzane jednym przebiegiem po indeksie grafiku, do którego trafiają też
+    wcześniejsze wiersze pliku - wykrywa to konflikty z bazą i wewnątrz samego pliku.
+    """
+    trainers = set(db.session.execute(db.select(Trainer.id).where(Trainer.active == True)).scalars())
+    index = build_index()
+    rows, errors = _read_import_rows(path)
+    accepted = []
+    for line, row in rows:
+        values, error = _parse_schedule_row(row, trainers)
+        if error is None:
+            error = conflict_message(index, values['trainer_id'], values['day'], values['start_hour'], values['length'])
+        if error is not None:
+            errors.append((line, error))
+            continue
+        index.add(f'wiersz {line}', values['name'], values['trainer_id'], values['day'], values['start_hour'], values['length'])
+        accepted.append(values)
+
+    if errors or dry_run or not accepted:
+        db.session.rollback()
+        return (0 if errors else len(accepted)), errors
+    db.session.execute(db.insert(GroupClass), accepted)
+    materialize_sessions()  # wstawienie zbiorcze omija zdarzenia mappera
+    invalidate_schedule()
+    db.session.commit()
+    return len(accepted), errors
+
+@click.command('import-schedule')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--dry-run', is_flag=True, help='Only validate the file')
+def import_schedule_command(path, dry_run):
+    """Imports group classes from a CSV or JSON file, rejecting the whole file on any error or trainer conflict"""
+    imported, errors = import_schedule(path, dry_run)
+    for line, error in errors:
+        click.echo(click.style(f"Wiersz {line}: {error}", fg='red'))
+    if errors:
+        click.echo(click.style(f"Nie zaimportowano grafiku - błędnych wierszy: {len(errors)}.", fg='red'))
+    elif dry_run:
+        click.echo(click.style(f"Plik poprawny, zajęć do zaimportowania: {imported}.", fg='green'))
+    else:
+        click.echo(click.style(f"Zaimportowano {imported} zajęć.", fg='green'))
+
+def init_app(app):
+    app.cli.add_command(import_schedule_command)
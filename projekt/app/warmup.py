@@ -0,0 +1,61 @@
+import importlib
+import pkgutil
+import time
+import click
+from flask import current_app
+from sqlalchemy import exc
+from sqlalchemy.orm import configure_mappers
+from app.db import db
+from app.templating import precompile_templates
+from app.schedule_cache import schedule_version, get_classes
+from app.timetable import get_index
+
+def _import_modules():
+    import app as package
+    names = [name for _, name, _ in pkgutil.walk_packages(package.__path__, package.__name__ + '.')]
+    for name in names:
+        importlib.import_module(name)
+    return len(names)
+
+def _prime_caches():
+    version = schedule_version()
+    get_classes(version)
+    get_index(version)
+    db.session.commit()
+
+def warmup(app):
+    """Przygotowuje aplikację w procesie nadrzędnym serwera z preforkiem (gunicorn --preload).
+
+    Import modułów, kompilacja szablonów, konfiguracja mapperów i pamięci podręczne grafiku są robione raz,
+    a procesy robocze dziedziczą je przez fork. Na końcu pula połączeń jest opróżniana, żeby żadne połączenie
+    nie przeszło do procesów potomnych. Zwraca {krok: ms}.
+    """
+    timings = {}
+
+    def step(name, fn):
+        started = time.perf_counter()
+        fn()
+        timings[name] = (time.perf_counter() - started) * 1000
+
+    step('modules', _import_modules)
+    step('templates', lambda: precompile_templates(app))
+    step('mappers', configure_mappers)
+    with app.app_context():
+        try:
+            step('caches', _prime_caches)
+        except exc.SQLAlchemyError as e:
+            # baza bez schematu (pierwsze wdrożenie przed init-db) - procesy zbudują pamięci same
+            db.session.rollback()
+            app.logger.warning('Pominięto wstępne ładowanie pamięci podręcznych: %s', getattr(e, 'orig', e))
+        for engine in db.engines.values():
+            engine.dispose()
+    return timings
+
+@click.command('warmup')
+def warmup_command():
+    """Runs the preload warmup and shows how long each step takes"""
+    for name, elapsed in warmup(current_app._get_current_object()).items():
+        click.echo(f'{name:10} {elapsed:8.1f} ms')
+
+def init_app(app):
+    app.cli.add_command(warmup_command)
@@ -4,4 +4,105 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'DEV'
 
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'instance/db.db')
\ No newline at end of file
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'instance/db.db')
+    # pragmy wykonywane na każdym nowym połączeniu SQLite (puste - bez zmian)
+    SQLITE_PRAGMAS = {}
+    # transakcje żądań zapisujących (POST, DELETE...) na SQLite zaczynają się od BEGIN IMMEDIATE (patrz app.engine)
+    SQLITE_BEGIN_IMMEDIATE = False
+    # widoki @read_only czytają z osobnej puli: DATABASE_READ_URL (replika), a bez niej - dla pliku SQLite -
+    # z tego samego pliku otwartego w trybie mode=ro; zapisy zawsze idą do bazy głównej
+    DATABASE_READ_ROUTING = os.environ.get('DATABASE_READ_ROUTING', '1') == '1'
+    DATABASE_READ_URL = os.environ.get('DATABASE_READ_URL')
+    DATABASE_READ_POOL_SIZE = int(os.environ.get('DATABASE_READ_POOL_SIZE', 10))
+
+    PAGE_SIZE = int(os.environ.get('PAGE_SIZE', 50))
+    MAX_PAGE_SIZE = 500
+
+    ARGON2_PROFILE = os.environ.get('ARGON2_PROFILE', 'default')
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 2))
+    PASSWORD_HASH_QUEUE_LIMIT = int(os.environ.get('PASSWORD_HASH_QUEUE_LIMIT', 8))
+    PASSWORD_HASH_TIMEOUT = 10
+
+    USER_CACHE_SIZE = 1024
+    USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 30))
+    # co ile sekund proces sprawdza wspólny licznik zmian ról i aktywności kont (0 - w każdym żądaniu)
+    USER_CACHE_SYNC_INTERVAL = float(os.environ.get('USER_CACHE_SYNC_INTERVAL', 2))
+
+    # ważność tokenu API (s) - token niesie id, rolę i profil, więc żądania API nie czytają użytkownika z bazy
+    API_TOKEN_MAX_AGE = int(os.environ.get('API_TOKEN_MAX_AGE', 24 * 3600))
+
+    # instrumentacja SQL: próg wolnego zapytania, plik dziennika (None - log aplikacji),
+    # liczba powtórzeń jednego kształtu zapytania uznawana za N+1, nagłówki X-SQL-* i panel w stopce
+    SQL_SLOW_QUERY_MS = int(os.environ.get('SQL_SLOW_QUERY_MS', 100))
+    SQL_SLOW_QUERY_LOG = os.environ.get('SQL_SLOW_QUERY_LOG')
+    SQL_N_PLUS_ONE_THRESHOLD = 10
+    SQL_STATS_HEADERS = os.environ.get('SQL_STATS_HEADERS') == '1'
+    SQL_DEBUG_PANEL = os.environ.get('SQL_DEBUG_PANEL') == '1'
+
+    # profilowanie żądań: katalog (None - instance/profiles), odsetek losowo profilowanych żądań, liczba przechowywanych profili
+    PROFILE_DIR = os.environ.get('PROFILE_DIR')
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    PROFILE_KEEP = 200
+
+    # zadania w tle: liczba wątków wykonawczych, start wykonawcy w procesie aplikacji (inaczej tylko `flask worker`),
+    # odpytywanie kolejki (s), po ilu sekundach zadanie 'running' uznajemy za porzucone, pierwsze opóźnienie ponowienia (s)
+    JOB_WORKER_THREADS = int(os.environ.get('JOB_WORKER_THREADS', 2))
+    JOB_WORKER_IN_PROCESS = os.environ.get('JOB_WORKER_IN_PROCESS', '1') == '1'
+    JOB_POLL_INTERVAL = 1.0
+    JOB_TIMEOUT = 600
+    JOB_RETRY_DELAY = 30
+    JOB_KEEP_DAYS = 7
+
+    # terminy zajęć (class_session): ile dni naprzód generować i ile dni wstecz przechowywać;
+    # kanały iCalendar: liczba kanałów w pamięci, zalecany odstęp odpytywania (s) i domena w UID wydarzeń
+    SESSION_HORIZON_DAYS = int(os.environ.get('SESSION_HORIZON_DAYS', 56))
+    SESSION_KEEP_DAYS = 90
+    CALENDAR_CACHE_SIZE = int(os.environ.get('CALENDAR_CACHE_SIZE', 2048))
+    CALENDAR_MAX_AGE = int(os.environ.get('CALENDAR_MAX_AGE', 900))
+    CALENDAR_UID_DOMAIN = os.environ.get('CALENDAR_UID_DOMAIN', 'silownia.local')
+
+    # szablony: trwała pamięć kodu bajtowego Jinja (katalog None - instance/jinja_cache)
+    # i liczba fragmentów {% cache %} w pamięci procesu (0 - wyłączone)
+    TEMPLATE_BYTECODE_CACHE = os.environ.get('TEMPLATE_BYTECODE_CACHE', '1') == '1'
+    TEMPLATE_BYTECODE_DIR = os.environ.get('TEMPLATE_BYTECODE_DIR')
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE', 4096))
+
+    # rozgrzewka w create_app (app.warmup) - dla serwera z preforkiem uruchamianego z --preload
+    PRELOAD_WARMUP = os.environ.get('PRELOAD_WARMUP') == '1'
+
+class SQLiteConfig(Config):
+    """Lokalny plik SQLite - WAL, dzięki czemu odczyty nie czekają na zapisy."""
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',  # w trybie WAL fsync tylko przy checkpoincie, bez ryzyka uszkodzenia bazy
+        'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)),  # ms oczekiwania na blokadę zapisu
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,  # wartość ujemna - w KiB
+        'temp_store': 'MEMORY',
+    }
+    SQLITE_BEGIN_IMMEDIATE = True
+
+class PostgresConfig(Config):
+    """Serwer PostgreSQL - pula połączeń ze sprawdzaniem przed użyciem i limitami czasu zapytań."""
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'postgresql+psycopg://localhost/silownia'
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DATABASE_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DATABASE_MAX_OVERFLOW', 10)),
+        'pool_timeout': 10,
+        'pool_recycle': 1800,
+        'pool_pre_ping': True,
+        'connect_args': {
+            'connect_timeout': 5,
+            'options': '-c statement_timeout={} -c lock_timeout={} -c idle_in_transaction_session_timeout={}'.format(
+                int(os.environ.get('DATABASE_STATEMENT_TIMEOUT', 5000)),
+                int(os.environ.get('DATABASE_LOCK_TIMEOUT', 2000)),
+                60000,
+            ),
+        },
+    }
+
+# profil wybierany zmienną środowiskową DATABASE_PROFILE
+DATABASE_PROFILES = {
+    'sqlite': SQLiteConfig,
+    'postgresql': PostgresConfig,
+}